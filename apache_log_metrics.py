@@ -12,10 +12,13 @@ We are interested in static file bandwidth, so it parses out GET requests to
 from __future__ import print_function
 
 import argparse
+import bisect
 import functools
 from logging import handlers
 import re
 import sys
+import threading
+import time
 
 # TODO(ayatane): Fix cros lint pylint to work with virtualenv imports
 # pylint: disable=import-error
@@ -26,6 +29,8 @@ from chromite.lib import ts_mon_config
 from chromite.lib import metrics
 from chromite.lib import cros_logging as logging
 
+import log_analytics
+
 # Log rotation parameters.  Keep about two weeks of old logs.
 #
 # For more, see the documentation in standard python library for
@@ -46,9 +51,26 @@ RPC_USAGE_MATCHER = re.compile(
     r'.*"(?P<http_method>\S+) /(?P<rpc_name>(?:api/)?[^/?]+)[^"]*" '
     r'2\d\d (?P<size>\S+) .*')
 
+# Matcher of both the lines above in a single pass: static_ok is only set on
+# 200 responses, and endpoint only when the request is a GET to /static. The
+# request is the first quoted field, which saves backtracking from the end of
+# the line.
+LOG_LINE_MATCHER = re.compile(
+    r'^(?P<ip_addr>\d+\.\d+\.\d+\.\d+) '
+    r'[^"]*"(?P<http_method>\S+) /(?P<rpc_name>(?:api/)?[^/?]+)'
+    r'(?:(?<=GET /static)/(?P<endpoint>\S*))?[^"]*" '
+    r'(?P<status>(?P<static_ok>200)|2\d\d) (?P<size>\S+) ')
+
 STATIC_GET_METRIC_NAME = 'chromeos/devserver/apache/static_response_size'
 DEVSERVER_RPC_USAGE_METRIC_NAME = 'chromeos/devserver/rpc_usage'
 
+# Default flush triggers of the MetricAggregator: seconds between two flushes
+# and number of increments after which a flush is started early.
+DEFAULT_FLUSH_INTERVAL = 60
+DEFAULT_FLUSH_INCREMENTS = 100000
+# Longest interval between two flushes when ts_mon is slow.
+_MAX_FLUSH_INTERVAL = 600
+
 
 LAB_SUBNETS = (
     ("172.17.40.0", 22),
@@ -90,14 +112,39 @@ def MatchesSubnet(ip, base, mask):
   return (ip_value & mask) == (base_value & mask)
 
 
+def _MergeSubnets(subnets):
+  """Returns the sorted, disjoint (first, last) IP value ranges of |subnets|.
+
+  Args:
+    subnets: An iterable of (base, mask) pairs, as in LAB_SUBNETS.
+  """
+  ranges = []
+  for base, mask in subnets:
+    first = IPToNum(base) & ((2**mask - 1) << (32 - mask))
+    ranges.append((first, first + 2**(32 - mask) - 1))
+  merged = []
+  for first, last in sorted(ranges):
+    if merged and first <= merged[-1][1] + 1:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+    else:
+      merged.append((first, last))
+  return merged
+
+
+_LAB_RANGES = _MergeSubnets(LAB_SUBNETS)
+_LAB_RANGE_FIRSTS = [first for first, _ in _LAB_RANGES]
+
+
 def InLab(ip):
   """Whether |ip| is an IPv4 address which is in the ChromeOS Lab.
 
   Args:
-    ip: An IPv4 address to be tested.
+    ip: An IPv4 address to be tested, in dotted-quad notation.
   """
-  return any(MatchesSubnet(ip, base, mask)
-             for (base, mask) in LAB_SUBNETS)
+  a, b, c, d = ip.split('.')
+  ip_value = (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
+  i = bisect.bisect_right(_LAB_RANGE_FIRSTS, ip_value) - 1
+  return i >= 0 and ip_value <= _LAB_RANGES[i][1]
 
 
 MILESTONE_PATTERN = re.compile(r'R\d+')
@@ -116,9 +163,22 @@ FILENAME_PATTERNS = [(re.compile(s), s) for s in FILENAME_CONSTANTS] + [
     (re.compile(r'chromeos_.*_full_test\.bin-.*'),
      'chromeos_*_full_test.bin-*'),
     (re.compile(r'test-.*\.bz2'), 'test-*.bz2'),
-    (re.compile(r'dep-.*\.bz2'), 'dep-*.bz2'),
 ]
 
+# All of FILENAME_PATTERNS in one regex, each in a group named after its
+# index. Alternatives are tried in order, so the group matching (lastgroup)
+# is the first of FILENAME_PATTERNS that MatchAny would find.
+_FILENAME_MATCHER = re.compile('|'.join(
+    '(?P<_%d>%s)' % (i, pattern.pattern)
+    for i, (pattern, _) in enumerate(FILENAME_PATTERNS)))
+_FILENAME_VALUES = dict(('_%d' % i, value)
+                        for i, (_, value) in enumerate(FILENAME_PATTERNS))
+
+# Maximum number of endpoints whose parsing is memoized; the memo is cleared
+# when it is full.
+_MAX_PARSED_ENDPOINTS = 4096
+_parsed_endpoints = {}
+
 
 def MatchAny(needle, patterns, default=''):
   for pattern, value in patterns:
@@ -127,6 +187,15 @@ def MatchAny(needle, patterns, default=''):
   return default
 
 
+def ClassifyFilename(filename):
+  """Returns the value of the first of FILENAME_PATTERNS matching |filename|.
+
+  This is MatchAny(filename, FILENAME_PATTERNS) in a single regex match.
+  """
+  m = _FILENAME_MATCHER.match(filename)
+  return _FILENAME_VALUES[m.lastgroup] if m else ''
+
+
 def ParseStaticEndpoint(endpoint):
   """Parses a /static/.* URL path into build_config, milestone, and filename.
 
@@ -135,9 +204,21 @@ def ParseStaticEndpoint(endpoint):
 
   This function expects the '/static/' prefix to already be stripped off.
 
+  The result is memoized: the same payloads get downloaded over and over.
+
   Args:
     endpoint: A string which is the matched URL path after /static/
   """
+  parsed = _parsed_endpoints.get(endpoint)
+  if parsed is None:
+    if len(_parsed_endpoints) >= _MAX_PARSED_ENDPOINTS:
+      _parsed_endpoints.clear()
+    parsed = _parsed_endpoints[endpoint] = _ParseStaticEndpoint(endpoint)
+  return parsed
+
+
+def _ParseStaticEndpoint(endpoint):
+  """Parses a /static/.* URL path, see ParseStaticEndpoint."""
   build_config, milestone, filename = [''] * 3
   try:
     parts = endpoint.split('/')
@@ -148,7 +229,7 @@ def ParseStaticEndpoint(endpoint):
       if not MILESTONE_PATTERN.match(milestone):
         milestone = ''
     if len(parts) >= 3:
-      filename = MatchAny(parts[-1], FILENAME_PATTERNS)
+      filename = ClassifyFilename(parts[-1])
 
   except IndexError as e:
     logging.debug('%s failed to parse. Caught %s', endpoint, str(e))
@@ -156,6 +237,129 @@ def ParseStaticEndpoint(endpoint):
   return build_config, milestone, filename
 
 
+class MetricAggregator(object):
+  """Sums counter increments in memory and sends them to ts_mon in batches.
+
+  Increments are summed per (metric name, fields) in a dictionary which a
+  background thread swaps out and sends every |flush_interval| seconds, or
+  as soon as |flush_increments| increments were added. Lines keep being
+  parsed into the new dictionary while the previous one is being sent.
+
+  When ts_mon is slow and a flush takes more than half the flush interval,
+  the interval doubles, up to _MAX_FLUSH_INTERVAL, and early flushes are
+  disabled: increments for the same fields keep being summed in memory
+  instead of being queued. The interval goes back to |flush_interval| once
+  flushes are fast again.
+  """
+
+  def __init__(self, flush_interval=DEFAULT_FLUSH_INTERVAL,
+               flush_increments=DEFAULT_FLUSH_INCREMENTS, clock=time.time):
+    """Initializes the aggregator.
+
+    Args:
+      flush_interval: Number of seconds between two flushes.
+      flush_increments: Number of increments after which to flush early.
+      clock: Function returning the current time, for tests.
+    """
+    self._clock = clock
+    self._base_interval = flush_interval
+    self._interval = flush_interval
+    self._flush_increments = flush_increments
+    self._lock = threading.Lock()
+    self._sums = {}
+    self._increments = 0
+    self._counters = {}
+    self._flush_requested = threading.Event()
+    self._stopped = False
+    self._thread = None
+
+  def Add(self, name, fields, value):
+    """Adds |value| to the counter |name| with |fields|.
+
+    Args:
+      name: The metric name.
+      fields: A tuple of (field name, value) pairs, in a constant order.
+      value: The increment.
+    """
+    key = (name, fields)
+    with self._lock:
+      self._sums[key] = self._sums.get(key, 0) + value
+      self._increments += 1
+      flush = (self._increments == self._flush_increments and
+               self._interval == self._base_interval)
+    if flush:
+      self._flush_requested.set()
+
+  def Flush(self):
+    """Sends the sums accumulated since the last flush to ts_mon."""
+    with self._lock:
+      sums, self._sums = self._sums, {}
+      self._increments = 0
+    start = self._clock()
+    for (name, fields), value in sums.items():
+      counter = self._counters.get(name)
+      if counter is None:
+        counter = self._counters[name] = metrics.Counter(name)
+      counter.increment_by(value, fields=dict(fields))
+    elapsed = self._clock() - start
+    if elapsed > self._interval / 2.0:
+      self._interval = min(self._interval * 2, _MAX_FLUSH_INTERVAL)
+      logging.warning('Sending %d metrics took %.1fs, flushing every %ds.',
+                      len(sums), elapsed, self._interval)
+    else:
+      self._interval = self._base_interval
+
+  def _Run(self):
+    while not self._stopped:
+      self._flush_requested.wait(self._interval)
+      self._flush_requested.clear()
+      try:
+        self.Flush()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception('Failed to flush metrics.')
+
+  def Start(self):
+    """Starts flushing in a background thread."""
+    self._thread = threading.Thread(target=self._Run, name='MetricAggregator')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def Stop(self):
+    """Stops the background thread and flushes what is left."""
+    self._stopped = True
+    self._flush_requested.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    self.Flush()
+
+  def __enter__(self):
+    self.Start()
+    return self
+
+  def __exit__(self, *_args):
+    self.Stop()
+
+
+# The MetricAggregator the emitters add to, if any. Counters are incremented
+# directly otherwise.
+_aggregator = None
+
+
+def SetAggregator(aggregator):
+  """Makes the emitters add to |aggregator|, or increment directly if None."""
+  global _aggregator  # pylint: disable=global-statement
+  _aggregator = aggregator
+
+
+def _IncrementCounter(name, value, fields):
+  """Increments the counter |name| with |fields|, a tuple of pairs."""
+  if _aggregator is not None:
+    _aggregator.Add(name, fields, value)
+  else:
+    metrics.Counter(name).increment_by(value, fields=dict(fields))
+
+
 def EmitStaticRequestMetric(m):
   """Emits a Counter metric for successful GETs to /static endpoints.
 
@@ -169,12 +373,11 @@ def EmitStaticRequestMetric(m):
   except ValueError:  # Zero is represented by "-"
     size = 0
 
-  metrics.Counter(STATIC_GET_METRIC_NAME).increment_by(
-      size, fields={
-          'build_config': build_config,
-          'milestone': milestone,
-          'in_lab': InLab(m.group('ip_addr')),
-          'endpoint': filename})
+  _IncrementCounter(STATIC_GET_METRIC_NAME, size, (
+      ('build_config', build_config),
+      ('milestone', milestone),
+      ('in_lab', InLab(m.group('ip_addr'))),
+      ('endpoint', filename)))
 
 
 def EmitRpcUsageMetric(m):
@@ -188,12 +391,21 @@ def EmitRpcUsageMetric(m):
   except ValueError:  # Zero is represented by "-"
     size = 0
 
-  metrics.Counter(DEVSERVER_RPC_USAGE_METRIC_NAME).increment_by(
-      size, fields={
-          'http_method': m.group('http_method'),
-          'rpc_name': m.group('rpc_name'),
-          'in_lab': InLab(m.group('ip_addr')),
-      })
+  _IncrementCounter(DEVSERVER_RPC_USAGE_METRIC_NAME, size, (
+      ('http_method', m.group('http_method')),
+      ('rpc_name', m.group('rpc_name')),
+      ('in_lab', InLab(m.group('ip_addr')))))
+
+
+def EmitLogLineMetrics(m):
+  """Emits the metrics of a line matched by LOG_LINE_MATCHER.
+
+  Args:
+    m: A regex match object
+  """
+  if m.group('endpoint') is not None and m.group('static_ok'):
+    EmitStaticRequestMetric(m)
+  EmitRpcUsageMetric(m)
 
 
 def RunMatchers(stream, matchers):
@@ -206,8 +418,6 @@ def RunMatchers(stream, matchers):
   """
   for line in iter(stream.readline, ''):
     for matcher, emitter in matchers:
-      logging.debug('Emitting %s for input "%s"',
-                    emitter.__name__, line.strip())
       m = matcher.match(line)
       if m:
         emitter(m)
@@ -215,22 +425,66 @@ def RunMatchers(stream, matchers):
 
 # TODO(phobbs) add a matcher for all requests, not just static files.
 MATCHERS = [
-    (STATIC_GET_MATCHER, EmitStaticRequestMetric),
-    (RPC_USAGE_MATCHER, EmitRpcUsageMetric),
+    (LOG_LINE_MATCHER, EmitLogLineMetrics),
 ]
 
+# The request time of a log line, e.g. [30/Jun/2016:15:34:40 -0700].
+_TIMESTAMP_MATCHER = re.compile(r'[^[]*\[([^]]+)\]')
+
+
+def ParseLogLine(line):
+  """Parses a log line for log_analytics, with the matchers of the metrics.
+
+  Args:
+    line: A line of the Apache access log.
+
+  Returns:
+    None if the line does not match LOG_LINE_MATCHER, else a (timestamp,
+    endpoint, size, status, cache_status, in_lab) tuple. The endpoint is the
+    RPC name, or 'static:' followed by the file name class for downloads.
+  """
+  m = LOG_LINE_MATCHER.match(line)
+  timestamp = _TIMESTAMP_MATCHER.match(line)
+  if not m or not timestamp:
+    return None
+  if m.group('endpoint') is not None:
+    endpoint = 'static:%s' % (ParseStaticEndpoint(m.group('endpoint'))[2] or
+                              'other')
+  else:
+    endpoint = m.group('rpc_name')
+  try:
+    size = int(m.group('size'))
+  except ValueError:  # Zero is represented by "-"
+    size = 0
+  return (timestamp.group(1), endpoint, size, int(m.group('status')), '',
+          InLab(m.group('ip_addr')))
+
 
 def ParseArgs():
   """Parses command line arguments."""
   p = argparse.ArgumentParser(
       description='Parses apache logs and emits metrics to Monarch')
-  p.add_argument('--logfile', required=True)
-  return p.parse_args()
+  p.add_argument('--logfile')
+  p.add_argument('--flush-interval', type=int, default=DEFAULT_FLUSH_INTERVAL,
+                 help='Seconds between two flushes of the summed metrics.')
+  p.add_argument('--flush-increments', type=int,
+                 default=DEFAULT_FLUSH_INCREMENTS,
+                 help='Number of metric increments after which the summed '
+                 'metrics are flushed early.')
+  log_analytics.AddArguments(p)
+  args = p.parse_args()
+  if not args.analyze and not args.logfile:
+    p.error('--logfile is required unless --analyze is used.')
+  return args
 
 
 def main():
   """Sets up logging and runs matchers against stdin"""
   args = ParseArgs()
+  if args.analyze:
+    log_analytics.Analyze(args, ParseLogLine)
+    return
+
   root = logging.getLogger()
 
   root.addHandler(handlers.TimedRotatingFileHandler(
@@ -240,7 +494,13 @@ def main():
   root.setLevel(logging.DEBUG)
   with ts_mon_config.SetupTsMonGlobalState('devserver_apache_log_metrics',
                                            indirect=True):
-    RunMatchers(sys.stdin, MATCHERS)
+    with MetricAggregator(args.flush_interval,
+                          args.flush_increments) as aggregator:
+      SetAggregator(aggregator)
+      try:
+        RunMatchers(sys.stdin, MATCHERS)
+      finally:
+        SetAggregator(None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Replay benchmark of apache_log_metrics.
+
+Generates a synthetic Apache access log mixing /static downloads, RPCs and
+failed requests from lab and non-lab clients, then replays it through
+apache_log_metrics.RunMatchers with metrics going to a no-op sink: with the
+separate static and RPC matchers, with the combined LOG_LINE_MATCHER, and
+with LOG_LINE_MATCHER summing the metrics in a MetricAggregator. Prints the
+throughput of each in lines per second.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+import six
+
+import apache_log_metrics
+
+
+_BUILDS = ['%s-release/R%d-%d.0.0' % (board, milestone, 12000 + milestone)
+           for board in ('eve', 'kevin', 'octopus', 'nami', 'coral')
+           for milestone in range(78, 86)]
+
+_FILENAMES = [
+    'stateful.tgz', 'autotest_server_package.tar.bz2',
+    'chromeos_R80-1_eve_delta_test.bin-abcdef', 'dep-client.bz2',
+    'test-suites.bz2', 'update.gz', 'full_dev_part_KERNEL.bin.gz',
+]
+
+_RPCS = ['stage', 'is_staged', 'list_suite_controls', 'update/eve-release',
+         'api/hostinfo', 'check_health']
+
+
+def _RandomIp():
+  if random.random() < 0.8:
+    return '100.115.%d.%d' % (random.randrange(128, 256), random.randrange(256))
+  return '172.24.%d.%d' % (random.randrange(256), random.randrange(256))
+
+
+def GenerateLog(lines):
+  """Returns a synthetic Apache access log of |lines| lines."""
+  log = []
+  for _ in range(lines):
+    kind = random.random()
+    if kind < 0.6:
+      request = 'GET /static/%s/%s' % (random.choice(_BUILDS),
+                                       random.choice(_FILENAMES))
+    else:
+      request = '%s /%s?build=%s' % (random.choice(('GET', 'POST')),
+                                     random.choice(_RPCS),
+                                     random.choice(_BUILDS))
+    status = random.choice((200, 200, 200, 200, 206, 304, 404, 500))
+    log.append('%s - - [08/Sep/2019:07:30:29 -0700] "%s HTTP/1.1" %d %s "-" '
+               '"curl/7.35"\n' % (_RandomIp(), request, status,
+                                  random.randrange(1, 1 << 30)))
+  return ''.join(log)
+
+
+class _Counter(object):
+  """A metric which drops every increment.
+
+  Like ts_mon, it normalizes the fields and takes a lock on every increment,
+  which is the part of the cost the aggregation saves.
+  """
+
+  _lock = threading.Lock()
+
+  def increment_by(self, size, fields=None):
+    with self._lock:
+      _ = (size, tuple(sorted((fields or {}).items())))
+
+
+class _NoOpMetrics(object):
+  """A stand-in for chromite.lib.metrics dropping everything."""
+
+  @staticmethod
+  def Counter(_name):
+    return _Counter()
+
+
+def Replay(log, matchers):
+  """Returns the lines per second of RunMatchers on |log|."""
+  start = time.time()
+  apache_log_metrics.RunMatchers(six.StringIO(log), matchers)
+  return log.count('\n') / (time.time() - start)
+
+
+def ParseArguments(argv):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--lines', type=int, default=500000,
+                      help='Number of log lines to replay.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  opts = ParseArguments(argv)
+  log = GenerateLog(opts.lines)
+  apache_log_metrics.metrics = _NoOpMetrics()
+  separate = [
+      (apache_log_metrics.STATIC_GET_MATCHER,
+       apache_log_metrics.EmitStaticRequestMetric),
+      (apache_log_metrics.RPC_USAGE_MATCHER,
+       apache_log_metrics.EmitRpcUsageMetric),
+  ]
+  results = {
+      'separate_matchers_lines_per_second': int(Replay(log, separate)),
+      'combined_matcher_lines_per_second': int(
+          Replay(log, apache_log_metrics.MATCHERS)),
+  }
+  with apache_log_metrics.MetricAggregator() as aggregator:
+    apache_log_metrics.SetAggregator(aggregator)
+    results['aggregated_lines_per_second'] = int(
+        Replay(log, apache_log_metrics.MATCHERS))
+    apache_log_metrics.SetAggregator(None)
+  print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -9,6 +9,7 @@
 from __future__ import print_function
 
 import mock
+import six
 import unittest
 
 import apache_log_metrics
@@ -44,6 +45,61 @@ class TestParsers(unittest.TestCase):
 
     self.assertEqual(match.group('size'), '13805917')
 
+  def testLogLineMatcher(self):
+    """Tests the combined matcher finds the static and RPC fields."""
+    match = apache_log_metrics.LOG_LINE_MATCHER.match(STATIC_REQUEST_LINE)
+    self.assertEqual(match.group('endpoint'),
+                     'veyron_minnie-release/R52-8350.46.0/'
+                     'autotest_server_package.tar.bz2')
+    self.assertEqual(match.group('rpc_name'), 'static')
+    self.assertEqual(match.group('size'), '13805917')
+    self.assertTrue(match.group('static_ok'))
+
+    for line in RPC_REQUEST_LINE:
+      match = apache_log_metrics.LOG_LINE_MATCHER.match(line)
+      self.assertTrue(match)
+      self.assertIsNone(match.group('endpoint'))
+
+    partial = STATIC_REQUEST_LINE.replace('" 200 ', '" 206 ')
+    match = apache_log_metrics.LOG_LINE_MATCHER.match(partial)
+    self.assertFalse(match.group('static_ok'))
+    self.assertFalse(apache_log_metrics.LOG_LINE_MATCHER.match(
+        STATIC_REQUEST_LINE.replace('" 200 ', '" 404 ')))
+
+  def testInLab(self):
+    """Tests the subnet range table against the subnet masks."""
+    for ip in ('172.17.40.0', '172.17.43.255', '172.17.44.0', '100.115.254.1',
+               '100.107.141.127', '100.107.141.128', '100.107.126.200',
+               '0.0.0.0', '255.255.255.255'):
+      self.assertEqual(
+          apache_log_metrics.InLab(ip),
+          any(apache_log_metrics.MatchesSubnet(ip, base, mask)
+              for base, mask in apache_log_metrics.LAB_SUBNETS), ip)
+
+  def testParseStaticEndpoint(self):
+    """Tests static endpoints are parsed and their filenames classified."""
+    for _ in range(2):
+      self.assertEqual(
+          apache_log_metrics.ParseStaticEndpoint(
+              'eve-release/R80-12739.0.0/chromeos_R80_delta_test.bin-abc'),
+          ('eve-release', 'R80', 'chromeos_*_delta_test.bin-*'))
+    self.assertEqual(
+        apache_log_metrics.ParseStaticEndpoint(
+            'eve-release/LATEST-1/dep-x.bz2'),
+        ('eve-release', '', 'dep-*.bz2'))
+    self.assertEqual(apache_log_metrics.ClassifyFilename('update.gz'), '')
+
+  def testParseLogLine(self):
+    """Tests log lines are parsed for the offline analysis."""
+    self.assertEqual(
+        apache_log_metrics.ParseLogLine(STATIC_REQUEST_LINE),
+        ('30/Jun/2016:15:34:40 -0700', 'static:autotest_server_package.tar.bz2',
+         13805917, 200, '', False))
+    self.assertEqual(
+        apache_log_metrics.ParseLogLine(RPC_REQUEST_LINE[1]),
+        ('08/Sep/2019:07:14:38 -0700', 'update', 416, 200, '', True))
+    self.assertIsNone(apache_log_metrics.ParseLogLine('garbage'))
+
 
 class TestEmitters(unittest.TestCase):
   """Tests the emitter functions in apache_log_metrics."""
@@ -56,6 +112,18 @@ class TestEmitters(unittest.TestCase):
     with mock.patch.object(apache_log_metrics, 'metrics'):
       apache_log_metrics.EmitStaticRequestMetric(match)
 
+  def testEmitLogLineMetrics(self):
+    """Tests static GETs emit both metrics and other RPCs one."""
+    with mock.patch.object(apache_log_metrics, 'metrics') as metrics:
+      apache_log_metrics.RunMatchers(
+          six.StringIO('\n'.join((STATIC_REQUEST_LINE,) + RPC_REQUEST_LINE +
+                                  ('garbage',))),
+          apache_log_metrics.MATCHERS)
+    names = [c[1][0] for c in metrics.Counter.mock_calls if c[0] == '']
+    self.assertEqual(names.count(apache_log_metrics.STATIC_GET_METRIC_NAME), 1)
+    self.assertEqual(
+        names.count(apache_log_metrics.DEVSERVER_RPC_USAGE_METRIC_NAME), 3)
+
   def testEmitRpcUsageMetric(self):
     for line in RPC_REQUEST_LINE:
       match = apache_log_metrics.RPC_USAGE_MATCHER.match(line)
@@ -63,5 +131,66 @@ class TestEmitters(unittest.TestCase):
         apache_log_metrics.EmitRpcUsageMetric(match)
 
 
+class TestMetricAggregator(unittest.TestCase):
+  """Tests the MetricAggregator class."""
+
+  def setUp(self):
+    self.aggregator = apache_log_metrics.MetricAggregator(
+        flush_interval=60, flush_increments=3)
+    apache_log_metrics.SetAggregator(self.aggregator)
+
+  def tearDown(self):
+    apache_log_metrics.SetAggregator(None)
+
+  def testSums(self):
+    """Tests increments are summed per metric and fields."""
+    with mock.patch.object(apache_log_metrics, 'metrics') as metrics:
+      apache_log_metrics.RunMatchers(
+          six.StringIO('\n'.join((STATIC_REQUEST_LINE,) * 2 +
+                                  RPC_REQUEST_LINE)),
+          apache_log_metrics.MATCHERS)
+      metrics.Counter.assert_not_called()
+      self.aggregator.Flush()
+    counter = metrics.Counter.return_value
+    self.assertEqual(metrics.Counter.call_count, 2)
+    self.assertEqual(counter.increment_by.call_count, 4)
+    counter.increment_by.assert_any_call(
+        2 * 13805917, fields={'build_config': 'veyron_minnie-release',
+                              'milestone': 'R52',
+                              'in_lab': False,
+                              'endpoint': 'autotest_server_package.tar.bz2'})
+    counter.increment_by.assert_any_call(
+        2 * 13805917, fields={'http_method': 'GET',
+                              'rpc_name': 'static',
+                              'in_lab': False})
+
+  def testEarlyFlush(self):
+    """Tests a flush is requested once enough increments were added."""
+    for i in range(3):
+      self.assertFalse(self.aggregator._flush_requested.is_set())
+      self.aggregator.Add('metric', (('field', i),), 1)
+    self.assertTrue(self.aggregator._flush_requested.is_set())
+
+  def testBackoff(self):
+    """Tests the flush interval grows while ts_mon is slow."""
+    self.aggregator._clock = mock.Mock(side_effect=[0, 40, 0, 100, 0, 1])
+    self.aggregator.Add('metric', (), 1)
+    with mock.patch.object(apache_log_metrics, 'metrics'):
+      self.aggregator.Flush()
+      self.assertEqual(self.aggregator._interval, 120)
+      self.aggregator.Flush()
+      self.assertEqual(self.aggregator._interval, 240)
+      self.aggregator.Flush()
+      self.assertEqual(self.aggregator._interval, 60)
+
+  def testStop(self):
+    """Tests stopping the thread flushes the remaining increments."""
+    with mock.patch.object(apache_log_metrics, 'metrics') as metrics:
+      with self.aggregator:
+        self.aggregator.Add('metric', (('field', 'value'),), 5)
+    metrics.Counter.return_value.increment_by.assert_called_with(
+        5, fields={'field': 'value'})
+
+
 if __name__ == '__main__':
   unittest.main()
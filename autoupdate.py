@@ -22,6 +22,7 @@ try:
 except ImportError:
   import nebraska
 
+import resolution_cache
 import setup_chromite  # pylint: disable=unused-import
 from chromite.lib.xbuddy import cherrypy_log_util
 from chromite.lib.xbuddy import devserver_constants as constants
@@ -31,6 +32,15 @@ from chromite.lib.xbuddy import devserver_constants as constants
 def _Log(message, *args):
   return cherrypy_log_util.LogWithTag('UPDATE', message, *args)
 
+# Number of seconds the payload found for an alias label, e.g. eve/latest, is
+# cached for, unless something gets staged in the meantime. Cached payloads are
+# only used while they are still staged.
+PAYLOAD_CACHE_TTL = 60
+
+# Number of seconds a label no payload could be found for is cached for, unless
+# something gets staged in the meantime.
+PAYLOAD_NEGATIVE_TTL = 10
+
 class AutoupdateError(Exception):
   """Exception classes used by this module."""
   pass
@@ -60,15 +70,34 @@ def _NonePathJoin(*args):
 class Autoupdate(object):
   """Class that contains functionality that handles Chrome OS update pings."""
 
-  def __init__(self, xbuddy, static_dir=None):
+  def __init__(self, xbuddy, static_dir=None, payload_ttl=PAYLOAD_CACHE_TTL):
     """Initializes the class.
 
     Args:
       xbuddy: The xbuddy path.
       static_dir: The path to the devserver static directory.
+      payload_ttl: Number of seconds the payload found for a label is cached
+        for, 0 disables the caching.
     """
     self.xbuddy = xbuddy
     self.static_dir = static_dir
+    self._payload_ttl = payload_ttl
+    self._payload_cache = resolution_cache.ResolutionCache(
+        negative_ttl=min(PAYLOAD_NEGATIVE_TTL, payload_ttl))
+
+  @property
+  def payload_cache_stats(self):
+    """Get the statistics of the label to payload resolution cache."""
+    return self._payload_cache.GetStats()
+
+  def InvalidatePayloadCache(self):
+    """Forgets the payloads found for labels, and the labels without one.
+
+    To be called when builds are staged or evicted, as aliases such as
+    eve/latest may then resolve to another payload. Payloads which have been
+    evicted are also dropped from the cache when they are looked up.
+    """
+    self._payload_cache.Invalidate()
 
   def GetUpdateForLabel(self, label):
     """Given a label, get an update from the directory.
@@ -122,7 +151,10 @@ class Autoupdate(object):
   def GetPathToPayload(self, label, board):
     """Find a payload locally.
 
-    See devserver's update rpc for documentation.
+    See devserver's update rpc for documentation. Labels naming the directory
+    of a staged payload are returned as is. Other labels are resolved by
+    xBuddy: their resolutions are cached per (label, board) and concurrent
+    lookups of the same label are resolved once.
 
     Args:
       label: from update request
@@ -135,25 +167,37 @@ class Autoupdate(object):
       AutoupdateError: If the update could not be found.
     """
     label = label or ''
-    label_list = label.split('/')
     # Suppose that the path follows old protocol of indexing straight
     # into static_dir with board/version label.
     # Attempt to get the update in that directory, generating if necc.
     path_to_payload = self.GetUpdateForLabel(label)
+    if path_to_payload is not None:
+      return path_to_payload
+    return self._payload_cache.Get(
+        (label, board), lambda: self._ResolvePathToPayload(label, board),
+        ttl=self._payload_ttl, validate=self._IsPayloadStaged)
+
+  def _IsPayloadStaged(self, path_to_payload):
+    """Returns whether the update payload in |path_to_payload| still exists."""
+    return os.path.exists(_NonePathJoin(self.static_dir, path_to_payload,
+                                        constants.UPDATE_FILE))
+
+  def _ResolvePathToPayload(self, label, board):
+    """Finds a payload with xBuddy, see GetPathToPayload."""
+    label_list = label.split('/')
+    # There was no update found in the directory. Let XBuddy find the
+    # payloads.
+    if label_list[0] == 'xbuddy':
+      # If path explicitly calls xbuddy, pop off the tag.
+      label_list.pop()
+    x_label, _ = self.xbuddy.Translate(label_list, board=board)
+    # Path has been resolved, try to get the payload.
+    path_to_payload = self.GetUpdateForLabel(x_label)
     if path_to_payload is None:
-      # There was no update found in the directory. Let XBuddy find the
-      # payloads.
-      if label_list[0] == 'xbuddy':
-        # If path explicitly calls xbuddy, pop off the tag.
-        label_list.pop()
-      x_label, _ = self.xbuddy.Translate(label_list, board=board)
-      # Path has been resolved, try to get the payload.
-      path_to_payload = self.GetUpdateForLabel(x_label)
-      if path_to_payload is None:
-        # No update payload found after translation. Try to get an update to
-        # a test image from GS using the label.
-        path_to_payload, _image_name = self.xbuddy.Get(
-            ['remote', label, 'full_payload'])
+      # No update payload found after translation. Try to get an update to
+      # a test image from GS using the label.
+      path_to_payload, _image_name = self.xbuddy.Get(
+          ['remote', label, 'full_payload'])
 
     # One of the above options should have gotten us a relative path.
     if path_to_payload is None:
@@ -172,6 +216,13 @@ class Autoupdate(object):
     Returns:
       Update payload message for client.
     """
+    # Events are the bulk of the requests, acknowledge them without going
+    # through a full Request and Nebraska.
+    event_ack = nebraska.EventAck.GetResponse(data)
+    if event_ack is not None:
+      _Log('A non-update event notification received. Returning an ack.')
+      return event_ack
+
     # Get the static url base that will form that base of our update url e.g.
     # http://hostname:8080/static/update.gz.
     static_urlbase = self.GetStaticUrl()
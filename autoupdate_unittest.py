@@ -9,6 +9,7 @@
 from __future__ import print_function
 
 import json
+import os
 import shutil
 import socket
 import tempfile
@@ -111,5 +112,80 @@ class AutoupdateTest(unittest.TestCase):
 
     self.assertIn('error-unknownApplication', au_mock.HandleUpdatePing(request))
 
+  def _StagePayload(self, label):
+    payload_dir = os.path.join(self.static_image_dir, label)
+    common_util.MkDirP(payload_dir)
+    with open(os.path.join(payload_dir, 'update.gz'), 'w') as f:
+      f.write(self.payload)
+
+  def _AutoupdateWithMockXBuddy(self):
+    au_mock = autoupdate.Autoupdate(mock.Mock(),
+                                    static_dir=self.static_image_dir)
+    return au_mock, au_mock.xbuddy.Translate, au_mock.xbuddy.Get
+
+  def testGetPathToPayloadCached(self):
+    """Tests label resolutions are cached while the payload is staged."""
+    au_mock, translate_mock, get_mock = self._AutoupdateWithMockXBuddy()
+    translate_mock.return_value = ('eve-release/R80-1.0.0', None)
+    self._StagePayload('eve-release/R80-1.0.0')
+    for _ in range(3):
+      self.assertEqual(au_mock.GetPathToPayload('eve/latest', 'eve'),
+                       'eve-release/R80-1.0.0')
+    self.assertEqual(translate_mock.call_count, 1)
+    self.assertFalse(get_mock.called)
+
+    # The payload was evicted.
+    shutil.rmtree(os.path.join(self.static_image_dir, 'eve-release'))
+    translate_mock.return_value = ('eve-release/R81-1.0.0', None)
+    self._StagePayload('eve-release/R81-1.0.0')
+    self.assertEqual(au_mock.GetPathToPayload('eve/latest', 'eve'),
+                     'eve-release/R81-1.0.0')
+    self.assertEqual(translate_mock.call_count, 2)
+    self.assertEqual(au_mock.payload_cache_stats['invalid'], 1)
+
+  def testGetPathToPayloadNegative(self):
+    """Tests failures are cached until something is staged."""
+    au_mock, translate_mock, get_mock = self._AutoupdateWithMockXBuddy()
+    translate_mock.return_value = ('eve-release/R80-1.0.0', None)
+    get_mock.return_value = (None, None)
+    for _ in range(2):
+      with self.assertRaises(autoupdate.AutoupdateError):
+        au_mock.GetPathToPayload('eve/latest', 'eve')
+    self.assertEqual(get_mock.call_count, 1)
+
+    self._StagePayload('eve-release/R80-1.0.0')
+    au_mock.InvalidatePayloadCache()
+    self.assertEqual(au_mock.GetPathToPayload('eve/latest', 'eve'),
+                     'eve-release/R80-1.0.0')
+    self.assertEqual(get_mock.call_count, 1)
+
+  def testGetPathToPayloadInvalidated(self):
+    """Tests aliases are resolved again once something is staged."""
+    au_mock, translate_mock, _ = self._AutoupdateWithMockXBuddy()
+    translate_mock.return_value = ('eve-release/R80-1.0.0', None)
+    self._StagePayload('eve-release/R80-1.0.0')
+    self.assertEqual(au_mock.GetPathToPayload('eve/latest', 'eve'),
+                     'eve-release/R80-1.0.0')
+
+    # A newer build is staged, the old one is still there.
+    translate_mock.return_value = ('eve-release/R81-1.0.0', None)
+    self._StagePayload('eve-release/R81-1.0.0')
+    au_mock.InvalidatePayloadCache()
+    self.assertEqual(au_mock.GetPathToPayload('eve/latest', 'eve'),
+                     'eve-release/R81-1.0.0')
+    self.assertEqual(translate_mock.call_count, 2)
+
+  def testGetPathToPayloadStaged(self):
+    """Tests labels naming a staged payload are neither cached nor resolved."""
+    au_mock, translate_mock, _ = self._AutoupdateWithMockXBuddy()
+    self._StagePayload('eve-release/R80-1.0.0')
+    for _ in range(2):
+      self.assertEqual(
+          au_mock.GetPathToPayload('eve-release/R80-1.0.0', 'eve'),
+          'eve-release/R80-1.0.0')
+    self.assertFalse(translate_mock.called)
+    self.assertEqual(au_mock.payload_cache_stats['size'], 0)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Block maps and block deltas of staged partition images.
+
+quick-provision writes whole partition images to the DUT, even though the
+inactive partitions of a DUT usually hold a build very close to the one being
+provisioned. A block map describes an image as a list of fixed size chunks:
+  - the sha256 of every chunk, None for chunks which are all zeros,
+  - the extents of the runs of zero chunks.
+It is generated once, when the image is staged, and saved next to it.
+
+A client sends the hashes of the chunks it already has (see
+ComputeChunkHashes and FormatHashes) and gets back a block delta which only
+holds the non-zero chunks it does not have. ApplyBlockDelta writes them,
+checking each one against the block map, then zeroes the zero extents where
+the target is not already zero, so that unlike dd conv=sparse nothing is
+assumed about the previous content of the target.
+
+A block delta is a header, records and an end record:
+  header: magic (8 bytes), version, chunk size (uint32), image size (uint64)
+  record: offset (uint64), length (uint32), followed by length bytes of data
+  end record: the image size as offset and a zero length
+all integers big endian.
+"""
+
+from __future__ import print_function
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+
+import resolution_cache
+
+
+# The partition images quick-provision writes, block maps are generated for
+# them when they are staged.
+PARTITION_IMAGES = ('full_dev_part_KERN.bin.gz', 'full_dev_part_ROOT.bin.gz')
+
+# Suffix of the block map of an image, saved in the same directory.
+BLOCK_MAP_SUFFIX = '.blockmap.json'
+
+# Size of the chunks the images are split into.
+CHUNK_SIZE = 1024 * 1024
+
+BLOCK_MAP_VERSION = 1
+
+_DELTA_MAGIC = b'CrBlkDlt'
+_DELTA_VERSION = 1
+_DELTA_HEADER = struct.Struct('>8sIIQ')
+_DELTA_RECORD = struct.Struct('>QI')
+
+# Token standing for a zero (or unknown) chunk in formatted hash lists.
+_NO_HASH = '-'
+
+_HASH_SPLITTER = re.compile(r'[\s,]+')
+
+# Parsed block maps of the recently used images.
+_block_maps = resolution_cache.ResolutionCache(max_size=32)
+
+
+class BlockMapError(Exception):
+  """Exception class used by this module."""
+
+
+def _OpenImage(path):
+  """Opens the image at |path|, decompressing it if it is gzipped."""
+  if path.endswith('.gz'):
+    return gzip.open(path, 'rb')
+  return open(path, 'rb')
+
+
+def _ReadChunks(image, chunk_size):
+  """Yields the successive chunks of the file object |image|."""
+  while True:
+    chunk = image.read(chunk_size)
+    if not chunk:
+      return
+    yield chunk
+
+
+def _ReadChunkAt(image, index, chunk_size):
+  """Returns the chunk |index| of the seekable file object |image|."""
+  image.seek(index * chunk_size)
+  return image.read(chunk_size)
+
+
+def _IsZero(chunk):
+  """Returns whether the bytes of |chunk| are all zeros."""
+  return not chunk.strip(b'\0')
+
+
+def _ChunkHash(chunk):
+  """Returns the hash of |chunk| as found in block maps."""
+  if _IsZero(chunk):
+    return None
+  return hashlib.sha256(chunk).hexdigest()
+
+
+def ComputeChunkHashes(image, chunk_size=CHUNK_SIZE, size=None):
+  """Returns the hashes of the chunks of a file object.
+
+  Args:
+    image: File object opened for reading, e.g. a partition.
+    chunk_size: Size of the chunks.
+    size: Number of bytes to hash, everything up to EOF if None. Partitions
+      are usually larger than the images written to them.
+
+  Returns:
+    A list with the sha256 of every chunk, None for the zero chunks.
+  """
+  hashes = []
+  remaining = size
+  while remaining is None or remaining > 0:
+    chunk = image.read(chunk_size if remaining is None else
+                       min(chunk_size, remaining))
+    if not chunk:
+      break
+    hashes.append(_ChunkHash(chunk))
+    if remaining is not None:
+      remaining -= len(chunk)
+  return hashes
+
+
+def FormatHashes(hashes):
+  """Formats a list of chunk hashes as sent to the block_delta RPC."""
+  return ' '.join(h or _NO_HASH for h in hashes)
+
+
+def ParseHashes(text):
+  """Parses the output of FormatHashes, commas are accepted as separators."""
+  return [None if h == _NO_HASH else h.lower()
+          for h in _HASH_SPLITTER.split(text.strip()) if h]
+
+
+def GenerateBlockMap(image_path, chunk_size=CHUNK_SIZE):
+  """Returns the block map of the (possibly gzipped) image at |image_path|."""
+  hashes = []
+  zero_extents = []
+  whole = hashlib.sha256()
+  size = 0
+  with _OpenImage(image_path) as image:
+    for chunk in _ReadChunks(image, chunk_size):
+      whole.update(chunk)
+      chunk_hash = _ChunkHash(chunk)
+      if chunk_hash is None:
+        if zero_extents and sum(zero_extents[-1]) == size:
+          zero_extents[-1][1] += len(chunk)
+        else:
+          zero_extents.append([size, len(chunk)])
+      hashes.append(chunk_hash)
+      size += len(chunk)
+  return {
+      'version': BLOCK_MAP_VERSION,
+      'image': os.path.basename(image_path),
+      'size': size,
+      'chunk_size': chunk_size,
+      'sha256': whole.hexdigest(),
+      'hashes': hashes,
+      'zero_extents': zero_extents,
+  }
+
+
+def _WriteBlockMap(map_path, block_map):
+  """Atomically writes |block_map| to |map_path|."""
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(map_path),
+                                  prefix=os.path.basename(map_path))
+  try:
+    with os.fdopen(fd, 'w') as f:
+      json.dump(block_map, f, separators=(',', ':'))
+    os.rename(tmp_path, map_path)
+  except Exception:
+    os.unlink(tmp_path)
+    raise
+
+
+def _LoadOrGenerateBlockMap(image_path):
+  """Loads the saved block map of |image_path|, (re)generating it if stale."""
+  map_path = image_path + BLOCK_MAP_SUFFIX
+  try:
+    if os.stat(map_path).st_mtime >= os.stat(image_path).st_mtime:
+      with open(map_path) as f:
+        block_map = json.load(f)
+      if block_map.get('version') == BLOCK_MAP_VERSION:
+        return block_map
+  except (OSError, IOError, ValueError):
+    pass
+
+  block_map = GenerateBlockMap(image_path)
+  _WriteBlockMap(map_path, block_map)
+  return block_map
+
+
+def GetBlockMap(image_path):
+  """Returns the block map of a staged image, generating it if needed.
+
+  Concurrent callers share a single generation, and parsed block maps are
+  cached in memory until the image changes.
+
+  Raises:
+    BlockMapError: if the image does not exist.
+  """
+  try:
+    st = os.stat(image_path)
+  except OSError:
+    raise BlockMapError('%s is not staged' % image_path)
+  return _block_maps.Get((image_path, st.st_ino, st.st_size, st.st_mtime),
+                         lambda: _LoadOrGenerateBlockMap(image_path))
+
+
+def GenerateStagedBlockMaps(build_dir, names=PARTITION_IMAGES):
+  """Generates the missing block maps of the partition images of a build.
+
+  Args:
+    build_dir: The directory the build is staged in.
+    names: Names of the images to generate the block maps of.
+
+  Returns:
+    The list of the images found in |build_dir|.
+  """
+  images = [os.path.join(build_dir, name) for name in names]
+  images = [path for path in images if os.path.exists(path)]
+  for path in images:
+    GetBlockMap(path)
+  return images
+
+
+def DeltaChunks(block_map, client_hashes):
+  """Returns the indexes of the chunks a client needs.
+
+  Args:
+    block_map: The block map of the image.
+    client_hashes: The hashes of the chunks the client has, e.g. as computed
+      by ComputeChunkHashes on the partition it writes to.
+  """
+  return [i for i, chunk_hash in enumerate(block_map['hashes'])
+          if chunk_hash is not None and
+          (i >= len(client_hashes) or client_hashes[i] != chunk_hash)]
+
+
+def BlockDeltaSize(block_map, indexes):
+  """Returns the size of the block delta holding the chunks |indexes|."""
+  chunk_size = block_map['chunk_size']
+  size = _DELTA_HEADER.size + _DELTA_RECORD.size * (len(indexes) + 1)
+  for i in indexes:
+    size += min(chunk_size, block_map['size'] - i * chunk_size)
+  return size
+
+
+def IterBlockDelta(image_path, block_map, indexes):
+  """Yields the block delta holding the chunks |indexes| of an image.
+
+  Args:
+    image_path: Path to the (possibly gzipped) image.
+    block_map: The block map of the image.
+    indexes: Sorted indexes of the chunks to send, see DeltaChunks.
+  """
+  chunk_size = block_map['chunk_size']
+  yield _DELTA_HEADER.pack(_DELTA_MAGIC, _DELTA_VERSION, chunk_size,
+                           block_map['size'])
+  with _OpenImage(image_path) as image:
+    if image_path.endswith('.gz'):
+      # Gzipped images can't be seeked, read them once from start to end.
+      wanted = set(indexes)
+      chunks = ((i, chunk) for i, chunk in
+                enumerate(_ReadChunks(image, chunk_size)) if i in wanted)
+    else:
+      chunks = ((i, _ReadChunkAt(image, i, chunk_size)) for i in indexes)
+    for i, chunk in chunks:
+      yield _DELTA_RECORD.pack(i * chunk_size, len(chunk))
+      yield chunk
+  yield _DELTA_RECORD.pack(block_map['size'], 0)
+
+
+def _ReadExactly(f, size):
+  """Reads |size| bytes from |f|.
+
+  Raises:
+    BlockMapError: if the file is truncated.
+  """
+  data = f.read(size)
+  if len(data) != size:
+    raise BlockMapError('Truncated block delta')
+  return data
+
+
+def ApplyBlockDelta(delta, target, block_map):
+  """Applies a block delta to a target, e.g. a partition.
+
+  Every chunk is checked against the block map before being written. Zero
+  extents of the image are then checked on the target, and only the chunks
+  which are not already zero are overwritten.
+
+  Args:
+    delta: File object the block delta is read from.
+    target: File object opened for reading and writing, at least as large as
+      the image.
+    block_map: The block map of the image.
+
+  Returns:
+    A dict with the number of chunks written from the delta and the number of
+    chunks zeroed.
+
+  Raises:
+    BlockMapError: if the delta is invalid or does not match the block map.
+  """
+  chunk_size = block_map['chunk_size']
+  magic, version, delta_chunk_size, size = _DELTA_HEADER.unpack(
+      _ReadExactly(delta, _DELTA_HEADER.size))
+  if magic != _DELTA_MAGIC or version != _DELTA_VERSION:
+    raise BlockMapError('Not a block delta')
+  if delta_chunk_size != chunk_size or size != block_map['size']:
+    raise BlockMapError('The block delta is not for this block map')
+
+  stats = {'written_chunks': 0, 'zeroed_chunks': 0}
+  while True:
+    offset, length = _DELTA_RECORD.unpack(
+        _ReadExactly(delta, _DELTA_RECORD.size))
+    if not length:
+      if offset != size:
+        raise BlockMapError('Invalid end of block delta')
+      break
+    chunk = _ReadExactly(delta, length)
+    index, misaligned = divmod(offset, chunk_size)
+    if (misaligned or index >= len(block_map['hashes']) or
+        block_map['hashes'][index] != _ChunkHash(chunk)):
+      raise BlockMapError('Chunk at offset %d does not match the block map' %
+                          offset)
+    target.seek(offset)
+    target.write(chunk)
+    stats['written_chunks'] += 1
+
+  for start, length in block_map['zero_extents']:
+    for offset in range(start, start + length, chunk_size):
+      chunk_length = min(chunk_size, start + length - offset)
+      target.seek(offset)
+      if not _IsZero(target.read(chunk_length)):
+        target.seek(offset)
+        target.write(b'\0' * chunk_length)
+        stats['zeroed_chunks'] += 1
+  target.flush()
+  return stats
@@ -0,0 +1,151 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for block_map.py."""
+
+from __future__ import print_function
+
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import block_map
+
+
+_CHUNK_SIZE = 4096
+
+
+def _RandomBytes(rng, size):
+  return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+
+class BlockMapTest(unittest.TestCase):
+  """Tests generating and applying block deltas of generated images."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='block_map')
+    rng = random.Random(42)
+    # 16 chunks and a partial one: data, a zero run, data, a zero chunk.
+    self.image = (_RandomBytes(rng, 5 * _CHUNK_SIZE) +
+                  b'\0' * (4 * _CHUNK_SIZE) +
+                  _RandomBytes(rng, 6 * _CHUNK_SIZE) +
+                  b'\0' * _CHUNK_SIZE + _RandomBytes(rng, 100))
+    self.image_path = os.path.join(self.tempdir, 'full_dev_part_ROOT.bin.gz')
+    with gzip.open(self.image_path, 'wb') as f:
+      f.write(self.image)
+    self.raw_path = os.path.join(self.tempdir, 'part.bin')
+    with open(self.raw_path, 'wb') as f:
+      f.write(self.image)
+
+    # The previous build: a few chunks differ, one of the zero chunks is not
+    # zero any more.
+    old = bytearray(self.image)
+    for offset in (0, 3 * _CHUNK_SIZE + 7, 6 * _CHUNK_SIZE,
+                   12 * _CHUNK_SIZE + 1, 16 * _CHUNK_SIZE + 50):
+      old[offset] ^= 0xff
+    self.old = bytes(old)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _Delta(self, image_path, image_map, client_hashes):
+    indexes = block_map.DeltaChunks(image_map, client_hashes)
+    delta = b''.join(block_map.IterBlockDelta(image_path, image_map, indexes))
+    self.assertEqual(len(delta), block_map.BlockDeltaSize(image_map, indexes))
+    return indexes, delta
+
+  def testGenerateBlockMap(self):
+    """Tests chunk hashes and zero extents."""
+    image_map = block_map.GenerateBlockMap(self.image_path, _CHUNK_SIZE)
+    self.assertEqual(image_map['size'], len(self.image))
+    self.assertEqual(image_map['image'], 'full_dev_part_ROOT.bin.gz')
+    self.assertEqual(len(image_map['hashes']), 17)
+    self.assertEqual([i for i, h in enumerate(image_map['hashes'])
+                      if h is None], [5, 6, 7, 8, 15])
+    self.assertEqual(image_map['zero_extents'],
+                     [[5 * _CHUNK_SIZE, 4 * _CHUNK_SIZE],
+                      [15 * _CHUNK_SIZE, _CHUNK_SIZE]])
+    self.assertEqual(image_map['hashes'],
+                     block_map.ComputeChunkHashes(io.BytesIO(self.image),
+                                                  _CHUNK_SIZE))
+    self.assertEqual(
+        block_map.GenerateBlockMap(self.raw_path, _CHUNK_SIZE)['sha256'],
+        image_map['sha256'])
+
+  def testHashesFormat(self):
+    """Tests hash lists survive being sent to the RPC."""
+    hashes = block_map.GenerateBlockMap(self.image_path, _CHUNK_SIZE)['hashes']
+    text = block_map.FormatHashes(hashes)
+    self.assertEqual(block_map.ParseHashes(text), hashes)
+    self.assertEqual(block_map.ParseHashes(text.replace(' ', ',\n')), hashes)
+    self.assertEqual(block_map.ParseHashes(''), [])
+
+  def testApplyDelta(self):
+    """Tests a near identical partition gets only the changed chunks."""
+    for image_path in (self.image_path, self.raw_path):
+      image_map = block_map.GenerateBlockMap(image_path, _CHUNK_SIZE)
+      # The partition is larger than the image.
+      target = io.BytesIO(self.old + b'\xaa' * _CHUNK_SIZE)
+      client_hashes = block_map.ComputeChunkHashes(target, _CHUNK_SIZE,
+                                                   size=image_map['size'])
+      indexes, delta = self._Delta(image_path, image_map, client_hashes)
+      self.assertEqual(indexes, [0, 3, 12, 16])
+
+      stats = block_map.ApplyBlockDelta(io.BytesIO(delta), target, image_map)
+      self.assertEqual(stats, {'written_chunks': 4, 'zeroed_chunks': 1})
+      self.assertEqual(target.getvalue(),
+                       self.image + b'\xaa' * _CHUNK_SIZE)
+
+  def testApplyFullDelta(self):
+    """Tests a client without hashes gets all the non-zero chunks."""
+    image_map = block_map.GenerateBlockMap(self.image_path, _CHUNK_SIZE)
+    indexes, delta = self._Delta(self.image_path, image_map, [])
+    self.assertEqual(len(indexes), 12)
+    target = io.BytesIO(b'\xff' * len(self.image))
+    stats = block_map.ApplyBlockDelta(io.BytesIO(delta), target, image_map)
+    self.assertEqual(stats, {'written_chunks': 12, 'zeroed_chunks': 5})
+    self.assertEqual(target.getvalue(), self.image)
+
+  def testInvalidDelta(self):
+    """Tests corrupted, truncated or mismatched deltas are rejected."""
+    image_map = block_map.GenerateBlockMap(self.image_path, _CHUNK_SIZE)
+    _, delta = self._Delta(self.image_path, image_map, [])
+    corrupted = bytearray(delta)
+    corrupted[100] ^= 1
+    other_map = dict(image_map, size=image_map['size'] + 1)
+    for bad_delta, bad_map in ((bytes(corrupted), image_map),
+                               (delta[:-1], image_map),
+                               (b'garbage' * 10, image_map),
+                               (delta, other_map)):
+      with self.assertRaises(block_map.BlockMapError):
+        block_map.ApplyBlockDelta(io.BytesIO(bad_delta),
+                                  io.BytesIO(self.old), bad_map)
+
+  def testGetBlockMap(self):
+    """Tests block maps are saved next to the image and reused."""
+    image_map = block_map.GetBlockMap(self.image_path)
+    map_path = self.image_path + block_map.BLOCK_MAP_SUFFIX
+    with open(map_path) as f:
+      self.assertEqual(json.load(f), image_map)
+    self.assertIs(block_map.GetBlockMap(self.image_path), image_map)
+
+    self.assertEqual(
+        block_map.GenerateStagedBlockMaps(self.tempdir),
+        [self.image_path])
+    self.assertEqual(sorted(os.listdir(self.tempdir)),
+                     sorted(['full_dev_part_ROOT.bin.gz', 'part.bin',
+                             os.path.basename(map_path)]))
+    with self.assertRaises(block_map.BlockMapError):
+      block_map.GetBlockMap(os.path.join(self.tempdir, 'missing.bin.gz'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,13 +7,22 @@
 
 from __future__ import print_function
 
+import fnmatch
+import hashlib
+import json
+import multiprocessing
 import os
+import re
 import subprocess
+import tarfile
 import tempfile
 
+from concurrent import futures
+
 import portage  # pylint: disable=import-error
 import cherrypy  # pylint: disable=import-error
 
+import resolution_cache
 import setup_chromite  # pylint: disable=unused-import
 from chromite.lib.xbuddy import cherrypy_log_util
 
@@ -21,6 +30,23 @@ from chromite.lib.xbuddy import cherrypy_log_util
 # Relative path to the wrapper directory inside the sysroot.
 _SYSROOT_BUILD_BIN = 'build/bin'
 
+# Size of the reads from the decompressor pipe.
+_PIPE_CHUNK_SIZE = 1024 * 1024
+
+# Name of the manifest of the filtered packages in the gmerge binhost.
+_GMERGE_MANIFEST = '.gmerge-manifest.json'
+
+# Files, relative to the sysroot, rewritten by cros_workon start and stop.
+_WORKON_STATE_FILES = (
+    'etc/portage/package.keywords/cros-workon',
+    'etc/portage/package.mask/cros-workon',
+    'etc/portage/package.unmask/cros-workon',
+)
+
+# Number of seconds the list of all the cros_workon packages is cached for,
+# it only changes when ebuilds are added to or removed from the overlays.
+_WORKON_ALL_TTL = 600
+
 
 def _SysrootCmd(sysroot, cmd):
   """Path to the sysroot wrapper for |cmd|.
@@ -102,10 +128,199 @@ def _FilterInstallMaskFromPackage(in_path, out_path):
   portage.xpak.tbz2(out_path).recompose_mem(my_xpak)
 
 
-def UpdateGmergeBinhost(sysroot, pkgs, deep):
+def _InstallMaskMatchers():
+  """Returns regexes matching the archive names excluded by the install mask.
+
+  The names are anchored and relative to './' like the tar --exclude patterns
+  built by _FilterInstallMaskFromPackage; wildcards also match '/'.
+  """
+  masks = os.environ.get('DEFAULT_INSTALL_MASK', '').split()
+  return [re.compile(fnmatch.translate('./' + mask.strip('/')))
+          for mask in masks]
+
+
+def _IsMasked(name, matchers):
+  """Whether the archive member |name| is excluded by the install mask.
+
+  Like tar --exclude, a member is excluded when its name or the name of one
+  of its parent directories matches.
+  """
+  name = name.rstrip('/')
+  prefixes = [name] + [name[:i] for i, c in enumerate(name)
+                       if c == '/' and i > 0]
+  return any(m.match(prefix) for m in matchers for prefix in prefixes)
+
+
+def _FilterTarStream(in_file, out_file, matchers):
+  """Copies a tar stream, dropping the members excluded by |matchers|.
+
+  Both streams are read or written sequentially, in one pass, without
+  extracting anything to disk. Members are written as they were read, with
+  their owners, modes, times and extended headers, in the PAX format.
+
+  Args:
+    in_file: File object to read the tar stream from.
+    out_file: File object to write the filtered tar stream to.
+    matchers: Regexes returned by _InstallMaskMatchers.
+  """
+  masked_files = set()
+  in_tar = tarfile.open(fileobj=in_file, mode='r|')
+  out_tar = tarfile.open(fileobj=out_file, mode='w|',
+                         format=tarfile.PAX_FORMAT)
+  try:
+    for member in in_tar:
+      # Hard links to excluded files cannot be created either.
+      if (_IsMasked(member.name, matchers) or
+          (member.islnk() and member.linkname in masked_files)):
+        masked_files.add(member.name)
+        continue
+      if member.isreg():
+        out_tar.addfile(member, in_tar.extractfile(member))
+      else:
+        out_tar.addfile(member)
+  finally:
+    out_tar.close()
+    in_tar.close()
+
+
+def _FilterInstallMaskFromPackageStream(in_path, out_path, threads=None):
+  """Filter files matching DEFAULT_INSTALL_MASK out of a tarball.
+
+  This produces the same package as _FilterInstallMaskFromPackage, but the
+  tar stream is filtered on its way from the decompressor to the compressor:
+  nothing is extracted to disk, and no root permission is needed.
+
+  Args:
+    in_path: Unfiltered tarball.
+    out_path: Location to write filtered tarball.
+    threads: Number of threads of the decompressor and of the compressor,
+      defaults to the number of CPUs.
+  """
+  # Grab metadata about package in xpak format.
+  my_xpak = portage.xpak.xpak_mem(portage.xpak.tbz2(in_path).get_data())
+
+  gmerge_dir = os.path.dirname(out_path)
+  if not os.path.isdir(gmerge_dir):
+    os.makedirs(gmerge_dir)
+
+  decompress_cmd = ['pbzip2', '-dc', '--ignore-trailing-garbage=1', in_path]
+  compress_cmd = ['pbzip2', '-c']
+  if threads:
+    decompress_cmd.insert(1, '-p%d' % threads)
+    compress_cmd.insert(1, '-p%d' % threads)
+  try:
+    with open(out_path, 'wb') as out_file:
+      decompress = subprocess.Popen(decompress_cmd, stdout=subprocess.PIPE)
+      compress = subprocess.Popen(compress_cmd, stdin=subprocess.PIPE,
+                                  stdout=out_file)
+      try:
+        _FilterTarStream(decompress.stdout, compress.stdin,
+                         _InstallMaskMatchers())
+        # Drain the end of archive padding.
+        while decompress.stdout.read(_PIPE_CHUNK_SIZE):
+          pass
+      finally:
+        compress.stdin.close()
+        decompress.stdout.close()
+        compress.wait()
+        decompress.wait()
+    for proc, cmd in ((decompress, decompress_cmd),
+                      (compress, compress_cmd)):
+      if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+  except Exception:
+    if os.path.exists(out_path):
+      os.unlink(out_path)
+    raise
+
+  # Copy package metadata over to new package file.
+  portage.xpak.tbz2(out_path).recompose_mem(my_xpak)
+
+
+def _InstallMaskHash():
+  """Returns a hash of DEFAULT_INSTALL_MASK, to detect changes of the mask."""
+  masks = sorted(os.environ.get('DEFAULT_INSTALL_MASK', '').split())
+  return hashlib.sha1(' '.join(masks).encode('utf-8')).hexdigest()
+
+
+def _LoadManifest(path):
+  """Loads the gmerge binhost manifest, {cpv: [BUILD_TIME, mask hash]}."""
+  try:
+    with open(path) as f:
+      manifest = json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+  return manifest if isinstance(manifest, dict) else {}
+
+
+def _SaveManifest(path, manifest):
+  """Atomically replaces the gmerge binhost manifest."""
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                  prefix=os.path.basename(path))
+  try:
+    with os.fdopen(fd, 'w') as f:
+      json.dump(manifest, f, sort_keys=True)
+    os.rename(tmp_path, path)
+  except Exception:
+    os.unlink(tmp_path)
+    raise
+
+
+def _FilterPackages(packages, jobs):
+  """Filters the install mask out of packages concurrently.
+
+  The |jobs| CPUs are split between the packages filtered at the same time:
+  each of them runs pbzip2 with its share of the CPUs, so that the machine
+  is not oversubscribed by |jobs| pbzip2 running |jobs| threads each.
+
+  Args:
+    packages: A list of (cpv, build_path, gmerge_path) tuples.
+    jobs: Number of CPUs used to filter the packages, at most one package
+      being filtered per CPU.
+
+  Returns:
+    A tuple of the list of cpvs which were filtered successfully, and of the
+    first exception raised filtering a package, or None.
+  """
+  filtered = []
+  error = None
+  workers = max(1, min(jobs, len(packages)))
+  threads = max(1, jobs // workers)
+  with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    tasks = {}
+    for pkg, build_path, gmerge_path in packages:
+      _Log('Filtering install mask from %s' % pkg)
+      tasks[executor.submit(_FilterInstallMaskFromPackageStream, build_path,
+                            gmerge_path, threads)] = pkg
+    for task in futures.as_completed(tasks):
+      try:
+        task.result()
+        filtered.append(tasks[task])
+      except Exception as e:  # pylint: disable=broad-except
+        _Log('Failed to filter %s: %s' % (tasks[task], e))
+        error = error or e
+  return filtered, error
+
+
+def UpdateGmergeBinhost(sysroot, pkgs, deep, jobs=None):
   """Add packages to our gmerge-specific binhost.
 
   Files matching DEFAULT_INSTALL_MASK are not included in the tarball.
+
+  The BUILD_TIME and install mask of each filtered package are kept in a
+  manifest in the gmerge binhost, so that packages which did not change are
+  skipped without reading their metadata. Rebuilt packages are filtered
+  concurrently, and the Packages file is regenerated once at the end.
+
+  Args:
+    sysroot: Path to the sysroot.
+    pkgs: Packages to add, unless |deep| is set.
+    deep: Whether to add all the installed packages of the sysroot.
+    jobs: Number of CPUs used to filter the packages, see _FilterPackages.
+      Defaults to the number of CPUs.
+
+  Returns:
+    Whether any of the packages is installed.
   """
   # Portage internal api expects the sysroot to ends with a '/'.
   sysroot = os.path.join(sysroot, '')
@@ -158,31 +373,55 @@ def UpdateGmergeBinhost(sysroot, pkgs, deep):
   if bindb_matches - installed_matches:
     subprocess.check_call([_SysrootCmd(sysroot, 'eclean'), '-d', 'packages'])
 
+  manifest_path = os.path.join(gmerge_pkgdir, _GMERGE_MANIFEST)
+  manifest = _LoadManifest(manifest_path)
+  old_manifest = dict(manifest)
+  mask_hash = _InstallMaskHash()
+
   # Remove any stale packages that exist in the gmerge binhost but are not
   # installed anymore.
   changed = False
   for pkg in gmerge_matches - installed_matches:
     gmerge_path = gmerge_tree.getname(pkg)
+    manifest.pop(pkg, None)
     if os.path.exists(gmerge_path):
       os.unlink(gmerge_path)
       changed = True
 
   # Copy any installed packages that have been rebuilt to the gmerge binhost.
+  to_filter = []
+  build_times = {}
   for pkg in installed_matches:
     build_time, = bintree.dbapi.aux_get(pkg, ['BUILD_TIME'])
     build_path = bintree.getname(pkg)
     gmerge_path = gmerge_tree.getname(pkg)
 
-    # If a package exists in the gmerge binhost with the same build time,
-    # don't rebuild it.
+    # If a package exists in the gmerge binhost with the same build time and
+    # install mask, don't rebuild it.
     if pkg in gmerge_matches and os.path.exists(gmerge_path):
-      old_build_time, = gmerge_tree.dbapi.aux_get(pkg, ['BUILD_TIME'])
-      if old_build_time == build_time:
-        continue
-
-    _Log('Filtering install mask from %s' % pkg)
-    _FilterInstallMaskFromPackage(build_path, gmerge_path)
+      if pkg in manifest:
+        if manifest[pkg] == [build_time, mask_hash]:
+          continue
+      else:
+        # The package was filtered before the manifest existed.
+        old_build_time, = gmerge_tree.dbapi.aux_get(pkg, ['BUILD_TIME'])
+        if old_build_time == build_time:
+          manifest[pkg] = [build_time, mask_hash]
+          continue
+
+    manifest.pop(pkg, None)
+    to_filter.append((pkg, build_path, gmerge_path))
+    build_times[pkg] = build_time
+
+  error = None
+  if to_filter:
     changed = True
+    filtered, error = _FilterPackages(to_filter,
+                                      jobs or multiprocessing.cpu_count())
+    for pkg in filtered:
+      manifest[pkg] = [build_times[pkg], mask_hash]
+  if manifest != old_manifest:
+    _SaveManifest(manifest_path, manifest)
 
   # If the gmerge binhost was changed, update the Packages file to match.
   if changed:
@@ -191,20 +430,60 @@ def UpdateGmergeBinhost(sysroot, pkgs, deep):
     cmd = [_SysrootCmd(sysroot, 'emaint'), '-f', 'binhost']
     subprocess.check_call(cmd, env=env_copy)
 
+  if error:
+    raise error  # pylint: disable=raising-bad-type
+
   return bool(installed_matches)
 
 
 class Builder(object):
   """Builds packages for the devserver."""
 
+  def __init__(self):
+    self._workon_cache = resolution_cache.ResolutionCache(max_size=64)
+
+  @staticmethod
+  def _WorkonState(board):
+    """Returns a key changing whenever cros_workon starts or stops a package."""
+    sysroot = '/build/%s/' % board
+    state = []
+    for path in _WORKON_STATE_FILES:
+      try:
+        st = os.stat(os.path.join(sysroot, path))
+      except OSError:
+        state.append(None)
+      else:
+        state.append((st.st_ino, st.st_size, st.st_mtime))
+    return tuple(state)
+
+  @staticmethod
+  def _WorkonPackages(args):
+    """Runs cros_workon |args| and returns the set of packages it lists.
+
+    Every package is in the set both as category/name and as name, gmerge
+    accepts both.
+    """
+    packages = set()
+    for line in _OutputOf(['cros_workon'] + args).decode('utf-8').splitlines():
+      atom = line.strip()
+      if atom:
+        packages.add(atom)
+        packages.add(atom.rpartition('/')[2])
+    return packages
+
   def _ShouldBeWorkedOn(self, board, pkg):
     """Is pkg a package that could be worked on, but is not?"""
-    if pkg in _OutputOf(['cros_workon', '--board=' + board, 'list']):
+    worked_on = self._workon_cache.Get(
+        ('list', board, self._WorkonState(board)),
+        lambda: self._WorkonPackages(['--board=' + board, 'list']))
+    if pkg in worked_on:
       return False
 
     # If it's in the list of possible workon targets, we should be working on it
-    return pkg in _OutputOf([
-        'cros_workon', '--board=' + board, '--all', 'list'])
+    return pkg in self._workon_cache.Get(
+        ('all', board),
+        lambda: self._WorkonPackages(['--board=' + board, '--all', 'list']),
+        ttl=_WORKON_ALL_TTL)
 
   def SetError(self, text):
     cherrypy.response.status = 500
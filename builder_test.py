@@ -8,11 +8,72 @@
 
 from __future__ import print_function
 
+import hashlib
+import io
+import os
+import shutil
 import subprocess
+import tarfile
+import tempfile
 import unittest
 
+import mock
+
 import builder
 
+
+_INSTALL_MASK = '/usr/include /usr/share/doc/* *.la /usr/lib/debug/'
+
+
+def _HaveCommands(*commands):
+  """Whether all the commands can be run, sudo without a password."""
+  for command in commands:
+    if not any(os.access(os.path.join(d, command), os.X_OK)
+               for d in os.environ.get('PATH', '').split(os.pathsep)):
+      return False
+  return 'sudo' not in commands or subprocess.call(
+      ['sudo', '-n', 'true'], stderr=subprocess.PIPE) == 0
+
+
+def _MakePackageTar(fileobj, compression=''):
+  """Writes a tar stream laid out like a binary package to |fileobj|."""
+  tar = tarfile.open(fileobj=fileobj, mode='w|' + compression,
+                     format=tarfile.GNU_FORMAT)
+  def _Add(name, kind=tarfile.DIRTYPE, data=b'', mode=0o755, linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = kind
+    info.mode = mode
+    info.mtime = 1234567890
+    info.linkname = linkname
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data) if data else None)
+  for d in ('.', './usr', './usr/bin', './usr/include', './usr/include/sub',
+            './usr/lib', './usr/lib/debug', './usr/share', './usr/share/doc',
+            './usr/share/doc/pkg', './usr/share/docs'):
+    _Add(d)
+  _Add('./usr/bin/tool', tarfile.REGTYPE, b'#!/bin/sh\n' * 1000)
+  _Add('./usr/include/tool.h', tarfile.REGTYPE, b'int x;', 0o644)
+  _Add('./usr/include/sub/more.h', tarfile.REGTYPE, b'int y;', 0o644)
+  _Add('./usr/lib/libtool.so.1', tarfile.REGTYPE, os.urandom(100000))
+  _Add('./usr/lib/libtool.so', tarfile.SYMTYPE, linkname='libtool.so.1')
+  _Add('./usr/lib/libtool.la', tarfile.REGTYPE, b'# libtool', 0o644)
+  _Add('./usr/lib/debug/libtool.so.1.debug', tarfile.REGTYPE, b'debug')
+  _Add('./usr/share/doc/pkg/README', tarfile.REGTYPE, b'readme', 0o644)
+  _Add('./usr/share/docs/kept', tarfile.REGTYPE, b'kept', 0o644)
+  _Add('./usr/bin/tool-link', tarfile.LNKTYPE, linkname='./usr/bin/tool')
+  tar.close()
+
+
+def _Members(tar):
+  """Returns the comparable attributes of the members of |tar|."""
+  members = {}
+  for member in tar:
+    data = tar.extractfile(member).read() if member.isreg() else b''
+    members[member.name.rstrip('/')] = (
+        member.type, member.mode, member.linkname,
+        hashlib.sha1(data).hexdigest())
+  return members
+
 # pylint: disable=protected-access
 
 class BuilderTest(unittest.TestCase):
@@ -25,6 +86,178 @@ class BuilderTest(unittest.TestCase):
     self.assertEqual(hello + '\n',
                      builder._OutputOf(['/bin/echo', hello]))
 
+  def testManifest(self):
+    """Tests the gmerge binhost manifest is saved and loaded."""
+    tempdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tempdir, builder._GMERGE_MANIFEST)
+      self.assertEqual(builder._LoadManifest(path), {})
+      manifest = {'chromeos-base/foo-1': ['1234', builder._InstallMaskHash()]}
+      builder._SaveManifest(path, manifest)
+      self.assertEqual(builder._LoadManifest(path), manifest)
+      self.assertEqual(os.listdir(tempdir), [builder._GMERGE_MANIFEST])
+    finally:
+      shutil.rmtree(tempdir)
+
+  def testInstallMaskHash(self):
+    """Tests the install mask hash only depends on the set of masks."""
+    with mock.patch.dict(os.environ, {'DEFAULT_INSTALL_MASK': '/a /b'}):
+      mask_hash = builder._InstallMaskHash()
+    with mock.patch.dict(os.environ, {'DEFAULT_INSTALL_MASK': ' /b\n/a'}):
+      self.assertEqual(builder._InstallMaskHash(), mask_hash)
+    with mock.patch.dict(os.environ, {'DEFAULT_INSTALL_MASK': '/a'}):
+      self.assertNotEqual(builder._InstallMaskHash(), mask_hash)
+
+  def testFilterPackages(self):
+    """Tests packages are all filtered even if one fails."""
+    error = OSError('pbzip2 failed')
+    def _Filter(build_path, _gmerge_path, _threads):
+      if build_path == 'bad':
+        raise error
+    with mock.patch.object(builder, '_FilterInstallMaskFromPackageStream',
+                           side_effect=_Filter):
+      filtered, first_error = builder._FilterPackages(
+          [('a', 'good', 'out_a'), ('b', 'bad', 'out_b'),
+           ('c', 'good', 'out_c')], 2)
+    self.assertEqual(sorted(filtered), ['a', 'c'])
+    self.assertIs(first_error, error)
+
+  def testFilterPackagesSplitsCpus(self):
+    """Tests the CPUs are split between the packages filtered at once."""
+    for packages, jobs, threads in ((1, 8, 8), (2, 8, 4), (3, 8, 2),
+                                    (16, 8, 1), (4, 2, 1)):
+      with mock.patch.object(builder,
+                             '_FilterInstallMaskFromPackageStream') as f:
+        builder._FilterPackages(
+            [('p%d' % i, 'in', 'out') for i in range(packages)], jobs)
+      self.assertEqual(set(c[0][2] for c in f.call_args_list), set([threads]),
+                       (packages, jobs))
+
+  def testShouldBeWorkedOn(self):
+    """Tests the workon lists are cached until cros_workon changes them."""
+    outputs = {
+        'list': b'chromeos-base/libbrillo\n',
+        'all': b'chromeos-base/libbrillo\nchromeos-base/update_engine\n',
+    }
+    def _Output(command):
+      return outputs['all' if '--all' in command else 'list']
+    state = [(1, 10, 1000.0), None, None]
+    b = builder.Builder()
+    with mock.patch.object(builder, '_OutputOf',
+                           side_effect=_Output) as output_of, \
+         mock.patch.object(builder.Builder, '_WorkonState',
+                           side_effect=lambda _board: tuple(state)):
+      self.assertFalse(b._ShouldBeWorkedOn('eve', 'libbrillo'))
+      self.assertTrue(b._ShouldBeWorkedOn('eve', 'update_engine'))
+      self.assertTrue(b._ShouldBeWorkedOn(
+          'eve', 'chromeos-base/update_engine'))
+      # No more substring matches.
+      self.assertFalse(b._ShouldBeWorkedOn('eve', 'update'))
+      self.assertEqual(output_of.call_count, 2)
+
+      outputs['list'] += b'chromeos-base/update_engine\n'
+      state[0] = (1, 40, 1001.0)
+      self.assertFalse(b._ShouldBeWorkedOn('eve', 'update_engine'))
+      self.assertEqual(output_of.call_count, 3)
+
+      # Boards are cached separately.
+      self.assertFalse(b._ShouldBeWorkedOn('kevin', 'shill'))
+      self.assertEqual(output_of.call_count, 5)
+
+
+@mock.patch.dict(os.environ, {'DEFAULT_INSTALL_MASK': _INSTALL_MASK})
+class StreamingFilterTest(unittest.TestCase):
+  """Tests the streaming install mask filter against tar."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    subprocess.call(['rm', '-rf', self.tempdir])
+
+  def testIsMasked(self):
+    """Tests masks are anchored and also exclude directory contents."""
+    matchers = builder._InstallMaskMatchers()
+    for name in ('./usr/include', './usr/include/a/b.h', './usr/lib/x.la',
+                 './usr/share/doc/pkg/README', './usr/lib/debug/'):
+      self.assertTrue(builder._IsMasked(name, matchers), name)
+    for name in ('.', './usr', './opt/usr/include', './usr/share/doc',
+                 './usr/share/docs/x', './usr/lib/x.lab'):
+      self.assertFalse(builder._IsMasked(name, matchers), name)
+
+  def testFilterTarStreamMatchesTar(self):
+    """Tests the same members as with tar --exclude are kept."""
+    tar_path = os.path.join(self.tempdir, 'package.tar')
+    with open(tar_path, 'wb') as f:
+      _MakePackageTar(f)
+
+    excludes = ['--exclude=./%s' % mask.strip('/')
+                for mask in _INSTALL_MASK.split()]
+    listed = subprocess.check_output(
+        ['tar', '-t', '-f', tar_path, '--anchored'] + excludes +
+        ['--wildcards']).decode('utf-8').split()
+    expected = set(name.rstrip('/') for name in listed)
+
+    out = io.BytesIO()
+    with open(tar_path, 'rb') as f:
+      builder._FilterTarStream(f, out, builder._InstallMaskMatchers())
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode='r|') as tar:
+      filtered = _Members(tar)
+    with tarfile.open(tar_path) as tar:
+      original = _Members(tar)
+
+    self.assertEqual(set(filtered), expected)
+    self.assertIn('./usr/share/docs/kept', filtered)
+    for name, attributes in filtered.items():
+      self.assertEqual(attributes, original[name], name)
+
+  def testMaskedHardLink(self):
+    """Tests hard links to excluded files are excluded too."""
+    in_tar = io.BytesIO()
+    _MakePackageTar(in_tar)
+    in_tar.seek(0)
+    out = io.BytesIO()
+    with mock.patch.dict(os.environ, {'DEFAULT_INSTALL_MASK': '/usr/bin/tool'}):
+      builder._FilterTarStream(in_tar, out, builder._InstallMaskMatchers())
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode='r|') as tar:
+      names = [m.name for m in tar]
+    self.assertNotIn('./usr/bin/tool', names)
+    self.assertNotIn('./usr/bin/tool-link', names)
+    self.assertIn('./usr/lib/libtool.so.1', names)
+
+  @unittest.skipUnless(_HaveCommands('pbzip2', 'sudo'),
+                       'needs pbzip2 and passwordless sudo')
+  def testEquivalentPackages(self):
+    """Tests the streaming filter builds the same package as the tar one."""
+    in_path = os.path.join(self.tempdir, 'in', 'pkg-1.tbz2')
+    os.makedirs(os.path.dirname(in_path))
+    with open(in_path, 'wb') as f:
+      _MakePackageTar(f, 'bz2')
+    xpak = builder.portage.xpak.xpak_mem({'CATEGORY': b'dev-util\n',
+                                          'PF': b'pkg-1\n'})
+    builder.portage.xpak.tbz2(in_path).recompose_mem(xpak)
+
+    packages = []
+    for name, filter_package in (
+        ('tar', builder._FilterInstallMaskFromPackage),
+        ('stream', builder._FilterInstallMaskFromPackageStream)):
+      out_path = os.path.join(self.tempdir, name, 'pkg-1.tbz2')
+      filter_package(in_path, out_path)
+      with open(out_path, 'rb') as f:
+        out_tar = io.BytesIO(subprocess.Popen(
+            ['pbzip2', '-dc', '--ignore-trailing-garbage=1'], stdin=f,
+            stdout=subprocess.PIPE).communicate()[0])
+      with tarfile.open(fileobj=out_tar) as tar:
+        members = _Members(tar)
+      # The tar implementation archives its temporary directory as '.'.
+      members.pop('.')
+      packages.append(
+          (members, builder.portage.xpak.tbz2(out_path).get_data()))
+
+    self.assertEqual(packages[0], packages[1])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -11,11 +11,17 @@ as well as the recent stable version as used (for example) in the lab. This
 premise is verified by the corresponding unit tests.
 """
 
+from __future__ import division
 from __future__ import print_function
 
+import collections
 import os
+import threading
+import time
 
 import cherrypy  # pylint: disable=import-error
+from cherrypy import _cpserver  # pylint: disable=import-error
+from cherrypy.process import plugins  # pylint: disable=import-error
 
 
 class PortFile(cherrypy.process.plugins.SimplePlugin):
@@ -103,3 +109,181 @@ class PortFile(cherrypy.process.plugins.SimplePlugin):
         raise
       except Exception:
         self.bus.log('Failed to remove port file: %r.' % self.portfile)
+
+
+class ThreadPoolMonitor(plugins.Monitor):
+  """CherryPy plugin measuring, and optionally adapting, the server threads.
+
+  Once the HTTP server is created, the put/get methods of its request thread
+  pool are wrapped to record how long each accepted connection waits in the
+  queue before a worker thread picks it up. The recent waits are reported as
+  percentiles by get_stats().
+
+  If adaptive, the pool is resized every |frequency| seconds: it grows (up to
+  its max) while a significant share of the connections had to wait and no
+  thread is idle, and shrinks back (down to its min) while most threads are
+  idle. This relies on the grow(), shrink() and idle members that both the
+  cheroot and the older wsgiserver thread pools provide.
+  """
+
+  # Number of recent queue waits kept for the percentiles.
+  SAMPLES = 1024
+
+  def __init__(self, bus, server=None, adaptive=False, frequency=5,
+               slow_wait=0.05):
+    """Initializes the plugin.
+
+    Args:
+      bus: The WSPBus to subscribe to.
+      server: The cherrypy server owning the thread pool, defaults to
+        cherrypy.server.
+      adaptive: Whether to grow and shrink the thread pool.
+      frequency: Number of seconds between two resizing decisions.
+      slow_wait: Queue wait, in seconds, above which a connection is
+        considered to have been starved.
+    """
+    super(ThreadPoolMonitor, self).__init__(bus, self._adapt,
+                                            frequency=frequency,
+                                            name='ThreadPoolMonitor')
+    self.server = server
+    self.adaptive = adaptive
+    self.slow_wait = slow_wait
+    self.pool = None
+    self._enqueued = {}
+    self._waits = collections.deque(maxlen=self.SAMPLES)
+    self._lock = threading.Lock()
+    self._window_count = 0
+    self._window_slow = 0
+    self._counters = collections.Counter()
+
+  def start(self):
+    """Hooks into the thread pool, once the HTTP server has been created."""
+    server = self.server or cherrypy.server
+    pool = getattr(getattr(server, 'httpserver', None), 'requests', None)
+    if pool is None:
+      self.bus.log('No HTTP server thread pool to monitor.')
+      return
+    if self.pool is not pool:
+      self.pool = pool
+      self._hook(pool)
+    if self.adaptive:
+      super(ThreadPoolMonitor, self).start()
+  # Run after cherrypy.server (75) has created its HTTP server.
+  start.priority = 80
+
+  def _hook(self, pool):
+    """Wraps the put/get methods of |pool| to time queued connections."""
+    put, get = pool.put, pool.get
+    enqueued = self._enqueued
+
+    def _put(obj, *args, **kwargs):
+      enqueued[id(obj)] = time.time()
+      try:
+        return put(obj, *args, **kwargs)
+      except Exception:
+        enqueued.pop(id(obj), None)
+        raise
+
+    def _get(*args, **kwargs):
+      obj = get(*args, **kwargs)
+      # Shutdown requests are queued directly and were never timed.
+      start = enqueued.pop(id(obj), None)
+      if start is not None:
+        self._record(time.time() - start)
+      return obj
+
+    pool.put = _put
+    pool.get = _get
+
+  def _record(self, wait):
+    with self._lock:
+      self._waits.append(wait)
+      self._window_count += 1
+      if wait > self.slow_wait:
+        self._window_slow += 1
+
+  def _adapt(self):
+    """Grows or shrinks the thread pool depending on the recent waits."""
+    pool = self.pool
+    if pool is None:
+      return
+    with self._lock:
+      count, slow = self._window_count, self._window_slow
+      self._window_count = self._window_slow = 0
+
+    size = len(getattr(pool, '_threads', ()))
+    idle = pool.idle
+    if count and slow * 10 >= count and idle == 0:
+      before = size
+      pool.grow(max(size // 4, 1))
+      grown = len(pool._threads) - before  # pylint: disable=protected-access
+      if grown:
+        self._counters['grown'] += grown
+        self.bus.log('Grew the thread pool by %d threads to %d (%d/%d '
+                     'connections waited over %.3fs).' %
+                     (grown, before + grown, slow, count, self.slow_wait))
+    elif not slow and idle > size // 2:
+      amount = min(idle // 2, max(size - pool.min, 0))
+      if amount:
+        pool.shrink(amount)
+        self._counters['shrunk'] += amount
+        self.bus.log('Shrinking the thread pool by %d threads (%d idle).' %
+                     (amount, idle))
+
+  def get_stats(self):
+    """Returns a dictionary describing the thread pool and its queue waits."""
+    with self._lock:
+      waits = sorted(self._waits)
+    stats = {'adaptive': self.adaptive}
+    stats.update(self._counters)
+    pool = self.pool
+    if pool is not None:
+      stats.update({
+          'threads': len(getattr(pool, '_threads', ())),
+          'idle_threads': pool.idle,
+          'min_threads': pool.min,
+          'max_threads': pool.max if pool.max != float('inf') else -1,
+          'queued_connections': pool.qsize,
+      })
+    for name, quantile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+      index = min(int(len(waits) * quantile), len(waits) - 1)
+      stats['queue_wait_%s_ms' % name] = (
+          round(waits[index] * 1000, 3) if waits else 0.0)
+    stats['queue_wait_max_ms'] = round(waits[-1] * 1000, 3) if waits else 0.0
+    stats['queue_wait_samples'] = len(waits)
+    return stats
+
+
+class ReusePortServer(_cpserver.Server):
+  """A cherrypy.server listening on a port other processes also listen on.
+
+  The socket of the HTTP server is bound with SO_REUSEPORT, so that the kernel
+  balances the connections between all the processes listening on the port,
+  e.g. the workers of a pre-fork server. Unlike the stock server, it does not
+  wait for the port to be free before binding it, as it never is once another
+  worker listens on it. This needs a cheroot HTTP server, the older wsgiserver
+  does not set SO_REUSEPORT.
+  """
+
+  def httpserver_from_self(self, httpserver=None):
+    """Returns the HTTP server and its address, binding with SO_REUSEPORT."""
+    httpserver, bind_addr = super(ReusePortServer, self).httpserver_from_self(
+        httpserver)
+    httpserver.reuse_port = True
+    return httpserver, bind_addr
+
+  def start(self):
+    """Starts the HTTP server without checking the port is free first."""
+    if self.running:
+      self.bus.log('Already serving on %s' % self.description)
+      return
+    if not self.httpserver:
+      self.httpserver, self.bind_addr = self.httpserver_from_self()
+    self.interrupt = None
+    thread = threading.Thread(target=self._start_http_thread)
+    thread.name = 'HTTPServer ' + thread.name
+    thread.start()
+    self.wait()
+    self.running = True
+    self.bus.log('Serving on %s' % self.description)
+  start.priority = 75
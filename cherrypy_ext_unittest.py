@@ -9,6 +9,7 @@
 from __future__ import print_function
 
 import tempfile
+import time
 import unittest
 
 import mox  # pylint: disable=import-error
@@ -49,5 +50,84 @@ class CherrypyExtTest(mox.MoxTestBase):
     self.mox.VerifyAll()
 
 
+class FakeThreadPool(object):
+  """A thread pool with the interface of the cheroot/wsgiserver ones."""
+
+  def __init__(self, size, min_size, max_size):
+    self._threads = [object()] * size
+    self._queue = []
+    self.min = min_size
+    self.max = max_size
+    self.idle = 0
+    self.qsize = 0
+
+  def put(self, obj):
+    self._queue.append(obj)
+
+  def get(self):
+    return self._queue.pop(0)
+
+  def grow(self, amount):
+    amount = min(amount, self.max - len(self._threads))
+    self._threads += [object()] * amount
+
+  def shrink(self, amount):
+    del self._threads[:amount]
+
+
+class ThreadPoolMonitorTest(unittest.TestCase):
+  """Tests for the ThreadPoolMonitor plugin."""
+  # pylint: disable=protected-access
+
+  def setUp(self):
+    self.pool = FakeThreadPool(4, 2, 10)
+    server = type('FakeServer', (object,), {})()
+    server.httpserver = type('FakeHTTPServer', (object,), {})()
+    server.httpserver.requests = self.pool
+    self.monitor = cherrypy_ext.ThreadPoolMonitor(
+        cherrypy.engine, server=server, adaptive=True, slow_wait=0.01)
+    self.monitor._hook(self.pool)
+    self.monitor.pool = self.pool
+
+  def _Serve(self, wait):
+    """Queues and dequeues a connection that waited |wait| seconds."""
+    conn = object()
+    self.pool.put(conn)
+    time.sleep(wait)
+    self.assertIs(self.pool.get(), conn)
+
+  def testQueueWaitPercentiles(self):
+    """Check that queue waits are recorded."""
+    self._Serve(0)
+    self._Serve(0)
+    self._Serve(0.05)
+    stats = self.monitor.get_stats()
+    self.assertEqual(stats['queue_wait_samples'], 3)
+    self.assertGreaterEqual(stats['queue_wait_p99_ms'], 50)
+    self.assertLess(stats['queue_wait_p50_ms'], stats['queue_wait_p99_ms'])
+    self.assertEqual(stats['threads'], 4)
+
+  def testUntimedConnections(self):
+    """Check that connections queued around the hooks are not timed."""
+    self.pool._queue.append(None)
+    self.assertIsNone(self.pool.get())
+    self.assertEqual(self.monitor.get_stats()['queue_wait_samples'], 0)
+
+  def testGrowWhenStarved(self):
+    """Check that the pool grows while connections wait for threads."""
+    self._Serve(0.02)
+    self.monitor._adapt()
+    self.assertEqual(len(self.pool._threads), 5)
+    self.assertEqual(self.monitor.get_stats()['grown'], 1)
+
+  def testShrinkWhenIdle(self):
+    """Check that the pool shrinks while threads are idle."""
+    self.pool.idle = 4
+    self.monitor._adapt()
+    self.assertEqual(len(self.pool._threads), 2)
+    self.monitor._adapt()
+    self.assertEqual(len(self.pool._threads), 2)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -24,13 +24,16 @@ how to update and which payload to give to a requester.
 
 from __future__ import print_function
 
+import collections
+import contextlib
+import functools
 import json
+import multiprocessing
 import optparse  # pylint: disable=deprecated-module
 import os
 import re
 import shutil
 import socket
-import subprocess
 import sys
 import tempfile
 import threading
@@ -46,22 +49,28 @@ from cherrypy.process import plugins
 # pylint: enable=no-name-in-module, import-error
 
 import autoupdate
+import block_map as block_map_lib
 import cherrypy_ext
 import health_checker
+import parallel_extract
+import prefork
+import resolution_cache
+import rpc_metrics
+import staging_pipeline
+import static_server
+import symbol_server
 
 # This must happen before any local modules get a chance to import
 # anything from chromite.  Otherwise, really bad things will happen, and
 # you will _not_ understand why.
 import setup_chromite  # pylint: disable=unused-import
-from chromite.lib import cros_build_lib
-from chromite.lib.xbuddy import android_build
 from chromite.lib.xbuddy import artifact_info
-from chromite.lib.xbuddy import build_artifact
 from chromite.lib.xbuddy import cherrypy_log_util
 from chromite.lib.xbuddy import common_util
 from chromite.lib.xbuddy import devserver_constants
-from chromite.lib.xbuddy import downloader
-from chromite.lib.xbuddy import xbuddy
+# The rest of the xbuddy stack (android_build, build_artifact, downloader and
+# xbuddy, which import most of chromite) is only imported by the RPCs using it,
+# to not slow down the start of the devserver and the tests importing it.
 
 # Module-local log function.
 def _Log(message, *args):
@@ -69,6 +78,14 @@ def _Log(message, *args):
 
 CACHED_ENTRIES = 12
 
+# Number of seconds resolutions of aliases such as 'latest' are cached for.
+# Resolutions of fully pinned versions are cached until evicted.
+RESOLUTION_CACHE_TTL = 60
+
+# Matches path parts naming a fully pinned build version, e.g. R26-4000.0.0 or
+# 4000.0.0.
+_PINNED_VERSION_RE = re.compile(r'^(R\d+-)?\d+\.\d+\.\d+')
+
 TELEMETRY_FOLDER = 'telemetry_src'
 TELEMETRY_DEPS = ['dep-telemetry_dep.tar.bz2',
                   'dep-page_cycler_dep.tar.bz2',
@@ -78,6 +95,14 @@ TELEMETRY_DEPS = ['dep-telemetry_dep.tar.bz2',
 # Sets up global to share between classes.
 updater = None
 
+# Server thread pool sizes. A fixed size pool is used unless
+# --adaptive_thread_pool is set, in which case the pool starts small and grows
+# up to its max while connections wait for a thread.
+_THREAD_POOL_SIZE = 2
+_PRODUCTION_THREAD_POOL_SIZE = 150
+_ADAPTIVE_THREAD_POOL_MAX = 16
+_PRODUCTION_ADAPTIVE_THREAD_POOL_MAX = 300
+
 # Log rotation parameters.  These settings correspond to twice a day once
 # devserver is started, with about two weeks (28 backup files) of old logs
 # kept for backup.
@@ -197,6 +222,8 @@ def _get_downloader(kwargs):
   Args:
     kwargs: Keyword arguments for the request.
   """
+  from chromite.lib.xbuddy import downloader
+
   local_path = kwargs.get('local_path')
   if local_path:
     local_path = _canonicalize_local_path(local_path)
@@ -234,6 +261,20 @@ def _get_downloader(kwargs):
   return dl
 
 
+def _get_factory_class(dl):
+  """Returns the artifact factory class matching the downloader |dl|."""
+  from chromite.lib.xbuddy import build_artifact
+  from chromite.lib.xbuddy import downloader
+
+  if (isinstance(dl, (downloader.GoogleStorageDownloader,
+                      downloader.LocalDownloader))):
+    return build_artifact.ChromeOSArtifactFactory
+  elif isinstance(dl, downloader.AndroidBuildDownloader):
+    return build_artifact.AndroidArtifactFactory
+  raise DevServerError(
+      'Unrecognized value for downloader type: %s' % type(dl))
+
+
 def _get_downloader_and_factory(kwargs):
   """Returns the downloader and artifact factory based on passed in arguments.
 
@@ -242,21 +283,84 @@ def _get_downloader_and_factory(kwargs):
   """
   artifacts, files = _get_artifacts(kwargs)
   dl = _get_downloader(kwargs)
-
-  if (isinstance(dl, (downloader.GoogleStorageDownloader,
-                      downloader.LocalDownloader))):
-    factory_class = build_artifact.ChromeOSArtifactFactory
-  elif isinstance(dl, downloader.AndroidBuildDownloader):
-    factory_class = build_artifact.AndroidArtifactFactory
-  else:
-    raise DevServerError(
-        'Unrecognized value for downloader type: %s' % type(dl))
-
+  factory_class = _get_factory_class(dl)
   factory = factory_class(dl.GetBuildDir(), artifacts, files, dl.GetBuild())
 
   return dl, factory
 
 
+def _get_staging_jobs(dl, artifacts, files):
+  """Returns the artifact factory of a build and the jobs staging it.
+
+  A single factory stages the whole build, so that every artifact is
+  processed once and the optional artifacts are only downloaded once, by
+  Download(factory) after the jobs are done.
+
+  Args:
+    dl: The downloader of the build.
+    artifacts: The names of the artifacts to stage.
+    files: The names of the files to stage.
+
+  Returns:
+    A (factory, jobs) tuple, |jobs| being a list of (name, function) pairs for
+    StagingPipeline.Stage, each function downloading and processing one of
+    the required artifacts of |factory|. The jobs staging files are all named
+    'files'.
+  """
+  artifacts = list(collections.OrderedDict.fromkeys(artifacts))
+  files = list(collections.OrderedDict.fromkeys(files))
+  factory = _get_factory_class(dl)(dl.GetBuildDir(), artifacts, files,
+                                   dl.GetBuild())
+  # The factory has one required artifact per name, the named artifacts
+  # first. They are processed the way Downloader.Download does, one per job.
+  names = artifacts + ['files'] * len(files)
+  jobs = [(name, functools.partial(artifact.Process, dl, True))
+          for name, artifact in zip(names, factory.RequiredArtifacts())]
+  return factory, jobs
+
+
+def _GenerateBlockMapsInBackground(build_dir):
+  """Generates the missing block maps of a staged build in a thread.
+
+  The partition images are staged by name or within artifacts, e.g.
+  full_payload; those present get their block map. Hashing large images takes
+  a while, which stage requests should not wait for. A block_map request for
+  an image whose block map is being generated waits for the same generation.
+
+  Args:
+    build_dir: The directory the build is staged in.
+  """
+  def _Generate():
+    try:
+      block_map_lib.GenerateStagedBlockMaps(build_dir)
+    except Exception as e:  # pylint: disable=broad-except
+      _Log('Failed to generate the block maps of %s: %s', build_dir, e)
+
+  thread = threading.Thread(target=_Generate, name='block_map')
+  thread.daemon = True
+  thread.start()
+
+
+def _get_block_map(kwargs):
+  """Returns the path and the block map of the staged image of a request.
+
+  Args:
+    kwargs: Keyword arguments for the request.
+
+  Raises:
+    DevServerError: if the image is not staged.
+  """
+  dl = _get_downloader(kwargs)
+  image = kwargs.get('image', 'full_dev_part_ROOT.bin.gz')
+  if os.path.basename(image) != image or image.startswith('.'):
+    raise DevServerError('Invalid image name %s' % image)
+  image_path = os.path.join(dl.GetBuildDir(), image)
+  try:
+    return image_path, block_map_lib.GetBlockMap(image_path)
+  except block_map_lib.BlockMapError as e:
+    raise DevServerError(str(e))
+
+
 def _LeadingWhiteSpaceCount(string):
   """Count the amount of leading whitespace in a string.
 
@@ -295,25 +399,77 @@ def _PrintDocStringAsHTML(func):
   return '\n'.join(html_doc)
 
 
-def _GetUpdateTimestampHandler(static_dir):
+def _GetStaticAccessHandler(static_dir, batcher):
   """Returns a handler to update directory staged.timestamp.
 
-  This handler resets the stage.timestamp whenever static content is accessed.
+  The handler resets the stage.timestamp whenever static content is accessed.
+  The updates are queued on |batcher|, so that each staged build is touched
+  at most once per batch instead of once per request.
 
   Args:
     static_dir: Directory from which static content is being staged.
+    batcher: static_server.AccessTimeBatcher used to batch the updates.
 
   Returns:
-    A cherrypy handler to update the timestamp of accessed content.
+    A function called with the path of each accessed static file.
   """
-  def UpdateTimestampHandler():
-    if not '404' in cherrypy.response.status:
-      build_match = re.match(devserver_constants.STAGED_BUILD_REGEX,
-                             cherrypy.request.path_info)
-      if build_match:
-        build_dir = os.path.join(static_dir, build_match.group('build'))
-        downloader.Downloader.TouchTimestampForStaged(build_dir)
-  return UpdateTimestampHandler
+  def StaticAccessHandler(path):
+    build_match = re.match(devserver_constants.STAGED_BUILD_REGEX, path)
+    if build_match:
+      batcher.Add(os.path.join(static_dir, build_match.group('build')))
+  return StaticAccessHandler
+
+
+def _TouchTimestampForStaged(build_dir):
+  """Resets the timestamp of the staged build |build_dir|."""
+  from chromite.lib.xbuddy import downloader
+  downloader.Downloader.TouchTimestampForStaged(build_dir)
+
+
+class _LazyXBuddy(object):
+  """An XBuddy created, and its module imported, when first used.
+
+  Most requests, e.g. to /static, /update with a staged payload or
+  /check_health never need XBuddy, so the devserver starts without it.
+  """
+
+  def __init__(self, **kwargs):
+    self._kwargs = kwargs
+    self._xbuddy = None
+    self._lock = threading.Lock()
+
+  def __getattr__(self, name):
+    if self._xbuddy is None:
+      with self._lock:
+        if self._xbuddy is None:
+          from chromite.lib.xbuddy import xbuddy
+          self._xbuddy = xbuddy.XBuddy(**self._kwargs)
+    return getattr(self._xbuddy, name)
+
+
+@contextlib.contextmanager
+def _NoLock():
+  """A context holding no lock."""
+  yield
+
+
+def _SetThreadPoolDefaults(options):
+  """Fills in and checks the thread pool bounds of |options|."""
+  if options.adaptive_thread_pool:
+    options.thread_pool_min = options.thread_pool_min or _THREAD_POOL_SIZE
+    options.thread_pool_max = options.thread_pool_max or (
+        _PRODUCTION_ADAPTIVE_THREAD_POOL_MAX if options.production
+        else _ADAPTIVE_THREAD_POOL_MAX)
+  else:
+    options.thread_pool_min = options.thread_pool_min or (
+        _PRODUCTION_THREAD_POOL_SIZE if options.production
+        else _THREAD_POOL_SIZE)
+    # A fixed size pool never grows past its initial size.
+    options.thread_pool_max = options.thread_pool_max or options.thread_pool_min
+  if options.thread_pool_max < options.thread_pool_min:
+    raise DevServerError('--thread_pool_max (%d) is lower than '
+                         '--thread_pool_min (%d).' %
+                         (options.thread_pool_max, options.thread_pool_min))
 
 
 def _GetConfig(options):
@@ -324,12 +480,6 @@ def _GetConfig(options):
   if not socket.has_ipv6:
     socket_host = '0.0.0.0'
 
-  # Adds the UpdateTimestampHandler to cherrypy's tools. This tools executes
-  # on the on_end_resource hook. This hook is called once processing is
-  # complete and the response is ready to be returned.
-  cherrypy.tools.update_timestamp = cherrypy.Tool(
-      'on_end_resource', _GetUpdateTimestampHandler(options.static_dir))
-
   base_config = {
       'global': {
           'server.log_request_headers': True,
@@ -338,9 +488,11 @@ def _GetConfig(options):
           'server.socket_port': int(options.port),
           'response.timeout': 6000,
           'request.show_tracebacks': True,
-          'server.socket_timeout': 60,
-          'server.thread_pool': 2,
+          'server.socket_timeout': options.socket_timeout,
+          'server.thread_pool': options.thread_pool_min,
+          'server.thread_pool_max': options.thread_pool_max,
           'engine.autoreload.on': False,
+          'tools.rpc_metrics.on': True,
       },
       '/build': {
           'response.timeout': 100000,
@@ -350,16 +502,10 @@ def _GetConfig(options):
           'request.process_request_body': False,
           'response.timeout': 10000,
       },
-      # Sets up the static dir for file hosting.
-      '/static': {
-          'tools.staticdir.dir': options.static_dir,
-          'tools.staticdir.on': True,
-          'response.timeout': 10000,
-          'tools.update_timestamp.on': True,
-      },
   }
-  if options.production:
-    base_config['global'].update({'server.thread_pool': 150})
+  if options.socket_queue_size:
+    base_config['global']['server.socket_queue_size'] = (
+        options.socket_queue_size)
 
   return base_config
 
@@ -515,20 +661,122 @@ class DevServerRoot(object):
   # Method names that should not be listed on the index page.
   _UNLISTED_METHODS = ['index', 'doc']
 
-  # Number of threads that devserver is staging images.
-  _staging_thread_count = 0
-  # Lock used to lock increasing/decreasing count.
-  _staging_thread_count_lock = threading.Lock()
+  def __init__(self, _xbuddy, symbolicator=None,
+               resolution_ttl=RESOLUTION_CACHE_TTL, thread_pool_monitor=None,
+               staging_counter=None, staging_lock_dict=None,
+               telemetry_lock_dict=None, pipeline=None, updater=None):
+    """Initializes the devserver.
 
-  def __init__(self, _xbuddy):
+    The counter and lock dictionaries default to ones local to the process;
+    the workers of a pre-fork devserver share theirs (see prefork.py).
+
+    Args:
+      _xbuddy: The XBuddy resolving and staging the artifacts.
+      symbolicator: The symbol_server.SymbolServer of symbolicate_dump.
+      resolution_ttl: Number of seconds the resolution of aliases are cached.
+      thread_pool_monitor: The cherrypy_ext.ThreadPoolMonitor of the server.
+      staging_counter: The prefork.Counter of the threads staging builds.
+      staging_lock_dict: A lock dictionary serializing the staging of each
+        build, by default they are not serialized.
+      telemetry_lock_dict: The lock dictionary serializing the staging of the
+        telemetry sources of each build.
+      pipeline: The staging_pipeline.StagingPipeline running the jobs staging
+        the artifacts.
+      updater: The autoupdate.Autoupdate serving the update RPC, whose payload
+        cache is invalidated when builds are staged, if any.
+    """
     self._builder = None
-    self._telemetry_lock_dict = common_util.LockDict()
+    self._staging_counter = staging_counter or prefork.Counter()
+    self._staging_lock_dict = staging_lock_dict
+    self._telemetry_lock_dict = telemetry_lock_dict or common_util.LockDict()
+    self._staging_pipeline = pipeline or staging_pipeline.StagingPipeline()
     self._xbuddy = _xbuddy
+    self._symbolicator = symbolicator or symbol_server.SymbolServer()
+    self._resolution_cache = resolution_cache.ResolutionCache()
+    self._resolution_ttl = resolution_ttl
+    self._thread_pool_monitor = thread_pool_monitor
+    self._updater = updater
 
   @property
   def staging_thread_count(self):
     """Get the staging thread count."""
-    return self._staging_thread_count
+    return self._staging_counter.value
+
+  @property
+  def resolution_cache_stats(self):
+    """Get the statistics of the xBuddy/latest build resolution cache."""
+    return self._resolution_cache.GetStats()
+
+  @property
+  def thread_pool_stats(self):
+    """Get the server thread pool size and queue wait percentiles."""
+    if self._thread_pool_monitor is None:
+      return {}
+    return self._thread_pool_monitor.get_stats()
+
+  @property
+  def payload_cache_stats(self):
+    """Get the statistics of the update label to payload resolution cache."""
+    if self._updater is None:
+      return {}
+    return self._updater.payload_cache_stats
+
+  @property
+  def server_stats(self):
+    """Get the statistics of the caches, threads and staging jobs."""
+    return {
+        'resolution_cache': self.resolution_cache_stats,
+        'payload_cache': self.payload_cache_stats,
+        'thread_pool': self.thread_pool_stats,
+        'staging_pipeline': self._staging_pipeline.GetStats(),
+    }
+
+  def _StagingLock(self, build_dir):
+    """Returns a context holding the staging lock of |build_dir|, if any."""
+    if self._staging_lock_dict is None:
+      return _NoLock()
+    return self._staging_lock_dict.lock(build_dir)
+
+  def _GetAndInvalidatePayloads(self, path_parts):
+    """Gets an artifact with xBuddy, which may stage a new update payload."""
+    resolved = self._xbuddy.Get(path_parts)
+    self._InvalidatePayloadCache()
+    return resolved
+
+  def _InvalidatePayloadCache(self):
+    """Forgets the update payloads found for labels, see autoupdate.py."""
+    if self._updater is not None:
+      self._updater.InvalidatePayloadCache()
+
+  def _RefreshCachedArtifact(self, resolved):
+    """Checks a cached xBuddy artifact is still staged and marks it as used.
+
+    XBuddy.Get resets the timestamp of the build it serves, which its cache
+    cleanup relies on to evict the least recently used builds. Cached
+    resolutions do not go through XBuddy.Get, so this does it instead.
+
+    Args:
+      resolved: The (build_id, file_name) pair returned by XBuddy.Get.
+
+    Returns:
+      Whether the artifact is still staged.
+    """
+    build_id, file_name = resolved
+    build_dir = os.path.join(self._xbuddy.static_dir, build_id)
+    if not os.path.exists(os.path.join(build_dir, file_name)):
+      return False
+    try:
+      _TouchTimestampForStaged(build_dir)
+    except (IOError, OSError):
+      # The build is being removed.
+      return False
+    return True
+
+  def _ResolutionTTL(self, path_parts):
+    """Returns how long the resolution of |path_parts| can be cached."""
+    if any(_PINNED_VERSION_RE.match(part) for part in path_parts):
+      return resolution_cache.NO_EXPIRY
+    return self._resolution_ttl
 
   @cherrypy.expose
   def build(self, board, pkg, **kwargs):
@@ -582,6 +830,8 @@ class DevServerRoot(object):
     Returns:
       A string with information about the contents of the image directory.
     """
+    from chromite.lib.xbuddy import build_artifact
+
     dl = _get_downloader(kwargs)
     try:
       image_dir_contents = dl.ListBuildDir()
@@ -644,22 +894,84 @@ class DevServerRoot(object):
         custom post-processing.
       clean: True to remove any previously staged artifacts first.
     """
-    dl, factory = _get_downloader_and_factory(kwargs)
+    from chromite.lib.xbuddy import xbuddy
 
-    with DevServerRoot._staging_thread_count_lock:
-      DevServerRoot._staging_thread_count += 1
-    try:
+    artifacts, files = _get_artifacts(kwargs)
+    dl = _get_downloader(kwargs)
+    factory, jobs = _get_staging_jobs(dl, artifacts, files)
+
+    with self._staging_counter.Count(), self._StagingLock(dl.GetBuildDir()):
       boolean_string = kwargs.get('clean')
       clean = xbuddy.XBuddy.ParseBoolean(boolean_string)
       if clean and os.path.exists(dl.GetBuildDir()):
         _Log('Removing %s' % dl.GetBuildDir())
         shutil.rmtree(dl.GetBuildDir())
+      # The artifacts are downloaded and processed concurrently.
+      self._staging_pipeline.Stage(dl.GetBuildDir(), jobs)
+      # The required artifacts are staged by now; this only starts the
+      # background download of the optional artifacts of the build.
       dl.Download(factory)
-    finally:
-      with DevServerRoot._staging_thread_count_lock:
-        DevServerRoot._staging_thread_count -= 1
+      self._InvalidatePayloadCache()
+    _GenerateBlockMapsInBackground(dl.GetBuildDir())
     return 'Success'
 
+  @cherrypy.expose
+  def block_map(self, **kwargs):
+    """Returns the block map of a staged partition image as JSON.
+
+    The block map has the size of the uncompressed image, its chunk size, the
+    sha256 of every chunk (null for zero chunks) and the [offset, length]
+    extents of the zero chunks. See block_map.py.
+
+    Examples:
+      http://devserver_url:<port>/block_map?archive_url=gs://your_url/path&
+          image=full_dev_part_ROOT.bin.gz
+
+    Args:
+      archive_url: Google Storage URL for the build.
+      local_path: Local path for the build.
+      image: Name of the staged image, full_dev_part_ROOT.bin.gz by default.
+    """
+    image_map = _get_block_map(kwargs)[1]
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(image_map, separators=(',', ':')).encode('utf-8')
+
+  @cherrypy.expose
+  def block_delta(self, hashes='', **kwargs):
+    """Returns the chunks of a staged partition image a client does not have.
+
+    Callers POST the hashes of the chunks they have, e.g. the chunks of the
+    partition the image is going to be written to, and get back a block delta
+    with the non-zero chunks of the image whose hash differs. It is applied
+    with block_map.ApplyBlockDelta, which also zeroes the zero extents of the
+    image.
+
+    Examples:
+      curl -F hashes=@hashes.txt http://devserver_url:<port>/block_delta?
+          archive_url=gs://your_url/path&image=full_dev_part_ROOT.bin.gz
+
+    Args:
+      archive_url: Google Storage URL for the build.
+      local_path: Local path for the build.
+      image: Name of the staged image, full_dev_part_ROOT.bin.gz by default.
+      hashes: Hashes of the chunks the client has, in the order of the chunks,
+        separated by spaces or commas, '-' for unknown or zero chunks. See
+        block_map.FormatHashes.
+    """
+    if hasattr(hashes, 'file'):
+      hashes = hashes.file.read().decode('utf-8')
+    image_path, image_map = _get_block_map(kwargs)
+    indexes = block_map_lib.DeltaChunks(image_map,
+                                        block_map_lib.ParseHashes(hashes))
+    _Log('Sending %d of %d chunks of %s', len(indexes),
+         len(image_map['hashes']), image_path)
+    headers = cherrypy.response.headers
+    headers['Content-Type'] = 'application/octet-stream'
+    headers['Content-Length'] = str(
+        block_map_lib.BlockDeltaSize(image_map, indexes))
+    return block_map_lib.IterBlockDelta(image_path, image_map, indexes)
+  block_delta._cp_config = {'response.stream': True}
+
   @cherrypy.expose
   def locate_file(self, **kwargs):
     """Get the path to the given file name.
@@ -728,29 +1040,33 @@ class DevServerRoot(object):
 
       common_util.MkDirP(telemetry_path)
 
-      # Copy over the required deps tar balls to the telemetry directory.
-      for dep in TELEMETRY_DEPS:
-        dep_path = os.path.join(deps_path, dep)
-        if not os.path.exists(dep_path):
-          # This dep does not exist (could be new), do not extract it.
-          continue
+      # Extract the deps tarballs side by side, then merge them in
+      # TELEMETRY_DEPS order so later deps win like a sequential extraction.
+      # Deps that do not exist (could be new) are not extracted.
+      deps = [os.path.join(deps_path, dep) for dep in TELEMETRY_DEPS
+              if os.path.exists(os.path.join(deps_path, dep))]
+      staging_dir = tempfile.mkdtemp(prefix='.staging', dir=telemetry_path)
+      try:
         try:
-          cros_build_lib.ExtractTarball(dep_path, telemetry_path)
-        except cros_build_lib.TarballError as e:
+          merged = parallel_extract.ExtractParallel(deps, staging_dir)
+        except parallel_extract.ExtractError as e:
           shutil.rmtree(telemetry_path)
           raise DevServerError(str(e))
 
-      # By default all the tarballs extract to test_src but some parts of
-      # the telemetry code specifically hardcoded to exist inside of 'src'.
-      test_src = os.path.join(telemetry_path, 'test_src')
-      try:
-        shutil.move(test_src, src_folder)
-      except shutil.Error:
-        # This can occur if src_folder already exists. Remove and retry move.
-        shutil.rmtree(src_folder)
-        raise DevServerError(
-            'Failure in telemetry setup for build %s. Appears that the '
-            'test_src to src move failed.' % dl.GetBuild())
+        # By default all the tarballs extract to test_src but some parts of
+        # the telemetry code specifically hardcoded to exist inside of 'src'.
+        # It is published last with a single rename, so src_folder only
+        # exists once telemetry is fully staged.
+        test_src = os.path.join(merged, 'test_src')
+        if not os.path.isdir(test_src):
+          raise DevServerError(
+              'Failure in telemetry setup for build %s. No test_src found in '
+              'the telemetry deps.' % dl.GetBuild())
+        os.rename(test_src, os.path.join(staging_dir, 'src'))
+        parallel_extract.MergeTree(merged, telemetry_path)
+        os.rename(os.path.join(staging_dir, 'src'), src_folder)
+      finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
       return src_folder
 
@@ -769,6 +1085,7 @@ class DevServerRoot(object):
     """
     if is_deprecated_server():
       raise DeprecatedRPCError('symbolicate_dump')
+    from chromite.lib.xbuddy import build_artifact
 
     # Ensure the symbols have been staged.
     # Try debug.tar.xz first, then debug.tgz
@@ -785,30 +1102,11 @@ class DevServerRoot(object):
       raise DevServerError(
           'Failed to stage symbols for %s' % dl.DescribeSource())
 
-    to_return = ''
-    with tempfile.NamedTemporaryFile() as local:
-      while True:
-        data = minidump.file.read(8192)
-        if not data:
-          break
-        local.write(data)
-
-      local.flush()
-
-      symbols_directory = os.path.join(dl.GetBuildDir(), 'debug', 'breakpad')
-
-      # The location of minidump_stackwalk is defined in chromeos-admin.
-      stackwalk = subprocess.Popen(
-          ['/usr/local/bin/minidump_stackwalk', local.name, symbols_directory],
-          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-      to_return, error_text = stackwalk.communicate()
-      if stackwalk.returncode != 0:
-        raise DevServerError(
-            "Can't generate stack trace: %s (rc=%d)" % (error_text,
-                                                        stackwalk.returncode))
-
-    return to_return
+    symbols_directory = os.path.join(dl.GetBuildDir(), 'debug', 'breakpad')
+    try:
+      return self._symbolicator.Symbolicate(minidump.file, symbols_directory)
+    except symbol_server.SymbolServerError as e:
+      raise DevServerError(str(e))
 
   @cherrypy.expose
   def latestbuild(self, **kwargs):
@@ -841,12 +1139,16 @@ class DevServerRoot(object):
       if not target or not branch:
         raise DevServerError('Both target and branch must be specified to query'
                              ' for the latest Android build.')
+      from chromite.lib.xbuddy import android_build
       return android_build.BuildAccessor.GetLatestBuildID(target, branch)
 
     try:
-      return common_util.GetLatestBuildVersion(
-          updater.static_dir, kwargs['target'],
-          milestone=kwargs.get('milestone'))
+      return self._resolution_cache.Get(
+          ('latestbuild', kwargs['target'], kwargs.get('milestone')),
+          lambda: common_util.GetLatestBuildVersion(
+              updater.static_dir, kwargs['target'],
+              milestone=kwargs.get('milestone')),
+          ttl=self._resolution_ttl)
     except common_util.CommonUtilError as errmsg:
       raise DevServerHTTPError(http_client.INTERNAL_SERVER_ERROR,
                                str(errmsg))
@@ -960,8 +1262,11 @@ class DevServerRoot(object):
     if is_deprecated_server():
       raise DeprecatedRPCError('xbuddy_translate')
 
-    build_id, filename = self._xbuddy.Translate(
-        args, image_dir=kwargs.get('image_dir'))
+    image_dir = kwargs.get('image_dir')
+    build_id, filename = self._resolution_cache.Get(
+        ('translate', args, image_dir),
+        lambda: self._xbuddy.Translate(args, image_dir=image_dir),
+        ttl=self._ResolutionTTL(args))
     response = os.path.join(build_id, filename)
     _Log('Path translation requested, returning: %s', response)
     return response
@@ -1009,6 +1314,7 @@ class DevServerRoot(object):
     """
     if is_deprecated_server():
       raise DeprecatedRPCError('xbuddy')
+    from chromite.lib.xbuddy import xbuddy
 
     boolean_string = kwargs.get('return_dir')
     return_dir = xbuddy.XBuddy.ParseBoolean(boolean_string)
@@ -1020,7 +1326,10 @@ class DevServerRoot(object):
           http_client.INTERNAL_SERVER_ERROR,
           'Cannot specify both return_dir and relative_path')
 
-    build_id, file_name = self._xbuddy.Get(args)
+    # Cached resolutions are only used while the artifact is still staged.
+    build_id, file_name = self._resolution_cache.Get(
+        ('get', args), lambda: self._GetAndInvalidatePayloads(args),
+        ttl=self._ResolutionTTL(args), validate=self._RefreshCachedArtifact)
 
     response = None
     if return_dir:
@@ -1188,6 +1497,63 @@ def _AddProductionOptions(parser):
                    help='have the devserver use production values when '
                    'starting up. This includes using more threads and '
                    'performing less logging.')
+  group.add_option('--symbolicate_workers',
+                   type='int', metavar='NUM',
+                   help='maximum number of concurrent minidump_stackwalk '
+                   'processes used by symbolicate_dump; capped at and '
+                   'defaulting to the number of CPUs.')
+  group.add_option('--symbolicate_cache_size',
+                   default=symbol_server.DEFAULT_CACHE_SIZE, type='int',
+                   help='number of symbolicate_dump results to keep in '
+                   'memory (default: %default).')
+  group.add_option('--thread_pool_min',
+                   type='int', metavar='NUM',
+                   help='number of server threads; the minimum number with '
+                   '--adaptive_thread_pool (default: %d, or %d with '
+                   '--production).' % (_THREAD_POOL_SIZE,
+                                       _PRODUCTION_THREAD_POOL_SIZE))
+  group.add_option('--thread_pool_max',
+                   type='int', metavar='NUM',
+                   help='maximum number of server threads the adaptive thread '
+                   'pool grows to (default: %d, or %d with --production).' %
+                   (_ADAPTIVE_THREAD_POOL_MAX,
+                    _PRODUCTION_ADAPTIVE_THREAD_POOL_MAX))
+  group.add_option('--adaptive_thread_pool',
+                   action='store_true', default=False,
+                   help='grow the server thread pool while connections wait '
+                   'for a thread, and shrink it back while threads are idle.')
+  group.add_option('--workers',
+                   default=1, type='int', metavar='NUM',
+                   help='number of devserver processes, all serving on '
+                   '--port; with more than 1, a supervisor process forks and '
+                   'restarts them (default: %default).')
+  group.add_option('--staging_jobs',
+                   default=staging_pipeline.DEFAULT_MAX_JOBS, type='int',
+                   metavar='NUM',
+                   help='maximum number of artifacts staged at once, by all '
+                   'the stage requests (default: %default).')
+  group.add_option('--staging_jobs_per_build',
+                   default=staging_pipeline.DEFAULT_MAX_JOBS_PER_BUILD,
+                   type='int', metavar='NUM',
+                   help='maximum number of artifacts of a build staged at '
+                   'once (default: %default).')
+  group.add_option('--socket_queue_size',
+                   type='int', metavar='NUM',
+                   help='listen backlog of the server socket (default: '
+                   "cherrypy's).")
+  group.add_option('--socket_timeout',
+                   default=60, type='int', metavar='SECONDS',
+                   help='timeout of the server sockets (default: %default).')
+  group.add_option('--no_sendfile',
+                   action='store_true', default=False,
+                   help='serve /static by copying files through python '
+                   'instead of using sendfile.')
+  group.add_option('--resolution_cache_ttl',
+                   default=RESOLUTION_CACHE_TTL, type='int',
+                   help='number of seconds xbuddy, xbuddy_translate and '
+                   'latestbuild cache the resolution of aliases such as '
+                   '"latest", and update caches the payload found for a '
+                   'label (default: %default); 0 disables the caching.')
   parser.add_option_group(group)
 
 
@@ -1236,6 +1602,20 @@ def main():
   _AddProductionOptions(parser)
   _AddTestingOptions(parser)
   (options, _) = parser.parse_args()
+  try:
+    _SetThreadPoolDefaults(options)
+  except DevServerError as e:
+    parser.error(str(e))
+  if options.workers < 1:
+    parser.error('--workers must be at least 1.')
+  if options.workers > 1 and not options.port:
+    parser.error('--workers needs a fixed --port.')
+  if (options.symbolicate_workers is not None and
+      options.symbolicate_workers < 1):
+    parser.error('--symbolicate_workers must be at least 1.')
+  if options.staging_jobs < 1 or options.staging_jobs_per_build < 1:
+    parser.error('--staging_jobs and --staging_jobs_per_build must be at '
+                 'least 1.')
 
   # Handle options that must be set globally in cherrypy.  Do this
   # work up front, because calls to _Log() below depend on this
@@ -1273,21 +1653,78 @@ def main():
   _Log('Using cache directory %s' % cache_dir)
   _Log('Serving from %s' % options.static_dir)
 
-  _xbuddy = xbuddy.XBuddy(manage_builds=options.xbuddy_manage_builds,
-                          static_dir=options.static_dir)
+  _xbuddy = _LazyXBuddy(manage_builds=options.xbuddy_manage_builds,
+                        static_dir=options.static_dir)
   if options.clear_cache and options.xbuddy_manage_builds:
     _xbuddy.CleanCache()
 
   # We allow global use here to share with cherrypy classes.
   # pylint: disable=W0603
   global updater
-  updater = autoupdate.Autoupdate(_xbuddy, static_dir=options.static_dir)
+  updater = autoupdate.Autoupdate(_xbuddy, static_dir=options.static_dir,
+                                  payload_ttl=options.resolution_cache_ttl)
 
   if options.exit:
     return
 
-  dev_server = DevServerRoot(_xbuddy)
-  health_checker_app = health_checker.Root(dev_server, options.static_dir)
+  shared_state = {}
+  staging_job_semaphore = None
+  if options.workers > 1:
+    # The workers must be forked before any thread is started.
+    state_dir = tempfile.mkdtemp(prefix='devserver_workers.')
+    staging_job_semaphore = multiprocessing.BoundedSemaphore(
+        options.staging_jobs)
+    shared_state = {
+        'staging_counter': prefork.Counter(shared=True),
+        'staging_lock_dict': prefork.FileLockDict(
+            os.path.join(state_dir, 'staging_locks')),
+        'telemetry_lock_dict': prefork.FileLockDict(
+            os.path.join(state_dir, 'telemetry_locks')),
+    }
+    stats_dir = os.path.join(state_dir, 'stats')
+    os.mkdir(stats_dir)
+    pidfile = options.pidfile and plugins.PIDFile(cherrypy.engine,
+                                                  options.pidfile)
+    if pidfile:
+      pidfile.start()
+    worker_id = prefork.ForkWorkers(options.workers)
+    if worker_id is None:
+      if pidfile:
+        pidfile.exit()
+      shutil.rmtree(state_dir)
+      return
+    options.pidfile = None
+    cherrypy.server.unsubscribe()
+    cherrypy.server = cherrypy_ext.ReusePortServer()
+    cherrypy.server.subscribe()
+    # Let the supervisor restart the worker instead of re-executing it.
+    cherrypy.engine.signal_handler.handlers['SIGHUP'] = cherrypy.engine.exit
+
+  symbolicator = symbol_server.SymbolServer(
+      max_workers=options.symbolicate_workers,
+      cache_size=options.symbolicate_cache_size)
+  thread_pool_monitor = cherrypy_ext.ThreadPoolMonitor(
+      cherrypy.engine, adaptive=options.adaptive_thread_pool)
+  thread_pool_monitor.subscribe()
+  pipeline = staging_pipeline.StagingPipeline(
+      options.staging_jobs, options.staging_jobs_per_build,
+      job_semaphore=staging_job_semaphore)
+  dev_server = DevServerRoot(_xbuddy, symbolicator=symbolicator,
+                             resolution_ttl=options.resolution_cache_ttl,
+                             thread_pool_monitor=thread_pool_monitor,
+                             pipeline=pipeline, updater=updater,
+                             **shared_state)
+  metrics = rpc_metrics.RpcMetrics()
+  cherrypy.tools.rpc_metrics = rpc_metrics.RpcMetricsTool(metrics)
+  worker_stats = None
+  if shared_state:
+    worker_stats = prefork.WorkerStats(
+        cherrypy.engine, stats_dir, worker_id,
+        lambda: dev_server.server_stats, get_raw_stats=metrics.GetState)
+    worker_stats.subscribe()
+  health_checker_app = health_checker.Root(dev_server, options.static_dir,
+                                           rpc_metrics=metrics,
+                                           worker_stats=worker_stats)
 
   if options.pidfile:
     plugins.PIDFile(cherrypy.engine, options.pidfile).subscribe()
@@ -1297,6 +1734,7 @@ def main():
 
   if (options.android_build_credential and
       os.path.exists(options.android_build_credential)):
+    from chromite.lib.xbuddy import android_build
     try:
       with open(options.android_build_credential) as f:
         android_build.BuildAccessor.credential_info = json.load(f)
@@ -1306,6 +1744,16 @@ def main():
 
   cherrypy.tree.mount(health_checker_app, '/check_health',
                       config=health_checker.get_config())
+
+  # Sets up the static dir for file hosting.
+  timestamp_batcher = static_server.AccessTimeBatcher(
+      cherrypy.engine, _TouchTimestampForStaged)
+  timestamp_batcher.subscribe()
+  static_app = static_server.StaticServer(
+      options.static_dir,
+      on_access=_GetStaticAccessHandler(options.static_dir, timestamp_batcher),
+      use_sendfile=not options.no_sendfile)
+  cherrypy.tree.mount(static_app, '/static', config=static_server.get_config())
   cherrypy.quickstart(dev_server, config=_GetConfig(options))
 
 
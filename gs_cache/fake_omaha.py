@@ -12,7 +12,6 @@ from __future__ import division
 from __future__ import print_function
 
 import cherrypy  # pylint: disable=import-error
-import nebraska_wrapper
 
 
 def get_config():
@@ -34,6 +33,9 @@ class FakeOmaha(object):
     server_addr, _ = cherrypy.request.headers.get('X-Forwarded-Host').split(':')
     body_length = int(cherrypy.request.headers.get('Content-Length', 0))
     data = cherrypy.request.rfile.read(body_length)
+    # Imported here as nebraska_wrapper pulls in nebraska, which
+    # gs_archive_server does not need to start.
+    import nebraska_wrapper
     with nebraska_wrapper.NebraskaWrapper(label, server_addr,
                                           full_update) as nb:
       return nb.HandleUpdatePing(data, **kwargs)
@@ -12,7 +12,6 @@ from __future__ import division
 from __future__ import print_function
 
 import cherrypy  # pylint: disable=import-error
-import telemetry_setup
 
 
 def get_config():
@@ -30,5 +29,8 @@ class FakeTelemetry(object):
   def GET(self, **kwargs):
     """A URL handler for setting up telemetry."""
     archive_url = kwargs.get('archive_url')
+    # Imported when first used, like nebraska_wrapper in fake_omaha, to not
+    # load it when gs_archive_server starts.
+    import telemetry_setup
     with telemetry_setup.TelemetrySetup(archive_url) as tlm:
       return tlm.Setup()
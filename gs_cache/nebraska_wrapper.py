@@ -85,7 +85,9 @@ class NebraskaWrapper(object):
     self._is_full_update = (not au_nton if full_update == 'unspecified'
                             else full_update == 'true')
 
-    self._props_dir = tempfile.mkdtemp(prefix='gsc-update')
+    # Created when the payload properties are downloaded, event requests
+    # don't need it.
+    self._props_dir = None
     self._payload_props_file = None
 
   def __enter__(self):
@@ -94,6 +96,8 @@ class NebraskaWrapper(object):
 
   def __exit__(self, exc_type, exc_value, traceback):
     """Called while exiting context manager; cleans up temp dirs."""
+    if self._props_dir is None:
+      return
     try:
       shutil.rmtree(self._props_dir)
     except Exception as e:
@@ -204,6 +208,8 @@ class NebraskaWrapper(object):
       NebraskaWrapperError is raised if the method is unable to
           download the file for some reason.
     """
+    if self._props_dir is None:
+      self._props_dir = tempfile.mkdtemp(prefix='gsc-update')
     local_payload_dir = self._props_dir
     partial_url = urllib.parse.urljoin(urlbase, '%s/' % self._label)
     _log('Downloading %s from bucket %s.', self._PayloadPropsFilename,
@@ -235,6 +241,14 @@ class NebraskaWrapper(object):
     Returns:
       Update payload message for client.
     """
+    # Events are the bulk of the requests, acknowledge them without going
+    # through a full Request and Nebraska.
+    event_ack = nebraska.EventAck.GetResponse(data)
+    if event_ack is not None:
+      _log('A non-update event notification received. Returning an ack.',
+           level=logging.INFO)
+      return event_ack
+
     # Get the static url base that will form that base of our update url e.g.
     # http://<GS_CACHE_IP>:<GS_CACHE_PORT>/download/chromeos-image-archive/.
     urlbase = self._GetDownloadURL()
@@ -23,6 +23,11 @@ from chromite.lib import cros_logging as logging
 from chromite.lib import metrics
 from chromite.lib import ts_mon_config
 
+# log_analytics.py is shared with the devserver's apache_log_metrics. The
+# devserver directory has been added to PYTHONPATH, after the gs_cache one, by
+# bin/gs_cache_nginx_metrics and bin/gs_archive_server_test.
+import log_analytics
+
 _LOG_ROTATION_TIME = 'H'
 _LOG_ROTATION_INTERVAL = 24  # hours
 _LOG_ROTATION_BACKUP = 14  # Keep for 14 days.
@@ -129,6 +134,34 @@ def match_url_path(url):
                   url, e)
   return {}
 
+
+def parse_log_line(line):
+  """Parse a log line for log_analytics with the matchers of the metrics.
+
+  Args:
+    line: A line of the Nginx access log.
+
+  Returns:
+    None if the line does not match _SUCCESS_RESPONSE_MATCHER, else a
+    (timestamp, endpoint, size, status, cache_status, in_lab) tuple. The
+    endpoint is the action, followed by the endpoint found by match_url_path
+    if any, e.g. 'download:image.zip'.
+  """
+  m = _SUCCESS_RESPONSE_MATCHER.match(line)
+  if not m:
+    return None
+  fields = match_url_path(m.group('url_path'))
+  endpoint = fields.get('action') or 'unknown'
+  if fields.get('endpoint'):
+    endpoint += ':' + fields['endpoint']
+  try:
+    size = int(m.group('size'))
+  except ValueError:
+    size = 0
+  return (m.group('timestamp'), endpoint, size, int(m.group('status_code')),
+          m.group('cache_status'), None)
+
+
 def input_log_file_type(filename):
   """A argparse type function converting input filename to file object.
 
@@ -144,7 +177,7 @@ def parse_args(argv):
   parser = argparse.ArgumentParser(description=__doc__)
   parser.add_argument(
       '-i', '--input-log-file', metavar='NGINX_ACCESS_LOG_FILE',
-      dest='input_fd', required=True,
+      dest='input_fd',
       type=input_log_file_type,
       help=('Nginx log file of Gs Cache '
             '(use "-" to indicate reading from sys.stdin).')
@@ -153,12 +186,19 @@ def parse_args(argv):
       '-l', '--log-file', default=sys.stdout,
       help='Log file of this script (default is sys.stdout).'
   )
-  return parser.parse_args(argv)
+  log_analytics.AddArguments(parser)
+  args = parser.parse_args(argv)
+  if not args.analyze and not args.input_fd:
+    parser.error('--input-log-file is required unless --analyze is used.')
+  return args
 
 
 def main(argv):
   """Main function."""
   args = parse_args(argv)
+  if args.analyze:
+    log_analytics.Analyze(args, parse_log_line)
+    return
 
   logger = logging.getLogger()
   if args.log_file is sys.stdout:
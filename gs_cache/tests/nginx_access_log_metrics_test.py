@@ -57,3 +57,14 @@ class TestMetric(unittest.TestCase):
     with mock.patch.object(nginx_access_log_metrics, 'metrics') as m:
       nginx_access_log_metrics.emit_successful_response_metric(match)
       m.Counter.assert_called_with(nginx_access_log_metrics._METRIC_NAME)
+
+  def test_parse_log_line(self):
+    """Test parsing a log line for the offline analysis."""
+    self.assertEqual(
+        nginx_access_log_metrics.parse_log_line(
+            '100.109.169.118 2018-08-01T09:11:27-07:00 "GET '
+            '/download/a_bucket/build/R1-2.3/image.zip HTTP/1.1" '
+            '206 12345 "agent/1.2.3" MISS'),
+        ('2018-08-01T09:11:27-07:00', 'download:image.zip', 12345, 206, 'MISS',
+         None))
+    self.assertIsNone(nginx_access_log_metrics.parse_log_line('garbage'))
@@ -8,8 +8,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import json
 import os
+import re
 import subprocess
 import threading
 import time
@@ -25,8 +27,8 @@ except ImportError:
   # and the auto-update test fails.
   psutil = None
 
+import rpc_metrics
 import setup_chromite  # pylint: disable=unused-import
-from chromite.lib import cros_update_progress
 from chromite.lib.xbuddy import cherrypy_log_util
 
 
@@ -36,8 +38,40 @@ def _Log(message, *args):
 
 # Number of seconds between the collection of disk and network IO counters.
 STATS_INTERVAL = 10.0
+# Number of IO rate samples kept per counter, 5 minutes at STATS_INTERVAL.
+IO_WINDOW_SIZE = 30
+# Windows over which the IO rates are averaged, in number of samples.
+_IO_WINDOWS = (('10s', 1), ('1m', 6), ('5m', 30))
+# Per-device rates reported for each device: (name, counter field, scale).
+# busy_time is in milliseconds, scaled to the percent of time busy.
+_DISK_RATES = (
+    ('read_bytes_per_second', 'read_bytes', 1.0),
+    ('write_bytes_per_second', 'write_bytes', 1.0),
+    ('busy_percent', 'busy_time', 0.1),
+)
+_NETWORK_RATES = (
+    ('sent_bytes_per_second', 'bytes_sent', 1.0),
+    ('recv_bytes_per_second', 'bytes_recv', 1.0),
+)
+# Number of seconds between two samples of the running processes.
+PROCESS_STATS_INTERVAL = 5.0
 _1G = 1000000000
 
+# Health fields counting the processes whose command line matches a pattern.
+_PROCESS_PATTERNS = (
+    ('apache_client_count', r'bin/apache2? -k start'),
+    ('telemetry_test_count', r'python.*telemetry'),
+    ('gsutil_count', r'gsutil'),
+)
+
+# Matches a command line against all of _PROCESS_PATTERNS in a single pass:
+# each pattern is an optional lookahead, anchored at the start of the command
+# line, capturing in a group named after its field when it matches. Like for
+# pgrep, '.' also matches the newlines arguments may contain.
+_PROCESS_MATCHER = re.compile('^' + ''.join(
+    r'(?:(?=.*?(?P<%s>%s)))?' % (name, pattern)
+    for name, pattern in _PROCESS_PATTERNS), re.DOTALL)
+
 
 def require_psutil():
   """Decorator for functions require psutil to run."""
@@ -91,6 +125,149 @@ def _get_process_count(process_cmd_pattern):
     return 0
 
 
+def _count_processes_with_pgrep():
+  """Counts the processes matching _PROCESS_PATTERNS with one pgrep each."""
+  return dict((name, _get_process_count(pattern))
+              for name, pattern in _PROCESS_PATTERNS)
+
+
+def _count_au_processes():
+  """Returns the number of running auto-update processes."""
+  # Imported here as it pulls in much of chromite, which the devserver does not
+  # need to start.
+  from chromite.lib import cros_update_progress
+  return len(cros_update_progress.GetAllRunningAUProcess())
+
+
+def _count_processes(processes):
+  """Counts the processes matching _PROCESS_PATTERNS.
+
+  Args:
+    processes: An iterable of psutil.Process with their cmdline in info, as
+      returned by psutil.process_iter(['cmdline']).
+
+  Returns:
+    A dictionary of the process count of each field of _PROCESS_PATTERNS.
+  """
+  counts = dict.fromkeys((name for name, _ in _PROCESS_PATTERNS), 0)
+  for proc in processes:
+    cmdline = proc.info.get('cmdline')
+    if not cmdline:
+      continue
+    match = _PROCESS_MATCHER.match(' '.join(cmdline))
+    for name, value in match.groupdict().items():
+      if value is not None:
+        counts[name] += 1
+  return counts
+
+
+class _RateWindow(object):
+  """Fixed-size ring buffer of the last rates of a counter."""
+
+  __slots__ = ('_rates', '_next', '_count')
+
+  def __init__(self, size=IO_WINDOW_SIZE):
+    self._rates = array.array('d', [0.0]) * size
+    self._next = 0
+    self._count = 0
+
+  def add(self, rate):
+    """Records a rate, overwriting the oldest one when the buffer is full."""
+    self._rates[self._next] = rate
+    self._next = (self._next + 1) % len(self._rates)
+    if self._count < len(self._rates):
+      self._count += 1
+
+  def last(self):
+    """Returns the last recorded rate, 0 if there is none."""
+    return self._rates[self._next - 1] if self._count else 0.0
+
+  def summary(self):
+    """Returns the average and peak rates over each of _IO_WINDOWS."""
+    size = len(self._rates)
+    result = {}
+    for name, window_samples in _IO_WINDOWS:
+      samples = min(window_samples, self._count, size)
+      total = peak = 0.0
+      for i in range(1, samples + 1):
+        rate = self._rates[(self._next - i) % size]
+        total += rate
+        peak = max(peak, rate)
+      result[name] = round(total / samples, 1) if samples else 0.0
+      if window_samples > 1:
+        result['peak_' + name] = round(peak, 1)
+    return result
+
+
+class _CounterRates(object):
+  """Rates of the counters of one device, e.g. a disk or a NIC."""
+
+  __slots__ = ('_rates', '_previous', '_windows')
+
+  def __init__(self, rates, counters):
+    """Initializes the rates.
+
+    Args:
+      rates: Tuple of (name, counter field, scale) of the reported rates.
+      counters: First sample of the device counters, as returned by psutil.
+    """
+    self._rates = tuple(r for r in rates if hasattr(counters, r[1]))
+    self._previous = array.array('d', [getattr(counters, field)
+                                       for _, field, _ in self._rates])
+    self._windows = tuple(_RateWindow() for _ in self._rates)
+
+  def update(self, counters, interval):
+    """Records the rates since the previous sample of the counters."""
+    for i, (_, field, scale) in enumerate(self._rates):
+      value = getattr(counters, field)
+      # Counters go back when they wrap or the device is reset.
+      delta = max(value - self._previous[i], 0)
+      self._previous[i] = value
+      self._windows[i].add(delta * scale / interval)
+
+  def last(self, name):
+    """Returns the last rate of the counter |name|."""
+    for i, (rate_name, _, _) in enumerate(self._rates):
+      if rate_name == name:
+        return self._windows[i].last()
+    return 0.0
+
+  def summary(self):
+    """Returns the window summaries of each rate."""
+    return dict((name, window.summary())
+                for (name, _, _), window in zip(self._rates, self._windows))
+
+
+def _update_device_rates(devices, counters, rates, interval):
+  """Records new samples of per-device counters.
+
+  Args:
+    devices: Dictionary of the _CounterRates of each device.
+    counters: Dictionary of the counters of each device, as returned by psutil.
+    rates: Tuple of the rates to record for new devices.
+    interval: Number of seconds since the previous sample, unused for new
+              devices.
+
+  Returns:
+    |devices|, or a new dictionary when devices appeared or disappeared, so
+    that readers iterating over |devices| are never disturbed. The first
+    sample of a new device only serves as a reference for the next one.
+  """
+  if len(devices) == len(counters) and all(n in devices for n in counters):
+    for name, value in counters.items():
+      devices[name].update(value, interval)
+    return devices
+
+  updated = {}
+  for name, value in counters.items():
+    if name in devices:
+      updated[name] = devices[name]
+      updated[name].update(value, interval)
+    else:
+      updated[name] = _CounterRates(rates, value)
+  return updated
+
+
 def get_config():
   """Get cherrypy config for this application."""
   return {
@@ -104,9 +281,14 @@ def get_config():
 
 class Root(object):
   """Cherrypy Root class of the application."""
-  def __init__(self, devserver, static_dir):
+  def __init__(self, devserver, static_dir, rpc_metrics=None,
+               worker_stats=None):
     self._static_dir = static_dir
     self._devserver = devserver
+    self._rpc_metrics = rpc_metrics
+    # The prefork.WorkerStats of a pre-fork devserver worker, with which the
+    # statistics of all the workers are merged.
+    self._worker_stats = worker_stats
 
     # Cache of disk IO stats, a thread refresh the stats every 10 seconds.
     # lock is not used for these variables as the only thread writes to these
@@ -116,8 +298,20 @@ class Root(object):
     # Cache of network IO stats.
     self.network_sent_bytes_per_sec = 0
     self.network_recv_bytes_per_sec = 0
+    # Sliding windows of the rates of each disk and network interface, and
+    # the CPU time spent waiting for IO in the last interval.
+    self._disk_rates = {}
+    self._network_rates = {}
+    self._disk_total = None
+    self.cpu_iowait_percent = 0.0
     self._start_io_stat_thread()
 
+    # Snapshot of the process counts, replaced as a whole every
+    # PROCESS_STATS_INTERVAL by _refresh_process_stats. None until the first
+    # sample, or if psutil is not installed.
+    self._process_stats = None
+    self._start_process_stat_thread()
+
   @require_psutil()
   def _get_io_stats(self):
     """Get the IO stats as a dictionary.
@@ -133,38 +327,58 @@ class Root(object):
             'network_recv_bytes_per_second': self.network_recv_bytes_per_sec,
             'network_total_bytes_per_second': (self.network_sent_bytes_per_sec +
                                                self.network_recv_bytes_per_sec),
-            'cpu_percent': psutil.cpu_percent(), }
+            'cpu_percent': psutil.cpu_percent(),
+            'cpu_iowait_percent': self.cpu_iowait_percent,
+            'load_average': os.getloadavg(),
+            'disks': dict((name, rates.summary())
+                          for name, rates in self._disk_rates.items()),
+            'network_interfaces': dict(
+                (name, rates.summary())
+                for name, rates in self._network_rates.items()), }
+
+  def _sample_io_stats(self, interval):
+    """Records the IO rates over the last |interval| seconds."""
+    self._disk_rates = _update_device_rates(
+        self._disk_rates, psutil.disk_io_counters(perdisk=True) or {},
+        _DISK_RATES, interval)
+    self._network_rates = _update_device_rates(
+        self._network_rates, psutil.net_io_counters(pernic=True) or {},
+        _NETWORK_RATES, interval)
+    self.cpu_iowait_percent = getattr(psutil.cpu_times_percent(), 'iowait',
+                                      0.0)
+
+    # Totals over all disks, which psutil computes without the partitions.
+    disk_io_counters = psutil.disk_io_counters()
+    if disk_io_counters:
+      self._disk_total.update(disk_io_counters, interval)
+      self.disk_read_bytes_per_sec = self._disk_total.last(
+          'read_bytes_per_second')
+      self.disk_write_bytes_per_sec = self._disk_total.last(
+          'write_bytes_per_second')
+    self.network_sent_bytes_per_sec = sum(
+        r.last('sent_bytes_per_second') for r in self._network_rates.values())
+    self.network_recv_bytes_per_sec = sum(
+        r.last('recv_bytes_per_second') for r in self._network_rates.values())
 
   @require_psutil()
   def _refresh_io_stats(self):
     """A call running in a thread to update IO stats periodically."""
-    prev_disk_io_counters = psutil.disk_io_counters()
-    prev_network_io_counters = psutil.net_io_counters()
+    self._disk_total = _CounterRates(_DISK_RATES, psutil.disk_io_counters())
+    self._disk_rates = _update_device_rates(
+        {}, psutil.disk_io_counters(perdisk=True) or {}, _DISK_RATES, None)
+    self._network_rates = _update_device_rates(
+        {}, psutil.net_io_counters(pernic=True) or {}, _NETWORK_RATES, None)
+    psutil.cpu_times_percent()
     prev_read_time = time.time()
     while True:
       time.sleep(STATS_INTERVAL)
       now = time.time()
       interval = now - prev_read_time
       prev_read_time = now
-      # Disk IO is for all disks.
-      disk_io_counters = psutil.disk_io_counters()
-      network_io_counters = psutil.net_io_counters()
-
-      self.disk_read_bytes_per_sec = (
-          disk_io_counters.read_bytes -
-          prev_disk_io_counters.read_bytes) / interval
-      self.disk_write_bytes_per_sec = (
-          disk_io_counters.write_bytes -
-          prev_disk_io_counters.write_bytes) / interval
-      prev_disk_io_counters = disk_io_counters
-
-      self.network_sent_bytes_per_sec = (
-          network_io_counters.bytes_sent -
-          prev_network_io_counters.bytes_sent) / interval
-      self.network_recv_bytes_per_sec = (
-          network_io_counters.bytes_recv -
-          prev_network_io_counters.bytes_recv) / interval
-      prev_network_io_counters = network_io_counters
+      try:
+        self._sample_io_stats(interval)
+      except Exception as e:  # pylint: disable=broad-except
+        _Log('Failed to sample the IO counters: %s', e)
 
   @require_psutil()
   def _start_io_stat_thread(self):
@@ -173,6 +387,37 @@ class Root(object):
     thread.daemon = True
     thread.start()
 
+  def _sample_process_stats(self):
+    """Counts the running processes reported by the health check."""
+    stats = _count_processes(psutil.process_iter(['cmdline']))
+    stats['au_process_count'] = _count_au_processes()
+    self._process_stats = stats
+
+  @require_psutil()
+  def _refresh_process_stats(self):
+    """A call running in a thread to update process counts periodically."""
+    while True:
+      try:
+        self._sample_process_stats()
+      except Exception as e:  # pylint: disable=broad-except
+        _Log('Failed to sample the running processes: %s', e)
+      time.sleep(PROCESS_STATS_INTERVAL)
+
+  @require_psutil()
+  def _start_process_stat_thread(self):
+    """Start the thread to sample the running processes."""
+    thread = threading.Thread(target=self._refresh_process_stats)
+    thread.daemon = True
+    thread.start()
+
+  def _get_process_stats(self):
+    """Get the process counts, sampled by psutil if possible."""
+    if self._process_stats is not None:
+      return self._process_stats
+    stats = _count_processes_with_pgrep()
+    stats['au_process_count'] = _count_au_processes()
+    return stats
+
   @cherrypy.expose
   def index(self):
     """Collect the health status of devserver to see if it's ready for staging.
@@ -185,23 +430,70 @@ class Root(object):
       apache_client_count (int): count of Apache processes.
       telemetry_test_count (int): count of telemetry tests.
       gsutil_count (int): count of gsutil processes.
+      resolution_cache (dict): hit/miss statistics of the devserver xBuddy
+                               and latest build resolution cache.
+      payload_cache (dict): hit/miss statistics of the update label to
+                            payload resolution cache.
+      thread_pool (dict): server thread pool size and the percentiles of the
+                          time accepted connections waited for a thread.
+      disks (dict): read and write rates and busy percent of each disk,
+                    averaged over the last 10s, 1m and 5m, with their peaks.
+      network_interfaces (dict): sent and received rates of each network
+                                 interface, over the same windows.
+      cpu_iowait_percent (float): CPU time spent waiting for IO.
+      load_average (list): 1, 5 and 15 minutes load averages.
+      staging_pipeline (dict): number of running and queued artifact staging
+                               jobs, and the count, errors, durations and
+                               queue waits of the jobs of each artifact.
+      worker_count (int): number of devserver worker processes, only in
+                          pre-fork mode, where the cache, thread pool and
+                          staging statistics are merged across the workers.
+
+      Process counts are sampled in the background every
+      PROCESS_STATS_INTERVAL seconds when psutil is installed.
     """
     # Get free disk space.
     stat = os.statvfs(self._static_dir)
     free_disk = stat.f_bsize * stat.f_bavail / _1G
-    apache_client_count = _get_process_count('bin/apache2? -k start')
-    telemetry_test_count = _get_process_count('python.*telemetry')
-    gsutil_count = _get_process_count('gsutil')
-    au_process_count = len(cros_update_progress.GetAllRunningAUProcess())
+
+    server_stats = self._devserver.server_stats
+    if self._worker_stats is not None:
+      server_stats = self._worker_stats.merge(server_stats)
 
     health_data = {
         'free_disk': free_disk,
         'staging_thread_count': self._devserver.staging_thread_count,
-        'apache_client_count': apache_client_count,
-        'telemetry_test_count': telemetry_test_count,
-        'gsutil_count': gsutil_count,
-        'au_process_count': au_process_count,
     }
+    health_data.update(server_stats)
+    health_data.update(self._get_process_stats())
     health_data.update(self._get_io_stats() or {})
 
     return json.dumps(health_data)
+
+  @cherrypy.expose
+  def metrics(self, format='prometheus'):  # pylint: disable=redefined-builtin
+    """Report the per-RPC request metrics of the devserver.
+
+    Args:
+      format: 'prometheus' for the Prometheus text exposition format, or
+              'json'.
+
+    Returns:
+      Request counts per status code, requests in flight, latency histograms
+      and response bytes of each RPC.
+    """
+    if self._rpc_metrics is None:
+      raise cherrypy.NotFound()
+    if format not in ('json', 'prometheus'):
+      raise cherrypy.HTTPError(400, 'Unknown metrics format %r.' % format)
+    metrics = self._rpc_metrics
+    if self._worker_stats is not None:
+      metrics = rpc_metrics.RpcMetrics.Merge(
+          self._worker_stats.collect_raw_stats())
+    if format == 'json':
+      cherrypy.response.headers['Content-Type'] = 'application/json'
+      # The encode tool leaves non-text content types alone.
+      return json.dumps(metrics.GetSnapshot()).encode('utf-8')
+    cherrypy.response.headers['Content-Type'] = (
+        rpc_metrics.PROMETHEUS_CONTENT_TYPE)
+    return metrics.FormatPrometheus()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for health_checker.py."""
+
+from __future__ import print_function
+
+import collections
+import re
+import unittest
+
+import mock
+
+import health_checker
+
+
+_DiskCounters = collections.namedtuple('_DiskCounters',
+                                       ['read_bytes', 'write_bytes'])
+
+
+class RateWindowTest(unittest.TestCase):
+  """Tests for the _RateWindow class."""
+
+  def testEmpty(self):
+    """Tests the summary of an empty window."""
+    summary = health_checker._RateWindow().summary()
+    self.assertEqual(summary['10s'], 0.0)
+    self.assertEqual(summary['peak_5m'], 0.0)
+
+  def testWindows(self):
+    """Tests averages and peaks over the windows, oldest rates dropped."""
+    window = health_checker._RateWindow()
+    for rate in [1000.0] * 10 + [0.0] * 20 + [60.0, 0.0, 0.0, 0.0, 0.0, 30.0]:
+      window.add(rate)
+    summary = window.summary()
+    self.assertEqual(window.last(), 30.0)
+    self.assertEqual(summary['10s'], 30.0)
+    self.assertNotIn('peak_10s', summary)
+    self.assertEqual(summary['1m'], 15.0)
+    self.assertEqual(summary['peak_1m'], 60.0)
+    # Only 4 samples of 1000 are still in the 30 samples of the buffer.
+    self.assertEqual(summary['5m'], 136.3)
+    self.assertEqual(summary['peak_5m'], 1000.0)
+
+
+class DeviceRatesTest(unittest.TestCase):
+  """Tests for _update_device_rates."""
+
+  def testDevices(self):
+    """Tests rates are computed per device as devices come and go."""
+    rates = health_checker._DISK_RATES
+    devices = health_checker._update_device_rates(
+        {}, {'sda': _DiskCounters(0, 0)}, rates, None)
+    self.assertEqual(devices['sda'].summary()['read_bytes_per_second']['10s'],
+                     0.0)
+    # busy_time is not in the counters, it is not reported.
+    self.assertNotIn('busy_percent', devices['sda'].summary())
+
+    same = health_checker._update_device_rates(
+        devices, {'sda': _DiskCounters(1000, 500)}, rates, 10)
+    self.assertIs(same, devices)
+    self.assertEqual(devices['sda'].last('read_bytes_per_second'), 100.0)
+    self.assertEqual(devices['sda'].last('write_bytes_per_second'), 50.0)
+
+    updated = health_checker._update_device_rates(
+        devices, {'sda': _DiskCounters(1000, 500),
+                  'sdb': _DiskCounters(42, 42)}, rates, 10)
+    self.assertIsNot(updated, devices)
+    self.assertEqual(updated['sda'].last('read_bytes_per_second'), 0.0)
+    self.assertEqual(updated['sdb'].last('read_bytes_per_second'), 0.0)
+
+    # A counter going back, e.g. after a device reset, is not a negative rate.
+    health_checker._update_device_rates(
+        updated, {'sda': _DiskCounters(0, 0), 'sdb': _DiskCounters(52, 42)},
+        rates, 10)
+    self.assertEqual(updated['sda'].last('read_bytes_per_second'), 0.0)
+    self.assertEqual(updated['sdb'].last('read_bytes_per_second'), 1.0)
+
+
+class _FakeProcess(object):
+  """A psutil.Process as returned by psutil.process_iter(['cmdline'])."""
+
+  def __init__(self, cmdline):
+    self.info = {'cmdline': cmdline}
+
+
+class ProcessCountTest(unittest.TestCase):
+  """Tests for the process counts."""
+
+  # Command lines with, for each field, whether pgrep -f counts them.
+  _CMDLINES = (
+      (['/usr/sbin/apache2', '-k', 'start'], ('apache_client_count',)),
+      (['/usr/bin/apache', '-k', 'start', '-X'], ('apache_client_count',)),
+      (['/usr/sbin/apache2', '-k', 'stop'], ()),
+      (['python', '/tmp/telemetry/run_tests'], ('telemetry_test_count',)),
+      (['/usr/bin/python2', '-c', 'import os\nimport telemetry'],
+       ('telemetry_test_count',)),
+      (['python3', 'gsutil', 'cp', 'gs://telemetry/a', '.'],
+       ('telemetry_test_count', 'gsutil_count')),
+      (['/usr/bin/gsutil', 'ls'], ('gsutil_count',)),
+      (['telemetry_python'], ()),
+      (['bash'], ()),
+      ([], ()),
+      (None, ()),
+  )
+
+  def testCountProcesses(self):
+    """Tests the counts are those of the pgrep patterns."""
+    counts = health_checker._count_processes(
+        _FakeProcess(cmdline) for cmdline, _ in self._CMDLINES)
+    expected = dict.fromkeys(
+        (name for name, _ in health_checker._PROCESS_PATTERNS), 0)
+    for cmdline, fields in self._CMDLINES:
+      for name, pattern in health_checker._PROCESS_PATTERNS:
+        # The reference: the pattern searched in the command line, as pgrep
+        # does it.
+        found = bool(cmdline) and bool(
+            re.search(pattern, ' '.join(cmdline), re.DOTALL))
+        self.assertEqual(found, name in fields, (name, cmdline))
+        expected[name] += found
+    self.assertEqual(counts, expected)
+    self.assertEqual(counts, {'apache_client_count': 2,
+                              'telemetry_test_count': 3,
+                              'gsutil_count': 2})
+
+  @mock.patch.object(health_checker, '_count_au_processes', return_value=1)
+  @mock.patch.object(health_checker, 'psutil', None)
+  def testPgrepFallback(self, _count_au_processes):
+    """Tests pgrep counts the processes when psutil is not installed."""
+    root = health_checker.Root(None, '/static')
+    with mock.patch('subprocess.Popen') as popen:
+      popen.return_value.communicate.return_value = (b'4\n', b'')
+      stats = root._get_process_stats()
+    self.assertEqual(
+        [c[0][0] for c in popen.call_args_list],
+        [['pgrep', '-fc', pattern]
+         for _, pattern in health_checker._PROCESS_PATTERNS])
+    self.assertEqual(stats, {'apache_client_count': 4,
+                             'telemetry_test_count': 4,
+                             'gsutil_count': 4,
+                             'au_process_count': 1})
+
+
+if __name__ == '__main__':
+  unittest.main()
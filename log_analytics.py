@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Offline analysis of rotated web server access logs.
+
+The metrics scripts (apache_log_metrics, gs_cache/nginx_access_log_metrics)
+stream the live log into counters. For capacity planning, Analyze() reads
+weeks of rotated logs instead, plain or gzipped, one file per process of a
+pool, using the same matchers as the live scripts through a parse function
+they provide.
+
+Parsed lines are stored in columns (compact arrays, one value per line) which
+are cheap to send back from the worker processes and to aggregate, and are
+summarized per hour and per endpoint class: number of requests, bytes, median
+and 99th percentile response sizes, cache hit ratio and bytes served to the
+lab.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import array
+import calendar
+import csv
+import gzip
+import io
+import json
+import multiprocessing
+import re
+import sys
+import time
+
+
+# Fields of the summaries, in the order of the CSV columns.
+SUMMARY_FIELDS = ('group', 'key', 'requests', 'bytes', 'p50_bytes',
+                  'p99_bytes', 'hit_ratio', 'lab_bytes')
+
+# Cache statuses counted as hits, e.g. nginx $upstream_cache_status.
+_CACHE_HITS = frozenset(['HIT', 'STALE', 'REVALIDATED', 'UPDATING'])
+
+_MONTHS = dict((name, i + 1) for i, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec']))
+
+# Start of the hour of the Apache (30/Jun/2016:15:34:40 -0700) or ISO 8601
+# (2018-07-26T18:13:49-07:00) timestamps, and their timezone.
+_APACHE_HOUR_MATCHER = re.compile(
+    r'^(\d+)/(\w{3})/(\d{4}):(\d+):\d+:\d+ ([+-])(\d\d):?(\d\d)$')
+_ISO_HOUR_MATCHER = re.compile(
+    r'^(\d{4})-(\d+)-(\d+)T(\d+):\d+:\d+(?:\.\d+)?(?:Z|([+-])(\d\d):?(\d\d))$')
+
+# Maximum number of memoized hours per process.
+_MAX_CACHED_HOURS = 100000
+
+
+class LogAnalyticsError(Exception):
+  """Exception class used by this module."""
+
+
+def ParseHour(timestamp):
+  """Returns the UTC epoch time of the start of the hour of |timestamp|.
+
+  Args:
+    timestamp: An Apache or ISO 8601 timestamp with its timezone offset.
+
+  Returns:
+    The number of seconds since the epoch, or None if |timestamp| is invalid.
+  """
+  m = _APACHE_HOUR_MATCHER.match(timestamp)
+  if m:
+    day, month, year, hour, sign, tz_hours, tz_minutes = m.groups()
+    month = _MONTHS.get(month)
+    if month is None:
+      return None
+  else:
+    m = _ISO_HOUR_MATCHER.match(timestamp)
+    if not m:
+      return None
+    year, month, day, hour, sign, tz_hours, tz_minutes = m.groups()
+  offset = 0
+  if sign:
+    offset = (int(tz_hours) * 60 + int(tz_minutes)) * 60
+    offset = -offset if sign == '-' else offset
+  try:
+    local = calendar.timegm((int(year), int(month), int(day), int(hour), 0, 0))
+  except ValueError:
+    return None
+  # Timezones with a minute offset put the hour boundary off the UTC one.
+  utc = local - offset
+  return utc - utc % 3600
+
+
+class LogColumns(object):
+  """Columns of the parsed lines of access logs.
+
+  Strings (endpoint classes and cache statuses) are stored as indices in a
+  table of distinct values.
+  """
+
+  def __init__(self):
+    self.hours = array.array('l')
+    self.sizes = array.array('l')
+    self.statuses = array.array('i')
+    self.endpoints = array.array('i')
+    self.cache_statuses = array.array('i')
+    # 1 for the lab, 0 out of it, -1 if unknown.
+    self.in_lab = array.array('b')
+    self.endpoint_names = []
+    self.cache_status_names = []
+    self._endpoint_ids = {}
+    self._cache_status_ids = {}
+    self._hours = {}
+
+  def __len__(self):
+    return len(self.sizes)
+
+  @staticmethod
+  def _Id(names, ids, value):
+    """Returns the index of |value| in |names|, appending it if needed."""
+    index = ids.get(value)
+    if index is None:
+      index = ids[value] = len(names)
+      names.append(value)
+    return index
+
+  def _EndpointId(self, endpoint):
+    return self._Id(self.endpoint_names, self._endpoint_ids, endpoint)
+
+  def _CacheStatusId(self, cache_status):
+    return self._Id(self.cache_status_names, self._cache_status_ids,
+                    cache_status)
+
+  def Append(self, timestamp, endpoint, size, status, cache_status, in_lab):
+    """Appends a parsed line.
+
+    Args:
+      timestamp: Timestamp of the request, see ParseHour.
+      endpoint: Class of the requested endpoint.
+      size: Size of the response in bytes.
+      status: HTTP status code of the response.
+      cache_status: Cache status of the response, '' if unknown.
+      in_lab: Whether the client is in the lab, None if unknown.
+
+    Returns:
+      False if the line was dropped because of an invalid timestamp.
+    """
+    # The hour only depends on the timestamp up to the hour and the timezone.
+    hour_key = timestamp[:14] + timestamp[-6:]
+    hour = self._hours.get(hour_key)
+    if hour is None:
+      hour = ParseHour(timestamp)
+      if hour is None:
+        return False
+      if len(self._hours) >= _MAX_CACHED_HOURS:
+        self._hours.clear()
+      self._hours[hour_key] = hour
+    self.hours.append(hour)
+    self.sizes.append(size)
+    self.statuses.append(status)
+    self.endpoints.append(self._EndpointId(endpoint))
+    self.cache_statuses.append(self._CacheStatusId(cache_status))
+    self.in_lab.append(-1 if in_lab is None else int(bool(in_lab)))
+    return True
+
+  def Extend(self, other):
+    """Appends the lines of the LogColumns |other|."""
+    endpoints = [self._EndpointId(n) for n in other.endpoint_names]
+    cache_statuses = [self._CacheStatusId(n) for n in other.cache_status_names]
+    self.hours.extend(other.hours)
+    self.sizes.extend(other.sizes)
+    self.statuses.extend(other.statuses)
+    self.endpoints.extend(array.array('i', (endpoints[i]
+                                            for i in other.endpoints)))
+    self.cache_statuses.extend(array.array(
+        'i', (cache_statuses[i] for i in other.cache_statuses)))
+    self.in_lab.extend(other.in_lab)
+
+  def __getstate__(self):
+    # The hour memo is not worth sending between processes.
+    state = dict(self.__dict__)
+    state['_hours'] = {}
+    return state
+
+
+def OpenLog(path):
+  """Opens a log file as text, decompressing it if its name ends in .gz."""
+  if path.endswith('.gz'):
+    return io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(path)),
+                            errors='replace')
+  return io.open(path, errors='replace')
+
+
+def ParseLog(path, parse_line):
+  """Parses the log file |path| into a LogColumns.
+
+  Args:
+    path: Path of the log file.
+    parse_line: A function taking a log line and returning None if the line
+      should be skipped, else a (timestamp, endpoint, size, status,
+      cache_status, in_lab) tuple, see LogColumns.Append.
+
+  Returns:
+    A LogColumns.
+  """
+  columns = LogColumns()
+  with OpenLog(path) as f:
+    for line in f:
+      record = parse_line(line)
+      if record is not None:
+        columns.Append(*record)
+  return columns
+
+
+def _ParseLog(args):
+  """Unpacks the arguments of ParseLog, for Pool.imap."""
+  return ParseLog(*args)
+
+
+def ParseLogs(paths, parse_line, jobs=None):
+  """Parses the log files |paths| into one LogColumns.
+
+  Args:
+    paths: Paths of the log files.
+    parse_line: The function parsing each line, see ParseLog. It must be
+      defined at the top level of a module to be sent to the worker processes.
+    jobs: Number of worker processes, defaults to the number of CPUs.
+
+  Returns:
+    A LogColumns, with the lines in the order of |paths|.
+  """
+  jobs = min(jobs or multiprocessing.cpu_count(), len(paths))
+  columns = LogColumns()
+  if jobs <= 1:
+    for path in paths:
+      columns.Extend(ParseLog(path, parse_line))
+    return columns
+
+  pool = multiprocessing.Pool(jobs)
+  try:
+    for parsed in pool.imap(_ParseLog, [(p, parse_line) for p in paths]):
+      columns.Extend(parsed)
+  finally:
+    pool.terminate()
+    pool.join()
+  return columns
+
+
+def _Percentile(sorted_values, percentile):
+  """Returns the nearest-rank |percentile| of a sorted non-empty list."""
+  rank = int(-(-percentile * len(sorted_values) // 100))
+  return sorted_values[max(rank, 1) - 1]
+
+
+def _Summarize(group, key, indices, columns):
+  """Returns the summary of the lines |indices| of |columns|."""
+  sizes = sorted(columns.sizes[i] for i in indices)
+  hits = cached = 0
+  lab_bytes = 0
+  lab_known = True
+  for i in indices:
+    cache_status = columns.cache_status_names[columns.cache_statuses[i]]
+    if cache_status and cache_status != '-':
+      cached += 1
+      hits += cache_status in _CACHE_HITS
+    in_lab = columns.in_lab[i]
+    if in_lab < 0:
+      lab_known = False
+    elif in_lab:
+      lab_bytes += columns.sizes[i]
+  return {
+      'group': group,
+      'key': key,
+      'requests': len(indices),
+      'bytes': sum(sizes),
+      'p50_bytes': _Percentile(sizes, 50),
+      'p99_bytes': _Percentile(sizes, 99),
+      'hit_ratio': round(hits / cached, 4) if cached else None,
+      'lab_bytes': lab_bytes if lab_known else None,
+  }
+
+
+def _HourName(hour):
+  return time.strftime('%Y-%m-%dT%H:00Z', time.gmtime(hour))
+
+
+def Summarize(columns):
+  """Summarizes parsed log lines per hour and per endpoint class.
+
+  Args:
+    columns: A LogColumns.
+
+  Returns:
+    A dictionary with the 'per_hour' and 'per_endpoint' lists of summaries,
+    dictionaries with the SUMMARY_FIELDS keys, sorted by hour and endpoint.
+  """
+  by_hour = {}
+  by_endpoint = {}
+  for i, (hour, endpoint) in enumerate(zip(columns.hours, columns.endpoints)):
+    by_hour.setdefault(hour, []).append(i)
+    by_endpoint.setdefault(endpoint, []).append(i)
+  return {
+      'per_hour': [_Summarize('hour', _HourName(hour), indices, columns)
+                   for hour, indices in sorted(by_hour.items())],
+      'per_endpoint': sorted(
+          (_Summarize('endpoint', columns.endpoint_names[endpoint], indices,
+                      columns)
+           for endpoint, indices in by_endpoint.items()),
+          key=lambda s: s['key']),
+  }
+
+
+def WriteSummary(summary, output, output_format):
+  """Writes |summary| to the file object |output|.
+
+  Args:
+    summary: The dictionary returned by Summarize.
+    output: A text file object.
+    output_format: 'json' or 'csv'. CSV puts both lists in one table, told
+      apart by the group column.
+  """
+  if output_format == 'json':
+    json.dump(summary, output, indent=2, sort_keys=True)
+    output.write('\n')
+  elif output_format == 'csv':
+    writer = csv.DictWriter(output, SUMMARY_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    for row in summary['per_hour'] + summary['per_endpoint']:
+      writer.writerow(dict((k, '' if v is None else v)
+                           for k, v in row.items()))
+  else:
+    raise LogAnalyticsError('Unknown output format %r.' % output_format)
+
+
+def AddArguments(parser):
+  """Adds the options of the offline analysis mode to an ArgumentParser."""
+  group = parser.add_argument_group(
+      'offline analysis',
+      'Summarize rotated log files per hour and per endpoint instead of '
+      'emitting metrics.')
+  group.add_argument('--analyze', nargs='+', metavar='LOG_FILE',
+                     help='Log files to analyze, plain or gzipped (.gz).')
+  group.add_argument('--format', choices=('json', 'csv'), default='json',
+                     help='Format of the summary (default: json).')
+  group.add_argument('--jobs', type=int, default=None,
+                     help='Number of parsing processes (default: one per '
+                     'CPU).')
+
+
+def Analyze(args, parse_line, output=None):
+  """Runs the offline analysis requested by the AddArguments options.
+
+  Args:
+    args: The parsed arguments.
+    parse_line: The function parsing each line, see ParseLogs.
+    output: The file object to write the summary to, defaults to stdout.
+  """
+  columns = ParseLogs(args.analyze, parse_line, jobs=args.jobs)
+  WriteSummary(Summarize(columns), output or sys.stdout, args.format)
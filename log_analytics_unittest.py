@@ -0,0 +1,151 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for log_analytics.py."""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import six
+
+import log_analytics
+
+
+def ParseTestLine(line):
+  """Parses 'timestamp endpoint size status cache_status in_lab' lines."""
+  fields = line.split()
+  if len(fields) != 6:
+    return None
+  timestamp, endpoint, size, status, cache_status, in_lab = fields
+  return (timestamp, endpoint, int(size), int(status), cache_status,
+          {'lab': True, 'out': False}.get(in_lab))
+
+
+_LOG = [
+    '2020-01-01T10:05:00+00:00 download 100 200 HIT lab',
+    '2020-01-01T10:59:59+00:00 download 300 200 MISS out',
+    'garbage',
+    '2020-01-01T12:00:00+01:00 extract 50 200 HIT lab',
+    '2020-01-01T11:30:00+00:00 extract 10 404 - lab',
+]
+
+
+class ParseHourTest(unittest.TestCase):
+  """Tests for ParseHour."""
+
+  def testFormats(self):
+    """Tests Apache and ISO 8601 timestamps in several timezones."""
+    hour = 1467324000  # 2016-06-30T22:00Z
+    for timestamp in ('30/Jun/2016:15:34:40 -0700',
+                      '30/Jun/2016:22:00:00 +0000', '2016-06-30T15:34:40-07:00',
+                      '2016-06-30T22:59:59Z',
+                      '2016-07-01T00:12:13.456+02:00'):
+      self.assertEqual(log_analytics.ParseHour(timestamp), hour, timestamp)
+
+  def testInvalid(self):
+    """Tests invalid timestamps."""
+    for timestamp in ('', '30/Foo/2016:15:34:40 -0700', '2016-13-30T15:34:40Z',
+                      'yesterday'):
+      self.assertIsNone(log_analytics.ParseHour(timestamp), timestamp)
+
+
+class LogColumnsTest(unittest.TestCase):
+  """Tests for the LogColumns class."""
+
+  def testAppendExtend(self):
+    """Tests appended lines survive merges and pickling."""
+    first = log_analytics.LogColumns()
+    self.assertTrue(first.Append(*ParseTestLine(_LOG[0])))
+    self.assertFalse(first.Append('never', 'download', 1, 200, '', None))
+    second = log_analytics.LogColumns()
+    for line in _LOG[3:]:
+      second.Append(*ParseTestLine(line))
+    first.Extend(pickle.loads(pickle.dumps(second)))
+
+    self.assertEqual(len(first), 3)
+    self.assertEqual(list(first.sizes), [100, 50, 10])
+    self.assertEqual([first.endpoint_names[i] for i in first.endpoints],
+                     ['download', 'extract', 'extract'])
+    self.assertEqual([first.cache_status_names[i]
+                      for i in first.cache_statuses], ['HIT', 'HIT', '-'])
+    self.assertEqual(list(first.in_lab), [1, 1, 1])
+    self.assertEqual(first.hours[1], first.hours[2])
+
+
+class AnalyzeTest(unittest.TestCase):
+  """Tests parsing log files and summarizing them."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='log_analytics')
+    self.plain = os.path.join(self.tempdir, 'access.log')
+    with open(self.plain, 'w') as f:
+      f.write('\n'.join(_LOG[:3]) + '\n')
+    self.gzipped = os.path.join(self.tempdir, 'access.log.1.gz')
+    with gzip.open(self.gzipped, 'wb') as f:
+      f.write(('\n'.join(_LOG[3:]) + '\n').encode('utf-8'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testParseLogs(self):
+    """Tests plain and gzipped files are parsed in parallel and in order."""
+    for jobs in (1, 2):
+      columns = log_analytics.ParseLogs([self.plain, self.gzipped],
+                                        ParseTestLine, jobs=jobs)
+      self.assertEqual(list(columns.sizes), [100, 300, 50, 10])
+
+  def testSummarize(self):
+    """Tests the per hour and per endpoint summaries."""
+    summary = log_analytics.Summarize(log_analytics.ParseLogs(
+        [self.plain, self.gzipped], ParseTestLine, jobs=1))
+    self.assertEqual([s['key'] for s in summary['per_hour']],
+                     ['2020-01-01T10:00Z', '2020-01-01T11:00Z'])
+    hour = summary['per_hour'][0]
+    self.assertEqual((hour['requests'], hour['bytes'], hour['p50_bytes'],
+                      hour['p99_bytes'], hour['hit_ratio'],
+                      hour['lab_bytes']), (2, 400, 100, 300, 0.5, 100))
+
+    download, extract = summary['per_endpoint']
+    self.assertEqual(download['key'], 'download')
+    self.assertEqual(extract['key'], 'extract')
+    self.assertEqual((extract['requests'], extract['bytes'],
+                      extract['hit_ratio'], extract['lab_bytes']),
+                     (2, 60, 1.0, 60))
+
+  def testAnalyze(self):
+    """Tests the JSON and CSV outputs."""
+    args = argparse.Namespace(analyze=[self.plain], jobs=1, format='json')
+    output = six.StringIO()
+    log_analytics.Analyze(args, ParseTestLine, output=output)
+    summary = json.loads(output.getvalue())
+    self.assertEqual(summary['per_endpoint'][0]['bytes'], 400)
+
+    args.format = 'csv'
+    output = six.StringIO()
+    log_analytics.Analyze(args, ParseTestLine, output=output)
+    lines = output.getvalue().splitlines()
+    self.assertEqual(lines[0], ','.join(log_analytics.SUMMARY_FIELDS))
+    self.assertEqual(lines[2], 'endpoint,download,2,400,100,300,0.5,100')
+
+  def testUnknownLab(self):
+    """Tests lab bytes are not reported when some clients are unknown."""
+    columns = log_analytics.LogColumns()
+    columns.Append('2020-01-01T10:05:00Z', 'download', 10, 200, '', None)
+    summary = log_analytics.Summarize(columns)
+    self.assertIsNone(summary['per_hour'][0]['lab_bytes'])
+    self.assertIsNone(summary['per_hour'][0]['hit_ratio'])
+
+
+if __name__ == '__main__':
+  unittest.main()
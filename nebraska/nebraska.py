@@ -11,23 +11,32 @@ from __future__ import print_function
 # pylint: disable=cros-logging-import
 import argparse
 import base64
-import copy
+import collections
+import ctypes
+import ctypes.util
 import datetime
 import errno
+import io
 import json
 import logging
 import os
+import re
+import select
 import shutil
 import signal
+import struct
 import sys
 import threading
 import traceback
 
 from xml.dom import minidom
 from xml.etree import ElementTree
+from xml.sax import saxutils
 
+import six
 from six.moves import BaseHTTPServer
 from six.moves import http_client
+from six.moves import socketserver
 from six.moves import urllib
 
 
@@ -38,6 +47,19 @@ _KERNEL_VER = '7'
 # This is the same for all images on canary channel.
 _CANARY_APP_ID = '{90F229CE-83E2-4FAF-8479-E368A34938B1}'
 
+# How often metadata directories are rescanned when they are watched without
+# inotify, in seconds.
+_METADATA_POLL_INTERVAL = 2.0
+
+# Requests larger than this are rejected before being parsed, update_engine
+# requests are a few hundred bytes per app.
+MAX_REQUEST_SIZE = 1024 * 1024
+
+# Path of the tenants API of multi-tenant servers, and prefix of the paths of
+# the requests to a tenant.
+_TENANTS_PATH = 'tenants'
+_TENANT_PATH_PREFIX = 't/'
+
 
 class Error(Exception):
   """The base class for failures raised by Nebraska."""
@@ -47,6 +69,23 @@ class InvalidRequestError(Error):
   """Raised for invalid requests."""
 
 
+class TenantError(Error):
+  """Raised for invalid tenant operations."""
+
+
+def _GetRejectionReason(request_str):
+  """Returns why a request is rejected before being parsed, None if it isn't.
+
+  Args:
+    request_str: XML-formatted request bytes.
+  """
+  if len(request_str) > MAX_REQUEST_SIZE:
+    return 'Request is larger than %d bytes.' % MAX_REQUEST_SIZE
+  if b'<!DOCTYPE' in request_str or b'<!ENTITY' in request_str:
+    return 'Requests can not declare a document type.'
+  return None
+
+
 class Request(object):
   """Request consisting of a list of apps to update/install."""
 
@@ -95,6 +134,9 @@ class Request(object):
     UPDATE = 2 # Request update for an existing app.
     EVENT = 3 # Just an event request.
 
+  __slots__ = ('request_str', 'version', 'track', 'board', 'request_type',
+               'timestamp', 'app_requests')
+
   def __init__(self, request_str):
     """Initializes a request instance.
 
@@ -129,11 +171,7 @@ class Request(object):
     Raises:
       InvalidRequestError if the request string is not a valid XML request.
     """
-    try:
-      request_root = ElementTree.fromstring(self.request_str)
-    except ElementTree.ParseError as err:
-      raise InvalidRequestError(
-          'Request string is not valid XML: %s' % err)
+    request_root = self._ParseXML(self.request_str)
 
     # TODO(http://crbug.com/914936): It would be better to specifically check
     # the platform app. An install is signalled by omitting the update_check for
@@ -155,9 +193,16 @@ class Request(object):
           'Client request omits update_check tag for more than one, but not all'
           ' app requests.')
 
+    # The values of the attributes which should be the same in all apps are
+    # collected while going through the apps.
+    all_attrs = {self.APP_VERSION_ATTR: set(), self.APP_CHANNEL_ATTR: set(),
+                 self.APP_BOARD_ATTR: set()}
     for app in app_elements:
       app_request = Request.AppRequest(app, self.request_type)
       self.app_requests.append(app_request)
+      all_attrs[self.APP_VERSION_ATTR].add(app_request.version)
+      all_attrs[self.APP_CHANNEL_ATTR].add(app_request.track)
+      all_attrs[self.APP_BOARD_ATTR].add(app_request.board)
 
     def _CheckAttributesAndReturnIt(attribute, in_all=False, ignore_value=None):
       """Checks the attribute integrity among all apps and return its value.
@@ -176,13 +221,12 @@ class Request(object):
         The value of the attribute. If no valid attribute value is found,
         ignore_value will be returned.
       """
-      all_attrs = [getattr(x, attribute) for x in self.app_requests]
-      if in_all and (ignore_value in all_attrs):
+      if in_all and (ignore_value in all_attrs[attribute]):
         raise InvalidRequestError(
             'All apps should have "%s" attribute.' % attribute)
 
       # Filter out non-ignore_value elements into a set.
-      unique_attrs = set(x for x in all_attrs if x != ignore_value)
+      unique_attrs = all_attrs[attribute] - {ignore_value}
       if not unique_attrs:
         # If no app had the attribute, we can just return the invalid one as it
         # was the only one.
@@ -210,6 +254,29 @@ class Request(object):
       raise InvalidRequestError('Either track(%s) or board(%s) attributes are '
                                 'empty in all apps.' % (self.track, self.board))
 
+  @staticmethod
+  def _ParseXML(request_str):
+    """Parses a request string into the root element of the request.
+
+    Requests are small, so the malicious or broken ones are rejected before
+    being parsed: the ones which are too large, and the ones with a document
+    type declaration, which could declare entities expanding to huge strings.
+
+    Raises:
+      InvalidRequestError if the request is rejected or is not valid XML.
+    """
+    if isinstance(request_str, six.text_type):
+      request_str = request_str.encode('utf-8')
+    reason = _GetRejectionReason(request_str)
+    if reason:
+      raise InvalidRequestError(reason)
+
+    try:
+      return ElementTree.fromstring(request_str)
+    except ElementTree.ParseError as err:
+      raise InvalidRequestError(
+          'Request string is not valid XML: %s' % err)
+
   def GetDict(self):
     """Returns a dictionary with some parameters of the request.
 
@@ -222,7 +289,7 @@ class Request(object):
     # TODO(ahassani): Extend this to return an object for all App Requests. For
     # now only can return the first one to be backward compatible with auto
     # update auto tests.
-    result = self.app_requests[0].__dict__
+    result = self.app_requests[0].ToDict()
 
     # Auto tests require an additional timestamp value which can be considered
     # as a Request wide varable and not App Request one. So set it here.
@@ -239,6 +306,10 @@ class Request(object):
     An app request can also send pings and event result information.
     """
 
+    __slots__ = ('request_type', 'appid', 'version', 'track', 'board', 'ping',
+                 'delta_okay', 'event_type', 'event_result', 'previous_version',
+                 'rollback_allowed', 'has_update_check')
+
     def __init__(self, app, request_type):
       """Initializes a Request.
 
@@ -250,18 +321,6 @@ class Request(object):
         https://github.com/google/omaha/blob/master/doc/ServerProtocolV3.md
       """
       self.request_type = request_type
-      self.appid = None
-      self.version = None
-      self.track = None
-      self.board = None
-      self.ping = None
-      self.delta_okay = None
-      self.event_type = None
-      self.event_result = None
-      self.previous_version = None
-      self.rollback_allowed = None
-      self.has_update_check = False
-
       self.ParseApp(app)
 
     def __str__(self):
@@ -274,6 +333,10 @@ class Request(object):
         return '%s update %s from v%s' % (
             'delta' if self.delta_okay else 'full', self.appid, self.version)
 
+    def ToDict(self):
+      """Returns a new dictionary with the fields of the app request."""
+      return {name: getattr(self, name) for name in self.__slots__}
+
     def ParseApp(self, app):
       """Parses the app XML element and populates the self object.
 
@@ -300,6 +363,10 @@ class Request(object):
         self.event_type = int(event.get(Request.EVENT_TYPE_ATTR))
         self.event_result = int(event.get(Request.EVENT_RESULT_ATTR, 0))
         self.previous_version = event.get(Request.EVENT_PREVIOUS_VERSION_ATTR)
+      else:
+        self.event_type = None
+        self.event_result = None
+        self.previous_version = None
 
       self.ping = app.find(Request.PING_TAG) is not None
 
@@ -353,6 +420,139 @@ class Request(object):
       return False
 
 
+def _GetDayStart():
+  """Returns the elapsed days and seconds of the response daystart tag."""
+  curr = datetime.datetime.now()
+  # Jan 1 2007 is the start of Omaha v3 epoch:
+  # https://github.com/google/omaha/blob/master/doc/ServerProtocolV3.md#attributes-12
+  elapsed_days = (curr - datetime.datetime(2007, 1, 1)).days
+  elapsed_seconds = int((
+      curr - datetime.datetime.combine(curr.date(),
+                                       datetime.time.min)).total_seconds())
+  return elapsed_days, elapsed_seconds
+
+
+class EventAck(object):
+  """Acknowledges event requests without building a Request and a Response.
+
+  update_engine sends several event requests per update, and they only need an
+  acknowledgement of each app, ping and event. Requests with an updatecheck tag
+  are left to Request right away. The apps of the others are checked while the
+  request is parsed incrementally, the parsing stops as soon as something shows
+  that the request is not a valid event request, and the response is filled in
+  a precomputed template. The response is the same as the one Nebraska would
+  send, pretty printed.
+  """
+
+  _HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<response protocol="3.0" server="nebraska">\n'
+             '  <daystart elapsed_days="%d" elapsed_seconds="%d"/>\n')
+  _APP_START = '  <app appid="%s" status="ok">\n'
+  _APP_EMPTY = '  <app appid="%s" status="ok"/>\n'
+  _PING = '    <ping status="ok"/>\n'
+  _EVENT = '    <event status="ok"/>\n'
+  _APP_END = '  </app>\n'
+  _FOOTER = '</response>\n'
+
+  _UPDATE_CHECK_START = b'<' + Request.UPDATE_CHECK_TAG.encode('utf-8')
+
+  # Characters escaped in attribute values, as minidom does.
+  _ATTR_ENTITIES = {'"': '&quot;'}
+
+  @staticmethod
+  def _ParseApps(request_str):
+    """Returns the (appid, ping, event) of each app of an event request.
+
+    Returns:
+      The list of the apps, or None if the request is not an event request or
+      is invalid, in which case Request reports why.
+    """
+    # pylint: disable=protected-access
+    apps = []
+    versions = set()
+    tracks = set()
+    boards = set()
+    app = None
+    depth = 0
+    try:
+      for event, element in ElementTree.iterparse(io.BytesIO(request_str),
+                                                  events=('start', 'end')):
+        if event == 'end':
+          depth -= 1
+          if depth == 1 and app is not None:
+            apps.append(tuple(app))
+            app = None
+          element.clear()
+          continue
+
+        depth += 1
+        if element.tag == Request.UPDATE_CHECK_TAG:
+          return None
+        if depth == 2 and element.tag == Request.APP_TAG:
+          appid = element.get(Request.APP_APPID_ATTR)
+          version = element.get(Request.APP_VERSION_ATTR)
+          if appid is None or version is None:
+            return None
+          if version != Request._VERSION_ZERO:
+            versions.add(version)
+          tracks.add(element.get(Request.APP_CHANNEL_ATTR))
+          boards.add(element.get(Request.APP_BOARD_ATTR))
+          app = [appid, False, False]
+        elif depth == 3 and app is not None:
+          if element.tag == Request.PING_TAG:
+            app[1] = True
+          elif element.tag == Request.EVENT_TAG and not app[2]:
+            int(element.get(Request.EVENT_TYPE_ATTR))
+            int(element.get(Request.EVENT_RESULT_ATTR, 0))
+            app[2] = True
+    except (ElementTree.ParseError, TypeError, ValueError):
+      return None
+
+    tracks.discard(None)
+    boards.discard(None)
+    if (not apps or len(versions) > 1 or len(tracks) != 1 or
+        len(boards) != 1):
+      return None
+    return apps
+
+  @classmethod
+  def GetResponse(cls, request_str):
+    """Returns the response to an event request.
+
+    Args:
+      request_str: XML-formatted request string.
+
+    Returns:
+      The response as Nebraska.GetResponseToRequest returns it, or None if the
+      request is not a valid event request and has to go through Request.
+    """
+    if isinstance(request_str, six.text_type):
+      request_str = request_str.encode('utf-8')
+    # Most other requests are update checks, don't even parse them. Neither
+    # parse the requests Request rejects.
+    if (cls._UPDATE_CHECK_START in request_str or
+        _GetRejectionReason(request_str)):
+      return None
+    apps = cls._ParseApps(request_str)
+    if apps is None:
+      return None
+
+    response = [cls._HEADER % _GetDayStart()]
+    for appid, ping, event in apps:
+      appid = saxutils.escape(appid, cls._ATTR_ENTITIES)
+      if not ping and not event:
+        response.append(cls._APP_EMPTY % appid)
+        continue
+      response.append(cls._APP_START % appid)
+      if ping:
+        response.append(cls._PING)
+      if event:
+        response.append(cls._EVENT)
+      response.append(cls._APP_END)
+    response.append(cls._FOOTER)
+    return ''.join(response).encode('utf-8')
+
+
 class Response(object):
   """An update/install response.
 
@@ -375,13 +575,7 @@ class Response(object):
     self._nebraska_props = nebraska_props
     self._response_props = response_props
 
-    curr = datetime.datetime.now()
-    # Jan 1 2007 is the start of Omaha v3 epoch:
-    # https://github.com/google/omaha/blob/master/doc/ServerProtocolV3.md#attributes-12
-    self._elapsed_days = (curr - datetime.datetime(2007, 1, 1)).days
-    self._elapsed_seconds = int((
-        curr - datetime.datetime.combine(curr.date(),
-                                         datetime.time.min)).total_seconds())
+    self._elapsed_days, self._elapsed_seconds = _GetDayStart()
 
   def GetXMLString(self):
     """Generates a response to a set of client requests.
@@ -569,18 +763,51 @@ class AppIndex(object):
   index is built by scanning a given directory for json files that describe the
   available payloads.
 
+  The index can be refreshed when the directory changes (see MetadataWatcher).
+  A refresh builds a new list and swaps it in, so that requests being answered
+  keep using the list they started with and never need a lock.
+
   Attributes:
     _directory: Directory containing metdata and payloads, can be None.
     _index: A list of AppData describing payloads.
+    _entries: An ordered dictionary of the names of the loaded metadata files
+        to their stat key and AppData, only modified with _lock held.
+    _failures: A dictionary of the names of the metadata files which failed to
+        load to their stat key, so they are only retried once modified.
+    generation: Number of times the index changed since the initial scan.
   """
 
   def __init__(self, directory):
     """Initializes an AppIndex instance."""
     self._directory = directory
     self._index = []
+    self._entries = collections.OrderedDict()
+    self._failures = {}
+    self._lock = threading.Lock()
+    self.generation = 0
 
     self._Scan()
 
+  @property
+  def directory(self):
+    """Returns the directory of the metadata files."""
+    return self._directory
+
+  @staticmethod
+  def _StatKey(path):
+    """Returns what changes when the file at |path| is modified."""
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime
+
+  def _LoadApp(self, name):
+    """Returns the AppData of the metadata file |name| of the directory."""
+    with open(os.path.join(self._directory, name), 'r') as metafile:
+      metadata = json.loads(metafile.read())
+    # Get the name from file name itself, assuming the metadata file ends with
+    # '.json'.
+    metadata[AppIndex.AppData.NAME_KEY] = name[:-len('.json')]
+    return AppIndex.AppData(metadata)
+
   def _Scan(self):
     """Scans the directory and loads all available properties files."""
     if self._directory is None:
@@ -589,18 +816,74 @@ class AppIndex(object):
     for f in os.listdir(self._directory):
       if f.endswith('.json'):
         try:
-          with open(os.path.join(self._directory, f), 'r') as metafile:
-            metadata_str = metafile.read()
-            metadata = json.loads(metadata_str)
-            # Get the name from file name itself, assuming the metadata file
-            # ends with '.json'.
-            metadata[AppIndex.AppData.NAME_KEY] = f[:-len('.json')]
-            app = AppIndex.AppData(metadata)
-            self._index.append(app)
-        except (IOError, KeyError, ValueError) as err:
+          stat_key = self._StatKey(os.path.join(self._directory, f))
+          app = self._LoadApp(f)
+        except (IOError, OSError, KeyError, ValueError) as err:
           logging.error('Failed to read app data from %s (%s)', f, str(err))
           raise
+        self._entries[f] = (stat_key, app)
         logging.debug('Found app data: %s', str(app))
+    self._index = [app for _, app in self._entries.values()]
+
+  def Refresh(self, names=None):
+    """Reloads the metadata files which were added, modified or removed.
+
+    Files which fail to load, e.g. because they are still being written, are
+    logged and left out: the previous version of a modified file stays in the
+    index until the file loads again.
+
+    Args:
+      names: The names of the files of the directory to check, all of them if
+          None.
+
+    Returns:
+      True if the index changed.
+    """
+    if self._directory is None:
+      return False
+
+    with self._lock:
+      if names is None:
+        try:
+          names = set(os.listdir(self._directory))
+        except OSError as err:
+          logging.error('Failed to list %s (%s)', self._directory, err)
+          return False
+        names.update(self._entries)
+
+      entries = collections.OrderedDict(self._entries)
+      changed = False
+      for name in sorted(x for x in names if x.endswith('.json')):
+        try:
+          stat_key = self._StatKey(os.path.join(self._directory, name))
+        except OSError:
+          self._failures.pop(name, None)
+          if entries.pop(name, None):
+            logging.info('Removed app data of %s', name)
+            changed = True
+          continue
+
+        entry = entries.get(name)
+        if ((entry and entry[0] == stat_key) or
+            self._failures.get(name) == stat_key):
+          continue
+        try:
+          app = self._LoadApp(name)
+        except (IOError, KeyError, ValueError) as err:
+          logging.error('Failed to read app data from %s (%s)', name, str(err))
+          self._failures[name] = stat_key
+          continue
+        self._failures.pop(name, None)
+        entries[name] = (stat_key, app)
+        changed = True
+        logging.info('Loaded app data: %s', str(app))
+
+      if not changed:
+        return False
+      self._entries = entries
+      self._index = [app for _, app in entries.values()]
+      self.generation += 1
+      return True
 
   def Find(self, request, matched_apps, full_payload, ignore_appid=False):
     """Search the index for a given appid.
@@ -622,14 +905,17 @@ class AppIndex(object):
       request, or None if no matches are found. Prefer delta payloads if the
       client can accept them and if one is available.
     """
+    # The index can be swapped by Refresh, use the same one all along.
+    index = self._index
+
     # Find a list of payloads exactly matching the client request.
-    matches = [app_data for app_data in self._index if
+    matches = [app_data for app_data in index if
                request.MatchAppData(app_data)]
 
     # Check to see if the incoming requests where from a canary channel (mostly
     # a test image).
     if not matches:
-      matches = [app_data for app_data in self._index if
+      matches = [app_data for app_data in index if
                  request.MatchAppData(app_data, check_against_canary=True)]
 
     if not matches:
@@ -641,11 +927,11 @@ class AppIndex(object):
       # The reason we just don't do this in one pass is that we want to find all
       # the matches with exact appid and iif there was no match, we do the appid
       # partial match.
-      matches = [app_data for app_data in self._index if
+      matches = [app_data for app_data in index if
                  request.MatchAppData(app_data, partial_match_appid=True)]
 
     if not matches and ignore_appid:
-      matches = [app_data for app_data in self._index if
+      matches = [app_data for app_data in index if
                  request.MatchAppData(app_data, ignore_appid=True)]
 
     # Now remove App ID matches that have already been matched by other
@@ -674,7 +960,9 @@ class AppIndex(object):
     # Add this App data to the list of already matched ones.
     matched_apps.add(match)
 
-    return copy.copy(match)
+    # AppData are immutable, so the indexed instance can be shared by all the
+    # requests.
+    return match
 
   class AppData(object):
     """Data about an available app.
@@ -682,6 +970,7 @@ class AppIndex(object):
     Data about an available app that can be either installed or upgraded
     to. This information is compiled into XML format and returned to the client
     in an app tag in the server's response to an update or install request.
+    AppData are immutable once initialized.
 
     Attributes:
       appid: App ID of the requested app.
@@ -709,6 +998,10 @@ class AppIndex(object):
     SHA256_HEX_KEY = 'sha256_hex'
     PUBLIC_KEY_RSA_KEY = 'public_key'
 
+    __slots__ = ('appid', 'canary_appid', 'name', 'target_version', 'is_delta',
+                 'source_version', 'size', 'metadata_signature',
+                 'metadata_size', 'public_key', 'sha256', 'sha256_hex')
+
     def __init__(self, app_data):
       """Initialize AppData.
 
@@ -716,33 +1009,45 @@ class AppIndex(object):
         app_data: Dictionary containing attributes used to initialize AppData
             instance.
       """
-      self.appid = app_data[self.APPID_KEY]
+      def set_attr(name, value):
+        # Attributes can only be set here, see __setattr__.
+        object.__setattr__(self, name, value)
+
+      appid = app_data[self.APPID_KEY]
+      set_attr('appid', appid)
       # Replace the begining of the App ID with the canary version.
-      self.canary_appid = ''
-      if len(self.appid) >= len(_CANARY_APP_ID):
-        self.canary_appid = (_CANARY_APP_ID +
-                             self.appid[len(_CANARY_APP_ID):])
-      self.name = app_data[self.NAME_KEY]
-      self.target_version = app_data[self.TARGET_VERSION_KEY]
-      self.is_delta = app_data[self.IS_DELTA_KEY]
-      self.source_version = (
-          app_data[self.SOURCE_VERSION_KEY] if self.is_delta else None)
-      self.size = app_data[self.SIZE_KEY]
+      canary_appid = ''
+      if len(appid) >= len(_CANARY_APP_ID):
+        canary_appid = _CANARY_APP_ID + appid[len(_CANARY_APP_ID):]
+      set_attr('canary_appid', canary_appid)
+      set_attr('name', app_data[self.NAME_KEY])
+      set_attr('target_version', app_data[self.TARGET_VERSION_KEY])
+      is_delta = app_data[self.IS_DELTA_KEY]
+      set_attr('is_delta', is_delta)
+      set_attr('source_version',
+               app_data[self.SOURCE_VERSION_KEY] if is_delta else None)
+      set_attr('size', app_data[self.SIZE_KEY])
       # Sometimes the payload is not signed, hence the matadata signature is
       # null, but we should pass empty string instead of letting the value be
       # null (the XML element tree will break).
-      self.metadata_signature = app_data[self.METADATA_SIG_KEY] or ''
-      self.metadata_size = app_data[self.METADATA_SIZE_KEY]
-      self.public_key = app_data.get(self.PUBLIC_KEY_RSA_KEY)
+      set_attr('metadata_signature', app_data[self.METADATA_SIG_KEY] or '')
+      set_attr('metadata_size', app_data[self.METADATA_SIZE_KEY])
+      set_attr('public_key', app_data.get(self.PUBLIC_KEY_RSA_KEY))
       # Unfortunately the sha256_hex that paygen generates is actually a base64
       # sha256 hash of the payload for some unknown historical reason. But the
       # Omaha response contains the hex value of that hash. So here convert the
       # value from base64 to hex so nebraska can send the correct version to the
       # client. See b/131762584.
-      self.sha256 = app_data[self.SHA256_HEX_KEY]
-      self.sha256_hex = base64.b16encode(
-          base64.b64decode(self.sha256)).decode('utf-8')
-      self.url = None # Determined per-request.
+      sha256 = app_data[self.SHA256_HEX_KEY]
+      set_attr('sha256', sha256)
+      set_attr('sha256_hex',
+               base64.b16encode(base64.b64decode(sha256)).decode('utf-8'))
+
+    def __setattr__(self, name, value):
+      raise AttributeError('AppData are immutable, can not set %s' % name)
+
+    def __delattr__(self, name):
+      raise AttributeError('AppData are immutable, can not delete %s' % name)
 
     def __str__(self):
       if self.is_delta:
@@ -752,6 +1057,241 @@ class AppIndex(object):
           self.appid, self.target_version)
 
 
+class _Inotify(object):
+  """Minimal ctypes binding of the Linux inotify API."""
+
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_DELETE = 0x00000200
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_CLOEXEC = 0o2000000
+
+  # struct inotify_event without the name which follows it.
+  _EVENT = struct.Struct('iIII')
+
+  def __init__(self):
+    """Initializes an inotify instance.
+
+    Raises:
+      AttributeError or OSError if inotify is not available.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self._inotify_add_watch = libc.inotify_add_watch
+    self._inotify_rm_watch = libc.inotify_rm_watch
+    self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+  def AddWatch(self, path, mask):
+    """Watches the events |mask| of |path| and returns the watch descriptor."""
+    if isinstance(path, six.text_type):
+      path = path.encode('utf-8')
+    wd = self._inotify_add_watch(self.fd, path, mask)
+    if wd < 0:
+      errno_value = ctypes.get_errno()
+      raise OSError(errno_value, os.strerror(errno_value), path)
+    return wd
+
+  def RemoveWatch(self, wd):
+    """Removes the watch |wd|, an IN_IGNORED event follows."""
+    self._inotify_rm_watch(self.fd, wd)
+
+  def ReadEvents(self):
+    """Reads the pending events, blocks if there are none.
+
+    Returns:
+      A list of (watch descriptor, mask, name) tuples.
+    """
+    data = os.read(self.fd, 64 * 1024)
+    events = []
+    offset = 0
+    while offset + self._EVENT.size <= len(data):
+      wd, mask, _, name_len = self._EVENT.unpack_from(data, offset)
+      offset += self._EVENT.size
+      name = data[offset:offset + name_len].rstrip(b'\0')
+      offset += name_len
+      events.append((wd, mask, name.decode('utf-8', 'replace')))
+    return events
+
+  def Close(self):
+    """Closes the inotify instance and removes all its watches."""
+    os.close(self.fd)
+
+
+class MetadataWatcher(object):
+  """Keeps app indexes up to date with their metadata directories.
+
+  Directories are watched with inotify, and only the metadata files which were
+  written, moved or deleted are reloaded. Where inotify is not available, or
+  when a watched directory goes away, directories are rescanned periodically
+  instead. App indexes can be added and removed while watching, see Watch and
+  Unwatch.
+  """
+
+  _INOTIFY_MASK = (_Inotify.IN_CLOSE_WRITE | _Inotify.IN_MOVED_FROM |
+                   _Inotify.IN_MOVED_TO | _Inotify.IN_DELETE)
+
+  def __init__(self, app_indexes, poll_interval=_METADATA_POLL_INTERVAL,
+               use_inotify=True):
+    """Initializes a MetadataWatcher.
+
+    Args:
+      app_indexes: The AppIndex instances to keep up to date. The ones without
+          a directory are ignored.
+      poll_interval: Seconds between the rescans of the directories which are
+          not watched with inotify.
+      use_inotify: False to always rescan the directories.
+    """
+    self._app_indexes = [x for x in app_indexes if x.directory is not None]
+    self._poll_interval = poll_interval
+    self._use_inotify = use_inotify
+    self._inotify = None
+    # Watch descriptors to the AppIndex of the watched directory.
+    self._watches = {}
+    self._polled = []
+    # Held while modifying the watched app indexes.
+    self._lock = threading.Lock()
+    self._stop_event = threading.Event()
+    self._wake_read_fd, self._wake_write_fd = None, None
+    self._thread = None
+    self.mode = None
+
+  def _StartInotify(self):
+    """Watches the directories with inotify, returns whether it succeeded."""
+    try:
+      self._inotify = _Inotify()
+      for app_index in self._app_indexes:
+        wd = self._inotify.AddWatch(app_index.directory, self._INOTIFY_MASK)
+        self._watches[wd] = app_index
+    except (AttributeError, OSError) as err:
+      logging.warning('Can not watch metadata with inotify, rescanning every '
+                      '%s seconds instead (%s)', self._poll_interval, err)
+      if self._inotify:
+        self._inotify.Close()
+      self._inotify = None
+      self._watches = {}
+      return False
+    return True
+
+  def Start(self):
+    """Starts watching the directories."""
+    with self._lock:
+      if self._use_inotify and self._StartInotify():
+        self.mode = 'inotify'
+        self._polled = []
+      else:
+        self.mode = 'poll'
+        self._polled = list(self._app_indexes)
+      self._wake_read_fd, self._wake_write_fd = os.pipe()
+
+      # Catch up with the changes made before the directories were watched.
+      for app_index in self._app_indexes:
+        app_index.Refresh()
+
+    self._thread = threading.Thread(target=self._Run,
+                                    name='nebraska-metadata-watcher')
+    self._thread.daemon = True
+    self._thread.start()
+    logging.info('Watching metadata directories (%s): %s', self.mode,
+                 ', '.join(x.directory for x in self._app_indexes))
+
+  def Stop(self):
+    """Stops watching the directories."""
+    if not self._thread:
+      return
+    self._stop_event.set()
+    os.write(self._wake_write_fd, b'x')
+    self._thread.join()
+    self._thread = None
+    if self._inotify:
+      self._inotify.Close()
+      self._inotify = None
+    os.close(self._wake_read_fd)
+    os.close(self._wake_write_fd)
+
+  def Watch(self, app_index):
+    """Keeps |app_index| up to date too, from now on."""
+    if app_index.directory is None:
+      return
+    with self._lock:
+      self._app_indexes.append(app_index)
+      if not self.mode:
+        # Start watches it with the others.
+        return
+      if self._inotify:
+        try:
+          wd = self._inotify.AddWatch(app_index.directory, self._INOTIFY_MASK)
+          self._watches[wd] = app_index
+          return
+        except OSError as err:
+          logging.warning('Can not watch %s with inotify, rescanning it every '
+                          '%s seconds instead (%s)', app_index.directory,
+                          self._poll_interval, err)
+      self._polled.append(app_index)
+
+  def Unwatch(self, app_index):
+    """Stops keeping |app_index| up to date."""
+    with self._lock:
+      self._app_indexes = [x for x in self._app_indexes if x is not app_index]
+      self._polled = [x for x in self._polled if x is not app_index]
+      for wd, watched_index in list(self._watches.items()):
+        if watched_index is app_index:
+          del self._watches[wd]
+          self._inotify.RemoveWatch(wd)
+
+  def _HandleEvents(self):
+    """Refreshes the app indexes the pending inotify events are about."""
+    # AppIndex to the names of the files to check, None to check all of them.
+    changes = {}
+    events = self._inotify.ReadEvents()
+    with self._lock:
+      for wd, mask, name in events:
+        if mask & _Inotify.IN_Q_OVERFLOW:
+          logging.warning('Missed metadata changes, rescanning all '
+                          'directories.')
+          changes = dict.fromkeys(self._watches.values())
+          continue
+        # Events of removed watches are ignored.
+        app_index = self._watches.get(wd)
+        if app_index is None:
+          continue
+        if mask & _Inotify.IN_IGNORED:
+          logging.warning('%s is not watched anymore, rescanning it every %s '
+                          'seconds instead.', app_index.directory,
+                          self._poll_interval)
+          del self._watches[wd]
+          self._polled.append(app_index)
+          continue
+        names = changes.setdefault(app_index, set())
+        if names is not None:
+          names.add(name)
+
+    for app_index, names in changes.items():
+      app_index.Refresh(names)
+
+  def _Run(self):
+    """Waits for changes and refreshes the app indexes until stopped."""
+    while not self._stop_event.is_set():
+      fds = [self._wake_read_fd]
+      if self._inotify:
+        fds.append(self._inotify.fd)
+      readable, _, _ = select.select(fds, [], [], self._poll_interval)
+      if self._stop_event.is_set():
+        return
+      try:
+        if self._inotify and self._inotify.fd in readable:
+          self._HandleEvents()
+        with self._lock:
+          polled = list(self._polled)
+        for app_index in polled:
+          app_index.Refresh()
+      except Exception:
+        logging.error('Failed to refresh the metadata: %s',
+                      traceback.format_exc())
+
+
 class NebraskaProperties(object):
   """An instance of this class contains Nebraska properties.
 
@@ -763,7 +1303,9 @@ class NebraskaProperties(object):
                install_payloads_address=None,
                update_metadata_dir=None,
                install_metadata_dir=None,
-               ignore_appid=False):
+               ignore_appid=False,
+               update_app_index=None,
+               install_app_index=None):
     """Initializes the NebraskaProperties instance.
 
     Args:
@@ -774,6 +1316,10 @@ class NebraskaProperties(object):
       install_metadata_dir: Install payloads metadata directory.
       ignore_appid: True to ignore the request's App ID and use the first
         available app.
+      update_app_index: An AppIndex to use instead of scanning
+        update_metadata_dir, e.g. one shared with other Nebraska instances.
+      install_app_index: An AppIndex to use instead of scanning
+        install_metadata_dir.
     """
     # Attach '/' at the end of the addresses if they don't have any. The update
     # engine just concatenates the base address with the payload file name and
@@ -783,8 +1329,9 @@ class NebraskaProperties(object):
     self.install_payloads_address = (
         os.path.join(install_payloads_address or '', '') or
         self.update_payloads_address)
-    self.update_app_index = AppIndex(update_metadata_dir)
-    self.install_app_index = AppIndex(install_metadata_dir)
+    self.update_app_index = update_app_index or AppIndex(update_metadata_dir)
+    self.install_app_index = (install_app_index or
+                              AppIndex(install_metadata_dir))
     self.ignore_appid = ignore_appid
 
 
@@ -872,6 +1419,11 @@ class Nebraska(object):
     """Returns the request logs in JSON format."""
     return json.dumps(self._request_log).encode('utf-8')
 
+  def GetMetadataGenerations(self):
+    """Returns the generations of the update and install app indexes."""
+    return (self._nebraska_props.update_app_index.generation,
+            self._nebraska_props.install_app_index.generation)
+
 
 def QueryDictToDict(query):
   """Converts the query string generated dict to a proper one.
@@ -907,6 +1459,175 @@ def QueryDictToDict(query):
       kwargs[k] = t(value[0] if isinstance(value, list) else value)
   return kwargs
 
+
+class Tenants(object):
+  """The tenants of a multi-tenant nebraska server.
+
+  Every tenant has its own Nebraska, and so its own request log and response
+  properties, so that a single server can answer the requests of many DUTs or
+  tests. The app indexes of the metadata directories are shared by all the
+  tenants using them, and dropped once no tenant uses them anymore.
+  """
+
+  _TENANT_ID_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+  # The properties of a tenant which are NebraskaProperties arguments, the
+  # ResponseProperties arguments are under 'response_properties'.
+  _NEBRASKA_PROPERTIES = ('update_payloads_address', 'install_payloads_address',
+                          'update_metadata_dir', 'install_metadata_dir',
+                          'ignore_appid')
+  _RESPONSE_PROPERTIES = 'response_properties'
+
+  Tenant = collections.namedtuple(
+      'Tenant',
+      ('nebraska', 'properties', 'response_properties', 'app_indexes'))
+
+  def __init__(self, metadata_watcher=None):
+    """Initializes the tenants.
+
+    Args:
+      metadata_watcher: A MetadataWatcher the app indexes of the tenants should
+        be watched with, None not to watch them.
+    """
+    self._metadata_watcher = metadata_watcher
+    self._lock = threading.Lock()
+    self._tenants = {}
+    # Real paths of metadata directories to their AppIndex and the number of
+    # tenants using it.
+    self._app_indexes = {}
+
+  def _AcquireAppIndex(self, directory):
+    """Returns the shared AppIndex of |directory|.
+
+    The directory is scanned without _lock held, not to block the operations
+    on the other tenants meanwhile.
+    """
+    if directory is None:
+      return AppIndex(None)
+    directory = os.path.realpath(directory)
+    with self._lock:
+      entry = self._app_indexes.get(directory)
+      if entry:
+        entry[1] += 1
+    if entry:
+      # Unwatched indexes may be stale.
+      if not self._metadata_watcher:
+        entry[0].Refresh()
+      return entry[0]
+
+    app_index = AppIndex(directory)
+    with self._lock:
+      entry = self._app_indexes.get(directory)
+      if entry:
+        # Another tenant of the same directory scanned it meanwhile.
+        entry[1] += 1
+        return entry[0]
+      self._app_indexes[directory] = [app_index, 1]
+      if self._metadata_watcher:
+        self._metadata_watcher.Watch(app_index)
+    return app_index
+
+  def _ReleaseAppIndexes(self, app_indexes):
+    """Releases AppIndexes of _AcquireAppIndex, called with _lock held."""
+    for app_index in app_indexes:
+      entry = self._app_indexes.get(app_index.directory)
+      if not entry:
+        continue
+      entry[1] -= 1
+      if not entry[1]:
+        del self._app_indexes[app_index.directory]
+        if self._metadata_watcher:
+          self._metadata_watcher.Unwatch(app_index)
+
+  def Create(self, tenant_id, properties):
+    """Creates a tenant.
+
+    Args:
+      tenant_id: The ID of the tenant, used in the paths of its requests.
+      properties: A dictionary of NebraskaProperties arguments (except the app
+        indexes), and of ResponseProperties arguments under
+        'response_properties'.
+
+    Returns:
+      The created Tenant.
+
+    Raises:
+      TenantError if the tenant exists, or its ID or properties are invalid.
+    """
+    if not self._TENANT_ID_RE.match(tenant_id):
+      raise TenantError('Invalid tenant ID "%s".' % tenant_id)
+    if not isinstance(properties, dict):
+      raise TenantError('Tenant properties should be a dictionary.')
+    unknown = (set(properties) - set(self._NEBRASKA_PROPERTIES) -
+               {self._RESPONSE_PROPERTIES})
+    if unknown:
+      raise TenantError('Unknown tenant properties: %s' %
+                        ', '.join(sorted(unknown)))
+    if not isinstance(properties.get(self._RESPONSE_PROPERTIES, {}), dict):
+      raise TenantError('Response properties should be a dictionary.')
+
+    with self._lock:
+      if tenant_id in self._tenants:
+        raise TenantError('Tenant "%s" already exists.' % tenant_id)
+
+    app_indexes = []
+    try:
+      for key in ('update_metadata_dir', 'install_metadata_dir'):
+        app_indexes.append(self._AcquireAppIndex(properties.get(key)))
+      kwargs = {k: v for k, v in properties.items()
+                if k in self._NEBRASKA_PROPERTIES}
+      nebraska_props = NebraskaProperties(update_app_index=app_indexes[0],
+                                          install_app_index=app_indexes[1],
+                                          **kwargs)
+      response_kwargs = properties.get(self._RESPONSE_PROPERTIES, {})
+      tenant = Tenants.Tenant(
+          Nebraska(nebraska_props, ResponseProperties(**response_kwargs)),
+          properties, response_kwargs, app_indexes)
+    except Exception as err:  # pylint: disable=broad-except
+      # The properties come from the client, whatever they break is its error.
+      with self._lock:
+        self._ReleaseAppIndexes(app_indexes)
+      raise TenantError('Invalid properties of tenant "%s": %s' %
+                        (tenant_id, err))
+
+    with self._lock:
+      if tenant_id in self._tenants:
+        # Created by a concurrent request meanwhile.
+        self._ReleaseAppIndexes(app_indexes)
+        raise TenantError('Tenant "%s" already exists.' % tenant_id)
+      self._tenants[tenant_id] = tenant
+    logging.info('Created tenant %s: %s', tenant_id, properties)
+    return tenant
+
+  def Delete(self, tenant_id):
+    """Deletes a tenant.
+
+    Raises:
+      TenantError if the tenant does not exist.
+    """
+    with self._lock:
+      tenant = self._tenants.pop(tenant_id, None)
+      if not tenant:
+        raise TenantError('Unknown tenant "%s".' % tenant_id)
+      self._ReleaseAppIndexes(tenant.app_indexes)
+    logging.info('Deleted tenant %s', tenant_id)
+
+  def Get(self, tenant_id):
+    """Returns the Tenant |tenant_id|, None if it does not exist."""
+    return self._tenants.get(tenant_id)
+
+  def GetProperties(self):
+    """Returns the IDs of the tenants to their properties."""
+    with self._lock:
+      return {k: v.properties for k, v in self._tenants.items()}
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+  """An HTTP server answering each request in its own thread."""
+  daemon_threads = True
+
+
 class NebraskaServer(object):
   """A simple Omaha server instance.
 
@@ -915,9 +1636,19 @@ class NebraskaServer(object):
   directories, respectively. These metadata files are used to configure
   responses to Omaha requests from Update Engine and describe update and install
   payloads provided by another server.
+
+  In multi-tenant mode, tenants with their own metadata and properties are
+  created and deleted with the tenants API, and their requests are sent to
+  paths prefixed with 't/<tenant ID>/', e.g.:
+      POST https://<ip>:<port>/tenants/<tenant ID> creates a tenant, with the
+          JSON dictionary of its properties (see Tenants.Create) as content.
+      DELETE https://<ip>:<port>/tenants/<tenant ID> deletes it.
+      GET https://<ip>:<port>/tenants returns the properties of all tenants.
+      POST https://<ip>:<port>/t/<tenant ID>/update?key1=value1... is an update
+          request to the tenant.
   """
 
-  def __init__(self, nebraska, runtime_root=None, port=0):
+  def __init__(self, nebraska, runtime_root=None, port=0, tenants=None):
     """Initializes a server instance.
 
     Args:
@@ -925,8 +1656,11 @@ class NebraskaServer(object):
       runtime_root: The root directory in which nebraska will write its PID and
         port files.
       port: Port the server should run on, 0 if the OS should assign a port.
+      tenants: The Tenants of a multi-tenant server, None for a single tenant
+        one.
     """
     self.nebraska = nebraska
+    self.tenants = tenants
     self._runtime_root = runtime_root
     self._port = port
 
@@ -971,6 +1705,79 @@ class NebraskaServer(object):
       parsed_query = urllib.parse.parse_qs(parsed_result.query)
       return parsed_path, parsed_query
 
+    def _GetTarget(self, parsed_path):
+      """Returns what a request is sent to.
+
+      Args:
+        parsed_path: The parsed path of the request, see _ParseURL.
+
+      Returns:
+        A tuple of the Nebraska to process the request, the default response
+        properties arguments of its tenant and the path of the request within
+        the tenant. None if the request was sent to an unknown tenant, in which
+        case an error was sent back.
+      """
+      tenants = self.server.owner.tenants
+      if not tenants or not parsed_path.startswith(_TENANT_PATH_PREFIX):
+        return self.server.owner.nebraska, {}, parsed_path
+
+      tenant_id, _, parsed_path = parsed_path[
+          len(_TENANT_PATH_PREFIX):].partition('/')
+      tenant = tenants.Get(tenant_id)
+      if not tenant:
+        logging.error('Unknown tenant "%s"', tenant_id)
+        self.send_error(http_client.NOT_FOUND,
+                        'Unknown tenant "%s"' % tenant_id)
+        return None
+      return tenant.nebraska, tenant.response_properties, parsed_path
+
+    def _HandleTenants(self, method, parsed_path, content=None):
+      """Handles the requests of the tenants API.
+
+      Args:
+        method: The HTTP method of the request.
+        parsed_path: The parsed path of the request, see _ParseURL.
+        content: The content of the request.
+      """
+      tenants = self.server.owner.tenants
+      tenant_id = parsed_path[len(_TENANTS_PATH):].strip('/')
+      try:
+        if method == 'GET' and not tenant_id:
+          self._SendResponse(
+              'application/json',
+              json.dumps(tenants.GetProperties()).encode('utf-8'))
+          return
+        if method == 'POST' and tenant_id:
+          try:
+            properties = json.loads(content or '{}')
+          except ValueError as err:
+            raise TenantError('Invalid tenant properties: %s' % err)
+          tenants.Create(tenant_id, properties)
+          self._SendResponse('application/json', b'{}',
+                             code=http_client.CREATED)
+          return
+        if method == 'DELETE' and tenant_id:
+          if not tenants.Get(tenant_id):
+            self.send_error(http_client.NOT_FOUND,
+                            'Unknown tenant "%s"' % tenant_id)
+            return
+          tenants.Delete(tenant_id)
+          self._SendResponse('application/json', b'{}')
+          return
+      except TenantError as err:
+        logging.error('Tenants request failed (%s)', err)
+        self.send_error(http_client.BAD_REQUEST, str(err))
+        return
+
+      self.send_error(http_client.BAD_REQUEST,
+                      'Invalid tenants request: %s /%s' % (method, parsed_path))
+
+    def _IsTenantsRequest(self, parsed_path):
+      """Returns whether the request is sent to the tenants API."""
+      return bool(self.server.owner.tenants and
+                  (parsed_path == _TENANTS_PATH or
+                   parsed_path.startswith(_TENANTS_PATH + '/')))
+
     def do_POST(self):
       """Responds to XML-formatted Omaha requests.
 
@@ -981,6 +1788,11 @@ class NebraskaServer(object):
       """
       try:
         request_len = int(self.headers.get('content-length'))
+        if request_len > MAX_REQUEST_SIZE:
+          self.send_error(http_client.REQUEST_ENTITY_TOO_LARGE,
+                          'Requests are limited to %d bytes.' %
+                          MAX_REQUEST_SIZE)
+          return
         request = self.rfile.read(request_len)
       except Exception as err:
         logging.error('Failed to read request in do_POST %s', str(err))
@@ -988,14 +1800,22 @@ class NebraskaServer(object):
         return
 
       parsed_path, parsed_query = self._ParseURL(self.path)
+      if self._IsTenantsRequest(parsed_path):
+        self._HandleTenants('POST', parsed_path, request)
+        return
+
+      target = self._GetTarget(parsed_path)
+      if not target:
+        return
+      nebraska, kwargs, parsed_path = target
       if parsed_path == 'update':
-        kwargs = QueryDictToDict(parsed_query)
+        # The arguments of the request override the ones of the tenant.
+        kwargs = dict(kwargs, **QueryDictToDict(parsed_query))
         response_props = ResponseProperties(**kwargs)
 
         try:
           request_obj = Request(request)
-          response = self.server.owner.nebraska.GetResponseToRequest(
-              request_obj, response_props)
+          response = nebraska.GetResponseToRequest(request_obj, response_props)
           self._SendResponse('application/xml', response)
         except Exception as err:
           logging.error('Failed to handle request (%s)', str(err))
@@ -1013,15 +1833,26 @@ class NebraskaServer(object):
 
       The use cases are:
       - requestlog: For getting the list of request logs in a JSON format.
+      - health_check: For checking nebraska is alive, and getting the
+        generations of the update and install metadata.
+      - tenants: For getting the properties of the tenants in a JSON format.
 
       The URL path can be like:
           https://<ip>:<port>/requestlog
+          https://<ip>:<port>/t/<tenant ID>/requestlog
       """
       parsed_path, _ = self._ParseURL(self.path)
+      if self._IsTenantsRequest(parsed_path):
+        self._HandleTenants('GET', parsed_path)
+        return
 
+      target = self._GetTarget(parsed_path)
+      if not target:
+        return
+      nebraska, _, parsed_path = target
       if parsed_path == 'requestlog':
         try:
-          response = self.server.owner.nebraska.GetRequestLog()
+          response = nebraska.GetRequestLog()
           self._SendResponse('application/json', response)
         except Exception as err:
           logging.error('Failed to get request logs (%s)', str(err))
@@ -1029,7 +1860,27 @@ class NebraskaServer(object):
           self.send_error(http_client.INTERNAL_SERVER_ERROR,
                           traceback.format_exc())
       elif parsed_path == 'health_check':
-        self._SendResponse('text/plain', 'Nebraska is alive!')
+        generations = nebraska.GetMetadataGenerations()
+        self._SendResponse(
+            'text/plain',
+            ('Nebraska is alive!\n'
+             'update_metadata_generation: %d\n'
+             'install_metadata_generation: %d\n' % generations).encode(
+                 'utf-8'))
+      else:
+        logging.error('The requested path "%s" was not found!', parsed_path)
+        self.send_error(http_client.BAD_REQUEST,
+                        'The requested path "%s" was not found!' % parsed_path)
+
+    def do_DELETE(self):
+      """Responds to Delete requests, only used to delete tenants.
+
+      The URL path can be like:
+          https://<ip>:<port>/tenants/<tenant ID>
+      """
+      parsed_path, _ = self._ParseURL(self.path)
+      if self._IsTenantsRequest(parsed_path):
+        self._HandleTenants('DELETE', parsed_path)
       else:
         logging.error('The requested path "%s" was not found!', parsed_path)
         self.send_error(http_client.BAD_REQUEST,
@@ -1037,8 +1888,12 @@ class NebraskaServer(object):
 
   def Start(self):
     """Starts the nebraska server."""
-    self._httpd = BaseHTTPServer.HTTPServer(('', self.GetPort()),
-                                            NebraskaServer.NebraskaHandler)
+    # A multi-tenant server can't answer the requests of all its tenants one
+    # after the other.
+    server_class = (_ThreadingHTTPServer if self.tenants else
+                    BaseHTTPServer.HTTPServer)
+    self._httpd = server_class(('', self.GetPort()),
+                               NebraskaServer.NebraskaHandler)
     self._port = self._httpd.server_port
 
     if self._runtime_root:
@@ -1115,6 +1970,16 @@ def ParseArguments(argv):
   parser.add_argument('--ignore-appid', action='store_true',
                       help='Ignore the App ID field of incoming requests and '
                       'use whichever app is available.')
+  parser.add_argument('--watch-metadata', action='store_true',
+                      help='Reload the metadata files which are added, '
+                      'modified or removed while nebraska is running.')
+  parser.add_argument('--multi-tenant', action='store_true',
+                      help='Serve the tenants created with the tenants API, '
+                      'under /t/<tenant ID>/, besides the default one.')
+  parser.add_argument('--metadata-poll-interval', metavar='SECONDS',
+                      type=float, default=_METADATA_POLL_INTERVAL,
+                      help='How often the metadata directories are rescanned '
+                      'with --watch-metadata when inotify is not available.')
 
   parser.add_argument('--port', metavar='PORT', type=int, default=0,
                       help='Port to run the server on.')
@@ -1152,11 +2017,20 @@ def main(argv):
       install_metadata_dir=opts.install_metadata,
       ignore_appid=opts.ignore_appid)
   nebraska = Nebraska(nebraska_props)
+  metadata_watcher = None
+  if opts.watch_metadata:
+    metadata_watcher = MetadataWatcher(
+        [nebraska_props.update_app_index, nebraska_props.install_app_index],
+        poll_interval=opts.metadata_poll_interval)
+    metadata_watcher.Start()
+  tenants = Tenants(metadata_watcher) if opts.multi_tenant else None
   nebraska_server = NebraskaServer(nebraska, runtime_root=opts.runtime_root,
-                                   port=opts.port)
+                                   port=opts.port, tenants=tenants)
 
   def handler(signum, _):
     logging.info('Exiting Nebraska with signal %d ...', signum)
+    if metadata_watcher:
+      metadata_watcher.Stop()
     nebraska_server.Stop()
 
   signal.signal(signal.SIGINT, handler)
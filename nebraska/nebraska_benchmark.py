@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmark of the parsing and acknowledgement of requests.
+
+Acknowledges the event requests update_engine sends during an update
+(download started, download finished, update complete) through a full Request
+and Nebraska, as the devserver used to, and through EventAck. Also measures
+what EventAck costs update checks, which it has to recognize before leaving
+them to Request, and how fast Request parses update checks of the platform
+app and 1 to 200 DLCs. Prints the throughput of each in requests per second.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import nebraska
+
+
+_EVENT_REQUEST = """<?xml version="1.0" encoding="UTF-8"?>
+<request requestid="%(id)d" sessionid="{5B5B6E8A-8E0B-4F45-A2E3-8C6F6B1E0F4A}"
+    protocol="3.0" updater="ChromeOSUpdateEngine" updaterversion="0.1.0.0"
+    installsource="ondemandupdate" ismachine="1">
+  <os version="Indy" platform="Chrome OS" sp="13020.0.0_x86_64"></os>
+  <app appid="{4D3D2356-0ABF-4994-B191-9A16A11AC0C6}" version="13020.0.0"
+      track="stable-channel" board="eve-signed-mpkeys"
+      hardware_class="EVE D6B-A5B-F3D" delta_okay="true" installdate="4767"
+      lang="en-US" fw_version="" ec_version="">
+    <event eventtype="%(type)d" eventresult="1"
+        previousversion="13020.0.0"></event>
+  </app>
+</request>
+"""
+
+_UPDATE_CHECK_REQUEST = """<?xml version="1.0" encoding="UTF-8"?>
+<request requestid="1" sessionid="{5B5B6E8A-8E0B-4F45-A2E3-8C6F6B1E0F4A}"
+    protocol="3.0" updater="ChromeOSUpdateEngine" updaterversion="0.1.0.0"
+    installsource="ondemandupdate" ismachine="1">
+  <os version="Indy" platform="Chrome OS" sp="13020.0.0_x86_64"></os>
+  <app appid="{4D3D2356-0ABF-4994-B191-9A16A11AC0C6}" version="13020.0.0"
+      track="stable-channel" board="eve-signed-mpkeys"
+      hardware_class="EVE D6B-A5B-F3D" delta_okay="true" installdate="4767"
+      lang="en-US" fw_version="" ec_version="">
+    <ping active="1" a="1" r="1"></ping>
+    <updatecheck targetversionprefix=""></updatecheck>
+  </app>
+</request>
+"""
+
+
+_DLC_APP = """  <app appid="{4D3D2356-0ABF-4994-B191-9A16A11AC0C6}_dlc-%(id)d"
+      version="13020.0.0" track="stable-channel" board="eve-signed-mpkeys"
+      hardware_class="EVE D6B-A5B-F3D" delta_okay="true" lang="en-US"
+      fw_version="" ec_version="">
+    <ping active="1" a="1" r="1"></ping>
+    <updatecheck></updatecheck>
+  </app>
+"""
+
+
+def _UpdateCheckRequest(dlcs):
+  """Returns an update check of the platform app and |dlcs| DLCs."""
+  apps = ''.join(_DLC_APP % {'id': i} for i in range(dlcs))
+  return _UPDATE_CHECK_REQUEST.replace('</request>',
+                                       apps + '</request>').encode('utf-8')
+
+
+def _EventRequests():
+  """Returns the event requests of an update."""
+  return [(_EVENT_REQUEST % {'id': i, 'type': event_type}).encode('utf-8')
+          for i, event_type in enumerate((
+              nebraska.Request.EVENT_TYPE_UPDATE_DOWNLOAD_STARTED,
+              nebraska.Request.EVENT_TYPE_UPDATE_DOWNLOAD_FINISHED,
+              nebraska.Request.EVENT_TYPE_UPDATE_COMPLETE))]
+
+
+def FullAck(request):
+  """Acknowledges an event request the way the devserver used to."""
+  return nebraska.Nebraska().GetResponseToRequest(
+      nebraska.Request(request), response_props=nebraska.ResponseProperties())
+
+
+def Throughput(handler, requests, count):
+  """Returns the number of |requests| per second |handler| processes."""
+  start = time.time()
+  for i in range(count):
+    handler(requests[i % len(requests)])
+  return count / (time.time() - start)
+
+
+def ParseArguments(argv):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--requests', type=int, default=20000,
+                      help='Number of requests to process in each mode.')
+  parser.add_argument('--dlcs', type=int, nargs='+', default=[0, 10, 50, 200],
+                      help='Numbers of DLCs of the update checks to parse.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  opts = ParseArguments(argv)
+  logging.disable(logging.CRITICAL)
+  events = _EventRequests()
+  for request in events:
+    if nebraska.EventAck.GetResponse(request) is None:
+      raise AssertionError('Not acknowledged by EventAck: %s' % request)
+  update_check = [_UPDATE_CHECK_REQUEST.encode('utf-8')]
+
+  results = {
+      'full_event_acks_per_second': int(
+          Throughput(FullAck, events, opts.requests)),
+      'fast_event_acks_per_second': int(
+          Throughput(nebraska.EventAck.GetResponse, events, opts.requests)),
+      'update_check_parses_per_second': int(
+          Throughput(nebraska.Request, update_check, opts.requests)),
+      'update_check_prescans_per_second': int(
+          Throughput(nebraska.EventAck.GetResponse, update_check,
+                     opts.requests)),
+  }
+  results['event_ack_speedup'] = round(
+      results['fast_event_acks_per_second'] /
+      results['full_event_acks_per_second'], 1)
+  for dlcs in opts.dlcs:
+    # Parse as many apps as with the platform app only.
+    requests = max(1, opts.requests // (dlcs + 1))
+    results['update_check_parses_per_second_%d_apps' % (dlcs + 1)] = round(
+        Throughput(nebraska.Request, [_UpdateCheckRequest(dlcs)], requests),
+        1)
+  print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
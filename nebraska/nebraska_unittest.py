@@ -16,6 +16,7 @@ import logging
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
 from xml.etree import ElementTree
@@ -301,7 +302,9 @@ class NebraskaHandlerTest(unittest.TestCase):
 
     nebraska_handler.do_GET()
     nebraska_handler._SendResponse.assert_called_once_with(
-        'text/plain', 'Nebraska is alive!')
+        'text/plain', b'Nebraska is alive!\n'
+        b'update_metadata_generation: 0\n'
+        b'install_metadata_generation: 0\n')
 
 class NebraskaServerTest(NebraskaBaseTest):
   """Test NebraskaServer."""
@@ -525,6 +528,65 @@ class NebraskaTest(NebraskaBaseTest):
     with self.assertRaises(KeyError):
       nebraska.AppIndex(self.tempdir)
 
+  def testRefresh(self):
+    """Tests Refresh adds, replaces and removes app data."""
+    self.GenerateAppData('foo.json')
+    self.GenerateAppData('bar.json', appid='bar')
+    app_index = nebraska.AppIndex(self.tempdir)
+    old_index = app_index._index
+    self.assertFalse(app_index.Refresh())
+    self.assertEqual(app_index.generation, 0)
+
+    self.GenerateAppData('foo.json', target_version='3.0.0')
+    os.utime(os.path.join(self.tempdir, 'foo.json'), (1, 1))
+    self.GenerateAppData('baz.json', appid='baz')
+    os.remove(os.path.join(self.tempdir, 'bar.json'))
+    self.assertTrue(app_index.Refresh())
+    self.assertEqual(app_index.generation, 1)
+    self.assertEqual([(x.appid, x.target_version) for x in app_index._index],
+                     [('foo', '3.0.0'), ('baz', '2.0.0')])
+    # Requests being answered keep the index they started with.
+    self.assertEqual([x.appid for x in old_index], ['foo', 'bar'])
+
+    # Files which fail to load leave the index as it was.
+    with open(os.path.join(self.tempdir, 'baz.json'), 'w') as f:
+      f.write('{"appid": ')
+    self.assertFalse(app_index.Refresh(['baz.json', 'foo.txt']))
+    self.assertEqual([x.appid for x in app_index._index], ['foo', 'baz'])
+    self.GenerateAppData('baz.json', appid='qux')
+    self.assertTrue(app_index.Refresh(['baz.json']))
+    self.assertEqual([x.appid for x in app_index._index], ['foo', 'qux'])
+    self.assertEqual(app_index.generation, 2)
+
+  def _WaitForGeneration(self, app_index, generation):
+    """Waits for |app_index| to reach |generation|."""
+    deadline = time.time() + 10
+    while app_index.generation < generation and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(app_index.generation, generation)
+
+  def testMetadataWatcher(self):
+    """Tests watching metadata directories, with and without inotify."""
+    for use_inotify in (False, True):
+      self.GenerateAppData('foo.json')
+      app_index = nebraska.AppIndex(self.tempdir)
+      watcher = nebraska.MetadataWatcher(
+          [app_index, nebraska.AppIndex(None)], poll_interval=0.01,
+          use_inotify=use_inotify)
+      watcher.Start()
+      try:
+        if use_inotify and watcher.mode != 'inotify':
+          self.skipTest('inotify is not available.')
+        self.assertEqual(watcher.mode, 'inotify' if use_inotify else 'poll')
+        self.GenerateAppData('bar.json', appid='bar')
+        self._WaitForGeneration(app_index, 1)
+        os.remove(os.path.join(self.tempdir, 'foo.json'))
+        self._WaitForGeneration(app_index, 2)
+        self.assertEqual([x.appid for x in app_index._index], ['bar'])
+      finally:
+        watcher.Stop()
+      os.remove(os.path.join(self.tempdir, 'bar.json'))
+
   def testMatch(self):
     """Tests different scenarios for correctly matching AppData."""
     # Providing some properties files.
@@ -753,6 +815,66 @@ class NebraskaTest(NebraskaBaseTest):
     with self.assertRaises(nebraska.InvalidRequestError):
       nebraska.Request(request)
 
+  def testParseRequestRejected(self):
+    """Tests oversized requests and entity declarations are not parsed."""
+    request = GenerateXMLRequest(
+        [GenerateXMLAppRequest(event=True, update_check=False)])
+    laughs = (b'<?xml version="1.0"?>\n'
+              b'<!DOCTYPE request [<!ENTITY lol "lol">'
+              b'<!ENTITY lol2 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">]>\n'
+              b'<request><app appid="&lol2;" version="1" track="t" board="b">'
+              b'<event eventtype="3"/></app></request>')
+    oversized = request.replace(
+        b'<os ', b'<!-- %s --><os ' % (b'x' * nebraska.MAX_REQUEST_SIZE))
+    for rejected in (laughs, oversized):
+      with self.assertRaises(nebraska.InvalidRequestError):
+        nebraska.Request(rejected)
+      self.assertIsNone(nebraska.EventAck.GetResponse(rejected))
+    self.assertIsNotNone(nebraska.EventAck.GetResponse(request))
+
+  def testGetDict(self):
+    """Tests the dictionary of a request is a copy of its first app."""
+    request = nebraska.Request(GenerateXMLRequest([
+        GenerateXMLAppRequest(event=True, event_type='3', ping=True),
+        GenerateXMLAppRequest(appid='bar'),
+    ]))
+    result = request.GetDict()
+    self.assertEqual(result, {
+        'request_type': nebraska.Request.RequestType.UPDATE,
+        'appid': 'foo',
+        'version': '1.0.0',
+        'track': 'foo-channel',
+        'board': 'foo-board',
+        'ping': True,
+        'delta_okay': False,
+        'event_type': 3,
+        'event_result': 1,
+        'previous_version': None,
+        'rollback_allowed': False,
+        'has_update_check': True,
+        'timestamp': request.timestamp,
+    })
+    json.dumps(result)
+    self.assertFalse(hasattr(request.app_requests[0], 'timestamp'))
+
+  def testAppDataImmutable(self):
+    """Tests the index returns its own AppData, which can't be modified."""
+    self.GenerateAppData()
+    app_index = nebraska.AppIndex(self.tempdir)
+    request = nebraska.Request(GenerateXMLRequest([GenerateXMLAppRequest()]))
+    matched_apps = set()
+    app_data = app_index.Find(request.app_requests[0], matched_apps, None)
+    self.assertIs(app_data, app_index._index[0])
+    self.assertEqual(matched_apps, {app_data})
+
+    with self.assertRaises(AttributeError):
+      app_data.size = 0
+    with self.assertRaises(AttributeError):
+      del app_data.appid
+    with self.assertRaises(AttributeError):
+      app_data.url = 'http://foo'
+    self.assertEqual(app_data.size, '9001')
+
   def testUpdateMultipleApps(self):
     """Tests update with multiple apps."""
     app_datas = [
@@ -991,6 +1113,186 @@ class NebraskaTest(NebraskaBaseTest):
     self.assertEqual(update_check.attrib['_eol_date'], '1000')
 
 
+class TenantsTest(NebraskaBaseTest):
+  """Test multi-tenant nebraska servers."""
+
+  def setUp(self):
+    super(TenantsTest, self).setUp()
+    self.update_dir = os.path.join(self.tempdir, 'update')
+    os.mkdir(self.update_dir)
+    self.GenerateAppData(os.path.join('update', 'foo.json'))
+
+  def testSharedAppIndexes(self):
+    """Tests tenants of the same metadata share its app index."""
+    watcher = mock.Mock()
+    tenants = nebraska.Tenants(metadata_watcher=watcher)
+    first = tenants.Create('first', {'update_metadata_dir': self.update_dir})
+    second = tenants.Create('second', {
+        'update_metadata_dir': self.update_dir + '/',
+        'update_payloads_address': 'http://foo/',
+        'response_properties': {'critical_update': True},
+    })
+    self.assertIs(first.app_indexes[0], second.app_indexes[0])
+    self.assertIsNot(first.app_indexes[1], second.app_indexes[1])
+    self.assertIsNot(first.nebraska, second.nebraska)
+    watcher.Watch.assert_called_once_with(first.app_indexes[0])
+    self.assertEqual(sorted(tenants.GetProperties()), ['first', 'second'])
+
+    tenants.Delete('first')
+    watcher.Unwatch.assert_not_called()
+    tenants.Delete('second')
+    watcher.Unwatch.assert_called_once_with(first.app_indexes[0])
+    self.assertIsNone(tenants.Get('second'))
+    self.assertEqual(tenants.GetProperties(), {})
+
+  def testInvalidTenants(self):
+    """Tests invalid tenant operations."""
+    tenants = nebraska.Tenants()
+    tenants.Create('foo', {})
+    for tenant_id, properties in (
+        ('foo', {}),
+        ('bar/baz', {}),
+        ('bar', []),
+        ('bar', {'unknown': 1}),
+        ('bar', {'response_properties': 1}),
+        ('bar', {'update_metadata_dir': self.update_dir,
+                 'install_metadata_dir': os.path.join(self.tempdir, 'no')}),
+        ('bar', {'update_metadata_dir': self.update_dir,
+                 'update_payloads_address': 5}),
+        ('bar', {'update_metadata_dir': self.update_dir,
+                 'response_properties': {'num_urls': 1, 1: 2}})):
+      with self.assertRaises(nebraska.TenantError):
+        tenants.Create(tenant_id, properties)
+    with self.assertRaises(nebraska.TenantError):
+      tenants.Delete('bar')
+    # The failed tenants did not keep the update app index.
+    self.assertEqual(tenants._app_indexes, {})
+
+  def _Request(self, port, method, path, body=None):
+    """Sends a request to the server, returns its status and content."""
+    connection = http_client.HTTPConnection('localhost', port)
+    try:
+      connection.request(method, path, body)
+      response = connection.getresponse()
+      return response.status, response.read()
+    finally:
+      connection.close()
+
+  @mock.patch.object(nebraska.NebraskaServer.NebraskaHandler, 'log_message')
+  def testServer(self, _):
+    """Tests the tenants API and the requests to tenants."""
+    server = nebraska.NebraskaServer(nebraska.Nebraska(),
+                                     tenants=nebraska.Tenants())
+    server.Start()
+    try:
+      port = server.GetPort()
+      self.assertEqual(self._Request(port, 'POST', '/tenants/dut1', json.dumps({
+          'update_metadata_dir': self.update_dir,
+          'update_payloads_address': 'http://dut1/',
+          'response_properties': {'critical_update': True},
+      })), (http_client.CREATED, b'{}'))
+      self.assertEqual(self._Request(port, 'POST', '/tenants/dut2', '{}')[0],
+                       http_client.CREATED)
+      self.assertEqual(self._Request(port, 'POST', '/tenants/dut2', '{}')[0],
+                       http_client.BAD_REQUEST)
+      self.assertEqual(self._Request(port, 'POST', '/tenants/dut3', json.dumps({
+          'update_metadata_dir': self.update_dir,
+          'update_payloads_address': 5,
+      }))[0], http_client.BAD_REQUEST)
+      status, content = self._Request(port, 'GET', '/tenants')
+      self.assertEqual(sorted(json.loads(content)), ['dut1', 'dut2'])
+
+      request = GenerateXMLRequest([GenerateXMLAppRequest()])
+      status, content = self._Request(port, 'POST', '/t/dut1/update', request)
+      self.assertEqual(status, http_client.OK)
+      update_check = ElementTree.fromstring(content).find('app/updatecheck')
+      self.assertEqual(update_check.find('urls/url').attrib['codebase'],
+                       'http://dut1/')
+      action = update_check.findall('manifest/actions/action')[1]
+      self.assertEqual(action.attrib['deadline'], 'now')
+      # The arguments of a request override the properties of the tenant.
+      status, content = self._Request(port, 'POST',
+                                      '/t/dut1/update?no_update=True', request)
+      self.assertEqual(ElementTree.fromstring(content).find(
+          'app/updatecheck').attrib['status'], 'noupdate')
+      status, content = self._Request(port, 'POST', '/t/dut2/update', request)
+      self.assertEqual(ElementTree.fromstring(content).find(
+          'app/updatecheck').attrib['status'], 'noupdate')
+
+      # Request logs are kept per tenant.
+      self.assertEqual(
+          len(json.loads(self._Request(port, 'GET', '/t/dut1/requestlog')[1])),
+          2)
+      self.assertEqual(
+          len(json.loads(self._Request(port, 'GET', '/t/dut2/requestlog')[1])),
+          1)
+      self.assertEqual(self._Request(port, 'GET', '/requestlog')[1], b'[]')
+
+      self.assertEqual(self._Request(port, 'DELETE', '/tenants/dut1')[0],
+                       http_client.OK)
+      self.assertEqual(self._Request(port, 'DELETE', '/tenants/dut1')[0],
+                       http_client.NOT_FOUND)
+      self.assertEqual(
+          self._Request(port, 'POST', '/t/dut1/update', request)[0],
+          http_client.NOT_FOUND)
+    finally:
+      server.Stop()
+
+
+@mock.patch.object(nebraska, '_GetDayStart', return_value=(4800, 3600))
+class EventAckTest(unittest.TestCase):
+  """Tests for the EventAck class."""
+
+  def _FullResponse(self, request):
+    return nebraska.Nebraska().GetResponseToRequest(nebraska.Request(request))
+
+  def testSameAsNebraska(self, _):
+    """Tests event acks are the same as the responses of Nebraska."""
+    requests = [
+        GenerateXMLRequest([
+            GenerateXMLAppRequest(appid='foo', event=True, update_check=False),
+        ]),
+        GenerateXMLRequest([
+            GenerateXMLAppRequest(appid='foo', event=True, ping=True,
+                                  update_check=False, previous_version='1'),
+            GenerateXMLAppRequest(appid='"bar" & <baz>', version='0.0.0.0',
+                                  track=None, board=None, update_check=False),
+            GenerateXMLAppRequest(appid='qux', ping=True, update_check=False),
+        ]),
+    ]
+    for request in requests:
+      ack = nebraska.EventAck.GetResponse(request)
+      self.assertIsNotNone(ack)
+      self.assertEqual(ack, self._FullResponse(request))
+      self.assertEqual(nebraska.EventAck.GetResponse(request.decode('utf-8')),
+                       ack)
+
+  def testNotEvents(self, _):
+    """Tests update checks and invalid requests are left to Request."""
+    for request in (
+        GenerateXMLRequest([GenerateXMLAppRequest(event=True)]),
+        GenerateXMLRequest([
+            GenerateXMLAppRequest(appid='foo', update_check=False),
+            GenerateXMLAppRequest(appid='bar'),
+        ]),
+        # Invalid requests.
+        b'<request><app',
+        GenerateXMLRequest([]),
+        GenerateXMLRequest([GenerateXMLAppRequest(version=None,
+                                                  update_check=False)]),
+        GenerateXMLRequest([GenerateXMLAppRequest(track=None,
+                                                  update_check=False)]),
+        GenerateXMLRequest([
+            GenerateXMLAppRequest(appid='foo', update_check=False),
+            GenerateXMLAppRequest(appid='bar', version='2.0.0',
+                                  update_check=False),
+        ]),
+        GenerateXMLRequest([GenerateXMLAppRequest(
+            event=True, event_type='x', update_check=False)]),
+    ):
+      self.assertIsNone(nebraska.EventAck.GetResponse(request))
+
+
 if __name__ == '__main__':
   # Disable logging so it doesn't pollute the unit test output. Failures and
   # exceptions are still shown.
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Concurrent extraction of several tarballs into one directory tree.
+
+Each tarball is extracted into its own staging directory by its own tar
+process (using a multithreaded decompressor when one is installed), and the
+staging trees are then merged with renames. The merge follows the order of
+the tarballs, so files from later tarballs replace files from earlier ones,
+exactly as if they had been extracted one after another into the same
+directory.
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+
+from concurrent import futures
+
+
+# Multithreaded decompressors, in order of preference. lbzip2 decompresses any
+# bzip2 stream in parallel, pbzip2 only those it compressed itself.
+_PARALLEL_DECOMPRESSORS = {
+    '.bz2': ('lbzip2', 'pbzip2'),
+    '.tbz2': ('lbzip2', 'pbzip2'),
+    '.gz': ('pigz',),
+    '.tgz': ('pigz',),
+}
+
+
+class ExtractError(Exception):
+  """Exception class used by this module."""
+
+
+def _FindProgram(name):
+  """Returns the full path of |name| in $PATH, or None."""
+  for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+    candidate = os.path.join(path, name)
+    if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+      return candidate
+  return None
+
+
+def FindDecompressor(tarball):
+  """Returns a multithreaded decompressor usable for |tarball|, or None."""
+  ext = os.path.splitext(tarball)[1]
+  for program in _PARALLEL_DECOMPRESSORS.get(ext, ()):
+    path = _FindProgram(program)
+    if path:
+      return path
+  return None
+
+
+def ExtractTarball(tarball, dest_dir):
+  """Extracts |tarball| into the existing directory |dest_dir|.
+
+  Raises:
+    ExtractError: if tar failed.
+  """
+  cmd = ['tar', '--sparse', '-xf', tarball, '-C', dest_dir]
+  decompressor = FindDecompressor(tarball)
+  if decompressor:
+    cmd += ['--use-compress-program', decompressor]
+  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  _, error = proc.communicate()
+  if proc.returncode:
+    raise ExtractError('Failed to extract %s (rc=%d): %s' %
+                       (tarball, proc.returncode, error))
+
+
+def MergeTree(src_dir, dest_dir):
+  """Moves the contents of |src_dir| into |dest_dir|.
+
+  Directories present on both sides are merged, anything else in |src_dir|
+  replaces what is at the same path in |dest_dir|. |src_dir| is consumed.
+  """
+  for name in os.listdir(src_dir):
+    src = os.path.join(src_dir, name)
+    dest = os.path.join(dest_dir, name)
+    src_is_dir = os.path.isdir(src) and not os.path.islink(src)
+    dest_is_dir = os.path.isdir(dest) and not os.path.islink(dest)
+    if src_is_dir and dest_is_dir:
+      MergeTree(src, dest)
+      os.rmdir(src)
+      continue
+    if dest_is_dir:
+      shutil.rmtree(dest)
+    elif src_is_dir and os.path.lexists(dest):
+      os.unlink(dest)
+    os.rename(src, dest)
+
+
+def ExtractParallel(tarballs, staging_dir, max_workers=None):
+  """Extracts |tarballs| concurrently and merges them in order.
+
+  Args:
+    tarballs: Paths of the tarballs, in the order they would be extracted.
+    staging_dir: An empty directory on the same filesystem as the final
+      destination, used for the per tarball trees.
+    max_workers: Maximum number of concurrent tar processes, defaults to one
+      per tarball.
+
+  Returns:
+    The path of the directory, inside |staging_dir|, holding the merged trees.
+    It can be published with a rename.
+
+  Raises:
+    ExtractError: if any tarball failed to extract.
+  """
+  dirs = []
+  for i in range(len(tarballs)):
+    dirs.append(os.path.join(staging_dir, str(i)))
+    os.mkdir(dirs[-1])
+
+  with futures.ThreadPoolExecutor(
+      max_workers=max_workers or max(len(tarballs), 1)) as pool:
+    jobs = [pool.submit(ExtractTarball, t, d) for t, d in zip(tarballs, dirs)]
+    for job in jobs:
+      job.result()
+
+  merged = os.path.join(staging_dir, 'merged')
+  if dirs:
+    os.rename(dirs[0], merged)
+    for d in dirs[1:]:
+      MergeTree(d, merged)
+      os.rmdir(d)
+  else:
+    os.mkdir(merged)
+  return merged
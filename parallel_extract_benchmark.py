@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmark for the telemetry deps extraction done by setup_telemetry.
+
+Generates dep tarballs shaped like the telemetry deps (many small source
+files under test_src plus a few large data files), then times extracting them
+one after another into one directory against parallel_extract.ExtractParallel.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import parallel_extract
+
+
+def GenerateDep(path, index, small_files, large_files, large_size):
+  """Writes a dep .tar.bz2 at |path|."""
+  src = tempfile.mkdtemp(prefix='parallel_extract_benchmark_src')
+  try:
+    for i in range(small_files):
+      subdir = os.path.join(src, 'test_src', 'dep%d' % index,
+                            'dir%d' % (i % 50))
+      if not os.path.isdir(subdir):
+        os.makedirs(subdir)
+      with open(os.path.join(subdir, 'file%d.py' % i), 'w') as f:
+        f.write(('# dep %d file %d\n' % (index, i)) * 100)
+    data_dir = os.path.join(src, 'test_src', 'data%d' % index)
+    os.makedirs(data_dir)
+    for i in range(large_files):
+      with open(os.path.join(data_dir, 'blob%d' % i), 'wb') as f:
+        # Half random, half repetitive, so that bzip2 has real work to do.
+        f.write(os.urandom(large_size // 2))
+        f.write(b'\0' * (large_size // 2))
+    compressor = parallel_extract.FindDecompressor(path)
+    cmd = ['tar', '-cf', path, '-C', src, 'test_src']
+    cmd += ['--use-compress-program', compressor] if compressor else ['-j']
+    subprocess.check_call(cmd)
+  finally:
+    shutil.rmtree(src)
+
+
+def Sequential(tarballs, dest):
+  for tarball in tarballs:
+    subprocess.check_call(['tar', '-xf', tarball, '-C', dest])
+
+
+def Parallel(tarballs, dest):
+  staging = tempfile.mkdtemp(prefix='.staging', dir=dest)
+  merged = parallel_extract.ExtractParallel(tarballs, staging)
+  parallel_extract.MergeTree(merged, dest)
+  shutil.rmtree(staging)
+
+
+def Time(func, tarballs, workdir, rounds):
+  best = None
+  for _ in range(rounds):
+    dest = tempfile.mkdtemp(dir=workdir)
+    start = time.time()
+    func(tarballs, dest)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+    shutil.rmtree(dest)
+  return round(best, 3)
+
+
+def ParseArguments(argv):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--deps', type=int, default=4,
+                      help='Number of dep tarballs.')
+  parser.add_argument('--small-files', type=int, default=2000,
+                      help='Number of small files per dep.')
+  parser.add_argument('--large-files', type=int, default=4,
+                      help='Number of large files per dep.')
+  parser.add_argument('--large-size', type=int, default=16 * 1024 * 1024,
+                      help='Size of the large files in bytes.')
+  parser.add_argument('--rounds', type=int, default=3,
+                      help='Number of timed rounds, the best one is kept.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  opts = ParseArguments(argv)
+  workdir = tempfile.mkdtemp(prefix='parallel_extract_benchmark')
+  try:
+    tarballs = []
+    for i in range(opts.deps):
+      tarballs.append(os.path.join(workdir, 'dep-%d.tar.bz2' % i))
+      GenerateDep(tarballs[-1], i, opts.small_files, opts.large_files,
+                  opts.large_size)
+
+    sequential = Time(Sequential, tarballs, workdir, opts.rounds)
+    parallel = Time(Parallel, tarballs, workdir, opts.rounds)
+    print(json.dumps({
+        'decompressor': parallel_extract.FindDecompressor(tarballs[0]),
+        'sequential_seconds': sequential,
+        'parallel_seconds': parallel,
+        'speedup': round(sequential / parallel, 2),
+    }, indent=2, sort_keys=True))
+  finally:
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for parallel_extract.py."""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import mock
+
+import parallel_extract
+
+
+def MakeTarball(path, files):
+  """Writes a .tar.bz2 at |path| holding |files|, a {name: content} dict."""
+  src = tempfile.mkdtemp('parallel_extract_src')
+  try:
+    for name, content in files.items():
+      full_path = os.path.join(src, name)
+      if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+      with open(full_path, 'w') as f:
+        f.write(content)
+    with tarfile.open(path, 'w:bz2') as tar:
+      for name in os.listdir(src):
+        tar.add(os.path.join(src, name), arcname=name)
+  finally:
+    shutil.rmtree(src)
+
+
+def ReadTree(root):
+  """Returns a {relative path: content} dict of the files under |root|."""
+  tree = {}
+  for dirpath, _, filenames in os.walk(root):
+    for name in filenames:
+      path = os.path.join(dirpath, name)
+      with open(path) as f:
+        tree[os.path.relpath(path, root)] = f.read()
+  return tree
+
+
+class ParallelExtractTest(unittest.TestCase):
+  """Tests for the parallel_extract module."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp('parallel_extract')
+    self.tarballs = []
+    deps = [
+        {'test_src/a': 'dep0', 'test_src/shared/x': 'dep0', 'other': 'dep0'},
+        {'test_src/b': 'dep1', 'test_src/shared/x': 'dep1'},
+        {'test_src/shared/y': 'dep2', 'test_src/a': 'dep2'},
+    ]
+    for i, files in enumerate(deps):
+      self.tarballs.append(os.path.join(self.tempdir, 'dep-%d.tar.bz2' % i))
+      MakeTarball(self.tarballs[-1], files)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testMatchesSequentialExtraction(self):
+    """Tests the merged tree is what sequential extraction would produce."""
+    sequential = os.path.join(self.tempdir, 'sequential')
+    os.mkdir(sequential)
+    for tarball in self.tarballs:
+      subprocess.check_call(['tar', '-xf', tarball, '-C', sequential])
+
+    staging = os.path.join(self.tempdir, 'staging')
+    os.mkdir(staging)
+    merged = parallel_extract.ExtractParallel(self.tarballs, staging)
+
+    self.assertEqual(ReadTree(merged), ReadTree(sequential))
+    self.assertEqual(ReadTree(merged), {
+        'other': 'dep0',
+        'test_src/a': 'dep2',
+        'test_src/b': 'dep1',
+        'test_src/shared/x': 'dep1',
+        'test_src/shared/y': 'dep2',
+    })
+    self.assertEqual(os.listdir(staging), ['merged'])
+
+  def testNoTarballs(self):
+    """Tests an empty tree is returned when there is nothing to extract."""
+    merged = parallel_extract.ExtractParallel([], self.tempdir)
+    self.assertEqual(os.listdir(merged), [])
+
+  def testExtractError(self):
+    """Tests a broken tarball fails the whole extraction."""
+    broken = os.path.join(self.tempdir, 'broken.tar.bz2')
+    with open(broken, 'w') as f:
+      f.write('not a tarball')
+    staging = os.path.join(self.tempdir, 'staging')
+    os.mkdir(staging)
+    with self.assertRaises(parallel_extract.ExtractError):
+      parallel_extract.ExtractParallel(self.tarballs + [broken], staging)
+
+  def testMergeTreeReplacesDirWithFile(self):
+    """Tests files from later trees replace directories of earlier ones."""
+    src = os.path.join(self.tempdir, 'src')
+    dest = os.path.join(self.tempdir, 'dest')
+    os.makedirs(os.path.join(dest, 'x', 'y'))
+    os.mkdir(src)
+    with open(os.path.join(src, 'x'), 'w') as f:
+      f.write('file')
+    parallel_extract.MergeTree(src, dest)
+    self.assertEqual(ReadTree(dest), {'x': 'file'})
+    self.assertEqual(os.listdir(src), [])
+
+  def testFindDecompressor(self):
+    """Tests multithreaded decompressors are preferred when installed."""
+    with mock.patch.object(parallel_extract, '_FindProgram',
+                           side_effect=lambda p: '/usr/bin/' + p):
+      self.assertEqual(parallel_extract.FindDecompressor('a.tar.bz2'),
+                       '/usr/bin/lbzip2')
+      self.assertEqual(parallel_extract.FindDecompressor('a.tgz'),
+                       '/usr/bin/pigz')
+      self.assertIsNone(parallel_extract.FindDecompressor('a.tar'))
+    with mock.patch.object(parallel_extract, '_FindProgram',
+                           return_value=None):
+      self.assertIsNone(parallel_extract.FindDecompressor('a.tar.bz2'))
+
+
+if __name__ == '__main__':
+  unittest.main()
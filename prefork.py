@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Support for running the devserver as several pre-forked worker processes.
+
+A single devserver process is limited by the GIL for the CPU heavy parts of
+its requests. In pre-fork mode, a supervisor process forks worker processes
+which each run a complete devserver listening on the same port (see
+cherrypy_ext.ReusePortServer), and restarts the ones which die.
+
+The state the workers share lives in objects created before the fork:
+  Counter: a gauge in shared memory, e.g. the number of staging threads.
+  FileLockDict: locks held across processes with flock() on lock files, e.g.
+    to not stage or extract the same build in two workers at once.
+  WorkerStats: the health statistics and request metrics of each worker,
+    published to a directory in which any worker merges them when asked for
+    the health or the metrics of the server.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import ctypes
+import errno
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import numbers
+import os
+import signal
+import threading
+import time
+
+from cherrypy.process import plugins  # pylint: disable=import-error
+
+import setup_chromite  # pylint: disable=unused-import
+from chromite.lib.xbuddy import cherrypy_log_util
+
+
+def _Log(message, *args):
+  """Module-local log function."""
+  return cherrypy_log_util.LogWithTag('PREFORK', message, *args)
+
+
+# Number of seconds between two publications of the statistics of a worker.
+STATS_INTERVAL = 5.0
+# Workers which did not publish their statistics for this many intervals are
+# assumed to be gone.
+_STALE_INTERVALS = 3
+# Workers exiting sooner than this many seconds after being forked are
+# restarted only after as long, to not fork in a loop when they cannot start.
+_MIN_WORKER_LIFETIME = 1.0
+
+
+class PreforkError(Exception):
+  """Exception class used by this module."""
+
+
+class Counter(object):
+  """A counter safely changed by concurrent threads.
+
+  With |shared|, the counter lives in shared memory, and is also shared with
+  the processes forked after its creation.
+  """
+
+  def __init__(self, shared=False):
+    if shared:
+      self._value = multiprocessing.Value('i', 0)
+      self._lock = self._value.get_lock()
+    else:
+      self._value = ctypes.c_int(0)
+      self._lock = threading.Lock()
+
+  @property
+  def value(self):
+    """The current value of the counter."""
+    return self._value.value
+
+  def Add(self, delta):
+    """Adds |delta| to the counter."""
+    with self._lock:
+      self._value.value += delta
+
+  @contextlib.contextmanager
+  def Count(self):
+    """Increments the counter for the duration of the context."""
+    self.Add(1)
+    try:
+      yield
+    finally:
+      self.Add(-1)
+
+
+class FileLockDict(object):
+  """A dictionary of locks held across threads and processes.
+
+  It has the interface of common_util.LockDict. The lock of a key is an
+  exclusive flock() on a file of |lock_dir| named after the hash of the key,
+  opened by each locker. Lock files are never removed, as removing them would
+  race with other lockers.
+  """
+
+  def __init__(self, lock_dir):
+    self._lock_dir = lock_dir
+    try:
+      os.makedirs(lock_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def _LockPath(self, key):
+    """Returns the path of the lock file of |key|."""
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(self._lock_dir, digest + '.lock')
+
+  @contextlib.contextmanager
+  def lock(self, key):
+    """Holds the lock of |key| for the duration of the context."""
+    fd = os.open(self._LockPath(key), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      yield
+    finally:
+      # Closing the only descriptor of the open file releases the lock.
+      os.close(fd)
+
+
+def MergeStats(stats_list):
+  """Merges the statistics dictionaries of several workers.
+
+  Nested dictionaries are merged recursively. Numbers are summed, except for
+  times in milliseconds (keys ending in _ms) of which the maximum is kept,
+  ratios (keys ending in _ratio) which are averaged, and limits (keys starting
+  with min_ or max_, e.g. the configured thread pool bounds) which are the
+  same in every worker. Those, and other values such as flags, are the ones
+  of the first dictionary they appear in.
+
+  Args:
+    stats_list: The list of the statistics dictionaries of the workers.
+
+  Returns:
+    The merged dictionary.
+  """
+  merged = {}
+  for key in set().union(*stats_list):
+    values = [stats[key] for stats in stats_list if key in stats]
+    if isinstance(values[0], dict):
+      merged[key] = MergeStats(values)
+    elif (isinstance(values[0], bool) or
+          not isinstance(values[0], numbers.Number)):
+      merged[key] = values[0]
+    elif key.endswith('_ms'):
+      merged[key] = max(values)
+    elif key.endswith('_ratio'):
+      merged[key] = sum(values) / len(values)
+    elif key.startswith(('min_', 'max_')):
+      merged[key] = values[0]
+    else:
+      merged[key] = sum(values)
+  return merged
+
+
+class WorkerStats(plugins.Monitor):
+  """CherryPy plugin sharing the statistics of a worker with the others.
+
+  Every |frequency| seconds, the statistics returned by |get_stats| are
+  written to a file of |stats_dir| named after the worker, which is removed
+  when the worker stops. merge() combines the current statistics of the
+  worker with the last ones published by the other live workers.
+
+  The data returned by |get_raw_stats|, e.g. request counters which need
+  their own merging, is published along, and returned for all the live
+  workers by collect_raw_stats().
+  """
+
+  def __init__(self, bus, stats_dir, worker_id, get_stats,
+               frequency=STATS_INTERVAL, get_raw_stats=None):
+    """Initializes the plugin.
+
+    Args:
+      bus: The WSPBus to subscribe to.
+      stats_dir: The directory shared by all the workers.
+      worker_id: The ID of the worker, unique among the workers.
+      get_stats: A function returning the statistics of the worker as a JSON
+        serializable dictionary.
+      frequency: Number of seconds between two publications.
+      get_raw_stats: An optional function returning JSON serializable data of
+        the worker, published with its statistics but not merged.
+    """
+    super(WorkerStats, self).__init__(bus, self.publish, frequency=frequency,
+                                      name='WorkerStats')
+    self.stats_dir = stats_dir
+    self.worker_id = worker_id
+    self.get_stats = get_stats
+    self.get_raw_stats = get_raw_stats
+    self._path = os.path.join(stats_dir, 'worker-%d.json' % worker_id)
+    # Serializes the publications of the background task and of
+    # collect_raw_stats(), so that older statistics never replace newer ones.
+    self._publish_lock = threading.Lock()
+
+  def publish(self):
+    """Writes the statistics of the worker, replacing the previous ones.
+
+    Returns:
+      The published data.
+    """
+    with self._publish_lock:
+      data = {'pid': os.getpid(), 'time': time.time(),
+              'stats': self.get_stats()}
+      if self.get_raw_stats is not None:
+        data['raw_stats'] = self.get_raw_stats()
+      temp_path = '%s.%d.tmp' % (self._path, os.getpid())
+      try:
+        with open(temp_path, 'w') as f:
+          json.dump(data, f)
+        os.rename(temp_path, self._path)
+      except (IOError, OSError) as e:
+        # An exception would stop the background task for good.
+        _Log('Failed to publish the statistics of worker %d: %s',
+             self.worker_id, e)
+      return data
+
+  def start(self):
+    """Publishes the statistics right away, then periodically."""
+    self.publish()
+    super(WorkerStats, self).start()
+
+  def stop(self):
+    """Stops publishing and removes the statistics of the worker."""
+    super(WorkerStats, self).stop()
+    try:
+      os.remove(self._path)
+    except OSError:
+      pass
+
+  def _read_others(self, field='stats'):
+    """Returns the |field| last published by the other live workers."""
+    others = []
+    deadline = time.time() - _STALE_INTERVALS * self.frequency
+    for name in os.listdir(self.stats_dir):
+      path = os.path.join(self.stats_dir, name)
+      if path == self._path or not name.endswith('.json'):
+        continue
+      try:
+        with open(path) as f:
+          data = json.load(f)
+      except (IOError, OSError, ValueError):
+        continue
+      if data['time'] >= deadline and field in data:
+        others.append(data[field])
+    return others
+
+  def merge(self, stats):
+    """Merges |stats|, of this worker, with those of the other workers.
+
+    Returns:
+      The merged statistics (see MergeStats), with the number of live workers
+      in a 'worker_count' field.
+    """
+    stats_list = [stats] + self._read_others()
+    merged = MergeStats(stats_list)
+    merged['worker_count'] = len(stats_list)
+    return merged
+
+  def collect_raw_stats(self):
+    """Returns the raw statistics of all the live workers, this one first.
+
+    The raw statistics of this worker are published first. Counters summed
+    over the workers then never go back from one call to the next, whichever
+    worker answers, as long as no worker exits.
+    """
+    data = self.publish()
+    return [data.get('raw_stats')] + self._read_others('raw_stats')
+
+
+def ForkWorkers(count):
+  """Forks |count| worker processes and supervises them.
+
+  The supervisor restarts the workers which exit with an error or are killed,
+  and forwards the SIGTERM, SIGINT and SIGHUP signals it receives to the
+  workers as a SIGTERM.
+
+  Args:
+    count: The number of worker processes.
+
+  Returns:
+    In each worker, its ID, between 0 and |count| - 1. In the supervisor, None
+    once all the workers have exited.
+  """
+  if count < 1:
+    raise PreforkError('Invalid number of workers: %d' % count)
+  workers = {}
+  stopping = []
+
+  def _Stop(signum, _frame):
+    if not stopping:
+      _Log('Received signal %d, stopping the workers', signum)
+    stopping.append(signum)
+    for pid in workers:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+  handled_signals = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+  previous_handlers = {}
+  for signum in handled_signals:
+    previous_handlers[signum] = signal.signal(signum, _Stop)
+
+  def _Fork(worker_id):
+    pid = os.fork()
+    if pid == 0:
+      for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+      return True
+    workers[pid] = (worker_id, time.time())
+    _Log('Started worker %d as process %d', worker_id, pid)
+    return False
+
+  for worker_id in range(count):
+    if _Fork(worker_id):
+      return worker_id
+
+  while workers:
+    try:
+      pid, status = os.wait()
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    if pid not in workers:
+      continue
+    worker_id, start_time = workers.pop(pid)
+    if stopping or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+      _Log('Worker %d exited', worker_id)
+      continue
+    _Log('Worker %d (process %d) died with status %d, restarting it',
+         worker_id, pid, status)
+    lifetime = time.time() - start_time
+    if lifetime < _MIN_WORKER_LIFETIME:
+      time.sleep(_MIN_WORKER_LIFETIME - lifetime)
+    if not stopping and _Fork(worker_id):
+      return worker_id
+
+  for signum, handler in previous_handlers.items():
+    signal.signal(signum, handler)
+  return None
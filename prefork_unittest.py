@@ -0,0 +1,180 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for prefork.py."""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+import prefork
+
+
+def _RunInChild(func):
+  """Runs |func| in a forked process and returns its exit status."""
+  pid = os.fork()
+  if pid == 0:
+    status = 1
+    try:
+      func()
+      status = 0
+    finally:
+      os._exit(status)  # pylint: disable=protected-access
+  _, status = os.waitpid(pid, 0)
+  return status
+
+
+class PreforkTest(unittest.TestCase):
+  """Tests for the state shared by the pre-fork workers."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='prefork')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testCounter(self):
+    """Tests shared counters are shared with the forked processes."""
+    counter = prefork.Counter()
+    with counter.Count():
+      self.assertEqual(counter.value, 1)
+    self.assertEqual(counter.value, 0)
+
+    counter = prefork.Counter(shared=True)
+    self.assertEqual(_RunInChild(lambda: counter.Add(3)), 0)
+    self.assertEqual(counter.value, 3)
+
+  def testFileLockDict(self):
+    """Tests a key is locked by one holder at a time."""
+    locks = prefork.FileLockDict(os.path.join(self.tempdir, 'locks'))
+    acquired = threading.Event()
+
+    def _Lock(key):
+      with locks.lock(key):
+        acquired.set()
+
+    with locks.lock('/static/build'):
+      # Other keys are not locked.
+      _Lock('/static/other')
+      acquired.clear()
+      thread = threading.Thread(target=_Lock, args=('/static/build',))
+      thread.start()
+      self.assertFalse(acquired.wait(0.2))
+    thread.join()
+    self.assertTrue(acquired.is_set())
+
+  def testFileLockDictAcrossProcesses(self):
+    """Tests locks are held across processes."""
+    locks = prefork.FileLockDict(os.path.join(self.tempdir, 'locks'))
+    path = os.path.join(self.tempdir, 'log')
+
+    def _Append(text):
+      with locks.lock('key'):
+        for char in text:
+          with open(path, 'a') as f:
+            f.write(char)
+          time.sleep(0.01)
+
+    pid = os.fork()
+    if pid == 0:
+      try:
+        _Append('aaaaa')
+      finally:
+        os._exit(0)  # pylint: disable=protected-access
+    _Append('bbbbb')
+    os.waitpid(pid, 0)
+    with open(path) as f:
+      self.assertIn(f.read(), ('aaaaabbbbb', 'bbbbbaaaaa'))
+
+  def testMergeStats(self):
+    """Tests counters are summed, latencies and ratios are not."""
+    merged = prefork.MergeStats([
+        {'cache': {'hits': 3, 'hit_ratio': 0.5, 'adaptive': False},
+         'queue_wait_p99_ms': 10.0},
+        {'cache': {'hits': 1, 'hit_ratio': 1.0, 'adaptive': True},
+         'queue_wait_p99_ms': 20.0, 'shrunk': 2},
+    ])
+    self.assertEqual(merged, {
+        'cache': {'hits': 4, 'hit_ratio': 0.75, 'adaptive': False},
+        'queue_wait_p99_ms': 20.0, 'shrunk': 2})
+
+  def testMergeStatsLimits(self):
+    """Tests limits are not summed."""
+    merged = prefork.MergeStats([
+        {'thread_pool': {'min_threads': 10, 'max_threads': -1, 'idle': 3}},
+        {'thread_pool': {'min_threads': 10, 'max_threads': -1, 'idle': 4}},
+    ])
+    self.assertEqual(merged, {
+        'thread_pool': {'min_threads': 10, 'max_threads': -1, 'idle': 7}})
+
+  def testWorkerStats(self):
+    """Tests workers merge their statistics with the other live workers."""
+    bus = mock.Mock()
+    workers = [prefork.WorkerStats(bus, self.tempdir, i,
+                                   lambda i=i: {'requests': 10 ** i})
+               for i in range(3)]
+    for worker in workers:
+      worker.publish()
+    self.assertEqual(workers[0].merge({'requests': 5}),
+                     {'requests': 115, 'worker_count': 3})
+
+    # Worker 2 stopped, worker 1 did not publish for too long.
+    workers[2].stop()
+    with mock.patch.object(time, 'time', return_value=time.time() + 60):
+      workers[0].publish()
+      self.assertEqual(workers[0].merge({'requests': 5}),
+                       {'requests': 5, 'worker_count': 1})
+
+  def testCollectRawStats(self):
+    """Tests the raw statistics of the live workers are collected."""
+    bus = mock.Mock()
+    raw_stats = [{'rpcs': i} for i in range(3)]
+    workers = [prefork.WorkerStats(bus, self.tempdir, i, dict,
+                                   get_raw_stats=lambda i=i: raw_stats[i])
+               for i in range(3)]
+    for worker in workers:
+      worker.publish()
+    raw_stats[1] = {'rpcs': 5}
+    self.assertEqual(
+        sorted(workers[1].collect_raw_stats(), key=lambda x: x['rpcs']),
+        [{'rpcs': 0}, {'rpcs': 2}, {'rpcs': 5}])
+    self.assertEqual(workers[1].collect_raw_stats()[0], {'rpcs': 5})
+
+  def testForkWorkers(self):
+    """Tests workers are forked, and restarted when they fail."""
+    def _Supervise():
+      worker_id = prefork.ForkWorkers(2)
+      if worker_id is None:
+        return
+      status = 1
+      try:
+        path = os.path.join(self.tempdir, 'worker-%d' % worker_id)
+        with open(path, 'a') as f:
+          f.write('started\n')
+        # Worker 1 fails the first time.
+        if worker_id == 1 and not os.path.exists(path + '.failed'):
+          open(path + '.failed', 'w').close()
+        else:
+          status = 0
+      finally:
+        os._exit(status)  # pylint: disable=protected-access
+
+    with mock.patch.object(prefork, '_MIN_WORKER_LIFETIME', 0):
+      self.assertEqual(_RunInChild(_Supervise), 0)
+    for worker_id, starts in ((0, 1), (1, 2)):
+      with open(os.path.join(self.tempdir, 'worker-%d' % worker_id)) as f:
+        self.assertEqual(f.read(), 'started\n' * starts)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A TTL cache for resolutions that are expensive to compute.
+
+Resolving xBuddy paths, aliases such as 'latest' or the latest build of a
+target means listing Google Storage. Most callers ask for the same few things
+over and over, so the devserver keeps the answers in a ResolutionCache:
+  - every entry has its own time to live, so that aliases are refreshed
+    regularly while fully pinned versions never expire,
+  - concurrent misses on the same key are resolved once (single-flight), the
+    other callers wait for and share the result,
+  - failures can optionally be cached for a short while (negative caching),
+  - entries can be validated on hit, e.g. to check that a file still exists.
+"""
+
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+
+# Entries with this TTL never expire.
+NO_EXPIRY = None
+
+
+class _Entry(object):
+  """A cached value, or error, with its expiry time."""
+
+  __slots__ = ('value', 'error', 'expiry')
+
+  def __init__(self, value, error, expiry):
+    self.value = value
+    self.error = error
+    self.expiry = expiry
+
+
+class _Flight(object):
+  """A resolution in progress that other callers can wait on."""
+
+  __slots__ = ('done', 'value', 'error')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+
+
+class ResolutionCache(object):
+  """Thread-safe LRU cache with per-entry TTL and single-flight misses."""
+
+  def __init__(self, max_size=1024, negative_ttl=0, clock=time.time):
+    """Initializes the cache.
+
+    Args:
+      max_size: Maximum number of entries kept.
+      negative_ttl: Number of seconds failed resolutions are cached for. Zero
+        disables negative caching.
+      clock: Function returning the current time in seconds.
+    """
+    self._max_size = max_size
+    self._negative_ttl = negative_ttl
+    self._clock = clock
+    self._entries = collections.OrderedDict()
+    self._inflight = {}
+    self._lock = threading.Lock()
+    self._stats = collections.Counter()
+
+  def Get(self, key, resolve, ttl=NO_EXPIRY, validate=None):
+    """Returns the resolution of |key|, calling |resolve| on a miss.
+
+    Args:
+      key: A hashable key.
+      resolve: Function called without arguments to resolve |key|. Exceptions
+        it raises are propagated to every caller waiting on it.
+      ttl: Number of seconds the result stays valid, NO_EXPIRY for ever. Zero
+        means the result is not cached, only shared with concurrent callers.
+      validate: Optional function called with a cached value; a false return
+        value drops the entry and resolves |key| again.
+
+    Returns:
+      The (possibly cached) return value of |resolve|.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and (entry.expiry is not None and
+                                entry.expiry <= self._clock()):
+        del self._entries[key]
+        self._stats['expired'] += 1
+        entry = None
+      if entry is not None and entry.error is not None:
+        self._entries[key] = self._entries.pop(key)
+        self._stats['negative_hits'] += 1
+        raise entry.error
+
+    if entry is not None:
+      if validate is None or validate(entry.value):
+        with self._lock:
+          self._stats['hits'] += 1
+          if key in self._entries:
+            self._entries[key] = self._entries.pop(key)
+        return entry.value
+      with self._lock:
+        self._stats['invalid'] += 1
+        if self._entries.get(key) is entry:
+          del self._entries[key]
+
+    with self._lock:
+      flight = self._inflight.get(key)
+      owner = flight is None
+      if owner:
+        flight = self._inflight[key] = _Flight()
+        self._stats['misses'] += 1
+      else:
+        self._stats['coalesced'] += 1
+
+    if not owner:
+      flight.done.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.value
+
+    try:
+      flight.value = resolve()
+    except Exception as e:
+      flight.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._inflight[key]
+        if flight.error is not None:
+          self._stats['errors'] += 1
+          if self._negative_ttl:
+            self._Put(key, _Entry(None, flight.error,
+                                  self._clock() + self._negative_ttl))
+        elif ttl != 0:
+          self._Put(key, _Entry(flight.value, None,
+                                None if ttl is None else self._clock() + ttl))
+      flight.done.set()
+    return flight.value
+
+  def _Put(self, key, entry):
+    """Adds an entry, evicting the least recently used ones. Lock is held."""
+    self._entries.pop(key, None)
+    self._entries[key] = entry
+    while len(self._entries) > self._max_size:
+      self._entries.popitem(last=False)
+      self._stats['evictions'] += 1
+
+  def Invalidate(self, predicate=None, errors_only=False):
+    """Drops cached entries.
+
+    Args:
+      predicate: Optional function called with each key, only the entries for
+        which it returns True are dropped. All entries are dropped if None.
+      errors_only: Only drop the cached failures, e.g. because what could not
+        be resolved may have appeared.
+
+    Returns:
+      The number of entries dropped.
+    """
+    with self._lock:
+      keys = [k for k, entry in self._entries.items()
+              if (predicate is None or predicate(k)) and
+              (not errors_only or entry.error is not None)]
+      for key in keys:
+        del self._entries[key]
+      self._stats['invalidated'] += len(keys)
+      return len(keys)
+
+  def GetStats(self):
+    """Returns a dict of counters describing the cache activity."""
+    with self._lock:
+      stats = dict(self._stats)
+      stats['size'] = len(self._entries)
+    lookups = (stats.get('hits', 0) + stats.get('negative_hits', 0) +
+               stats.get('misses', 0) + stats.get('coalesced', 0))
+    stats['hit_ratio'] = (
+        float(stats.get('hits', 0) + stats.get('negative_hits', 0) +
+              stats.get('coalesced', 0)) / lookups if lookups else 0.0)
+    return stats
@@ -0,0 +1,137 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for resolution_cache.py."""
+
+from __future__ import print_function
+
+import threading
+import time
+import unittest
+
+import mock
+
+import resolution_cache
+
+
+class ResolutionCacheTest(unittest.TestCase):
+  """Tests for the ResolutionCache class."""
+
+  def setUp(self):
+    self.now = 1000.0
+    self.cache = resolution_cache.ResolutionCache(max_size=3,
+                                                  clock=lambda: self.now)
+
+  def testNoExpiry(self):
+    """Tests entries without TTL are resolved once."""
+    resolve = mock.Mock(return_value='R26-4000.0.0')
+    for _ in range(3):
+      self.assertEqual(self.cache.Get('k', resolve), 'R26-4000.0.0')
+      self.now += 10 ** 6
+    self.assertEqual(resolve.call_count, 1)
+    stats = self.cache.GetStats()
+    self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+  def testTTL(self):
+    """Tests entries are resolved again once expired."""
+    resolve = mock.Mock(side_effect=['a', 'b'])
+    self.assertEqual(self.cache.Get('k', resolve, ttl=60), 'a')
+    self.now += 59
+    self.assertEqual(self.cache.Get('k', resolve, ttl=60), 'a')
+    self.now += 1
+    self.assertEqual(self.cache.Get('k', resolve, ttl=60), 'b')
+    self.assertEqual(self.cache.GetStats()['expired'], 1)
+
+  def testZeroTTL(self):
+    """Tests a zero TTL disables caching."""
+    resolve = mock.Mock(side_effect=['a', 'b'])
+    self.assertEqual(self.cache.Get('k', resolve, ttl=0), 'a')
+    self.assertEqual(self.cache.Get('k', resolve, ttl=0), 'b')
+
+  def testValidate(self):
+    """Tests entries failing validation are resolved again."""
+    resolve = mock.Mock(side_effect=['a', 'b'])
+    self.assertEqual(self.cache.Get('k', resolve), 'a')
+    self.assertEqual(
+        self.cache.Get('k', resolve, validate=lambda v: v != 'a'), 'b')
+    self.assertEqual(
+        self.cache.Get('k', resolve, validate=lambda v: v != 'a'), 'b')
+    self.assertEqual(resolve.call_count, 2)
+
+  def testErrorsNotCachedByDefault(self):
+    """Tests failed resolutions are retried."""
+    resolve = mock.Mock(side_effect=[ValueError('boom'), 'a'])
+    with self.assertRaises(ValueError):
+      self.cache.Get('k', resolve)
+    self.assertEqual(self.cache.Get('k', resolve), 'a')
+
+  def testNegativeTTL(self):
+    """Tests failed resolutions are cached for the negative TTL."""
+    cache = resolution_cache.ResolutionCache(negative_ttl=5,
+                                             clock=lambda: self.now)
+    resolve = mock.Mock(side_effect=[ValueError('boom'), 'a'])
+    for _ in range(2):
+      with self.assertRaises(ValueError):
+        cache.Get('k', resolve)
+    self.assertEqual(resolve.call_count, 1)
+    self.now += 5
+    self.assertEqual(cache.Get('k', resolve), 'a')
+
+  def testEviction(self):
+    """Tests the least recently used entries are evicted."""
+    for key in 'abc':
+      self.cache.Get(key, lambda k=key: k)
+    self.cache.Get('a', None)
+    self.cache.Get('d', lambda: 'd')
+    resolve = mock.Mock(return_value='b')
+    self.cache.Get('b', resolve)
+    self.assertTrue(resolve.called)
+    self.assertEqual(self.cache.Get('a', None), 'a')
+
+  def testInvalidate(self):
+    """Tests entries can be invalidated selectively."""
+    for key in ('x1', 'x2', 'y1'):
+      self.cache.Get(key, lambda k=key: k)
+    self.assertEqual(self.cache.Invalidate(lambda k: k.startswith('x')), 2)
+    self.assertEqual(self.cache.GetStats()['size'], 1)
+    self.assertEqual(self.cache.Invalidate(), 1)
+
+  def testInvalidateErrors(self):
+    """Tests cached failures can be invalidated alone."""
+    cache = resolution_cache.ResolutionCache(negative_ttl=5,
+                                             clock=lambda: self.now)
+    cache.Get('a', lambda: 'a')
+    with self.assertRaises(ValueError):
+      cache.Get('b', mock.Mock(side_effect=ValueError('boom')))
+    self.assertEqual(cache.Invalidate(errors_only=True), 1)
+    self.assertEqual(cache.Get('b', lambda: 'b'), 'b')
+    self.assertEqual(cache.GetStats()['size'], 2)
+
+  def testSingleFlight(self):
+    """Tests concurrent misses on the same key resolve it once."""
+    calls = []
+    results = []
+    cache = resolution_cache.ResolutionCache()
+
+    def _Resolve():
+      calls.append(1)
+      time.sleep(0.2)
+      return 'latest'
+
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.Get('k', _Resolve, ttl=0)))
+               for _ in range(5)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(results, ['latest'] * 5)
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(cache.GetStats()['coalesced'], 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Per-RPC request metrics for the devserver.
+
+RpcMetricsTool is a cherrypy tool recording, for each RPC (the exposed
+attribute of the root application handling the request, e.g. 'stage' or
+'update', or the mount point of another application, e.g. 'static'):
+  - the number of finished requests per response status code,
+  - the number of requests in flight,
+  - a latency histogram with logarithmic buckets, from the start of the
+    request handling to the end of the response, body streaming included,
+  - the number of response bytes.
+
+RpcMetrics holds the data and formats it in the Prometheus text exposition
+format or as a JSON-able dictionary. Recording a request costs two lock
+acquisitions and a bisection, so the tool can stay on for every request.
+
+The workers of a pre-fork devserver each have their own RpcMetrics. Their
+states (see GetState) are shared through prefork.WorkerStats, and combined
+with RpcMetrics.Merge to report the metrics of the whole server.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import collections
+import threading
+import time
+
+import cherrypy  # pylint: disable=import-error
+
+
+# Upper bounds of the latency histogram buckets in seconds: 1ms to ~17min,
+# doubling at each bucket. The last, implicit, bucket is +Inf.
+LATENCY_BUCKETS = tuple(0.001 * 2 ** i for i in range(21))
+
+# Maximum number of distinct RPC names tracked; requests for more names are
+# counted under _OTHER_RPC, as are the requests for paths without a handler.
+_MAX_RPCS = 64
+_OTHER_RPC = 'other'
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _RpcStats(object):
+  """Metrics of one RPC. Protected by the lock of RpcMetrics."""
+
+  def __init__(self):
+    self.in_flight = 0
+    self.responses = collections.Counter()
+    self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+    self.latency_sum = 0.0
+    self.response_bytes = 0
+
+
+class _Request(object):
+  """State of a request being recorded."""
+
+  __slots__ = ('stats', 'start', 'response_bytes')
+
+  def __init__(self, stats, start):
+    self.stats = stats
+    self.start = start
+    self.response_bytes = None
+
+
+class RpcMetrics(object):
+  """Thread-safe store of per-RPC metrics."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._rpcs = {}
+
+  def Start(self, rpc):
+    """Records the start of a request to |rpc|, returns its state."""
+    with self._lock:
+      stats = self._rpcs.get(rpc)
+      if stats is None:
+        if len(self._rpcs) >= _MAX_RPCS:
+          rpc = _OTHER_RPC
+        stats = self._rpcs.setdefault(rpc, _RpcStats())
+      stats.in_flight += 1
+    return _Request(stats, time.time())
+
+  def Finish(self, request, status, response_bytes):
+    """Records the end of |request|.
+
+    Args:
+      request: The state returned by Start().
+      status: The HTTP status code of the response.
+      response_bytes: Number of bytes in the response body.
+    """
+    latency = time.time() - request.start
+    bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+    stats = request.stats
+    with self._lock:
+      stats.in_flight -= 1
+      stats.responses[status] += 1
+      stats.buckets[bucket] += 1
+      stats.latency_sum += latency
+      stats.response_bytes += response_bytes
+
+  def _Copy(self):
+    """Returns a consistent copy of the per-RPC stats."""
+    with self._lock:
+      copies = {}
+      for rpc, stats in self._rpcs.items():
+        copy = _RpcStats()
+        copy.in_flight = stats.in_flight
+        copy.responses = collections.Counter(stats.responses)
+        copy.buckets = list(stats.buckets)
+        copy.latency_sum = stats.latency_sum
+        copy.response_bytes = stats.response_bytes
+        copies[rpc] = copy
+      return copies
+
+  def GetState(self):
+    """Returns the raw metrics as a JSON serializable dictionary.
+
+    See Merge() to combine the states of several RpcMetrics.
+    """
+    state = {}
+    for rpc, stats in self._Copy().items():
+      state[rpc] = {
+          'in_flight': stats.in_flight,
+          'responses': dict((str(k), v) for k, v in stats.responses.items()),
+          'buckets': stats.buckets,
+          'latency_sum': stats.latency_sum,
+          'response_bytes': stats.response_bytes,
+      }
+    return state
+
+  @classmethod
+  def Merge(cls, states):
+    """Returns an RpcMetrics with the sum of the metrics of |states|.
+
+    Args:
+      states: A list of states returned by GetState(), e.g. by each worker of
+        a pre-fork devserver. None entries are skipped.
+    """
+    merged = cls()
+    for state in states:
+      if state is None:
+        continue
+      for rpc, rpc_state in state.items():
+        stats = merged._rpcs.setdefault(rpc, _RpcStats())
+        stats.in_flight += rpc_state['in_flight']
+        for code, count in rpc_state['responses'].items():
+          stats.responses[int(code)] += count
+        for i, count in enumerate(rpc_state['buckets']):
+          stats.buckets[i] += count
+        stats.latency_sum += rpc_state['latency_sum']
+        stats.response_bytes += rpc_state['response_bytes']
+    return merged
+
+  def GetSnapshot(self):
+    """Returns the metrics as a dictionary keyed by RPC name.
+
+    Latency percentiles are estimated as the upper bound of the bucket they
+    fall in.
+    """
+    snapshot = {}
+    for rpc, stats in sorted(self._Copy().items()):
+      count = sum(stats.buckets)
+      percentiles = {}
+      for name, quantile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        percentiles['latency_%s_seconds' % name] = _EstimateQuantile(
+            stats.buckets, count, quantile)
+      snapshot[rpc] = dict(
+          requests=count,
+          responses=dict((str(k), v) for k, v in stats.responses.items()),
+          in_flight=stats.in_flight,
+          latency_sum_seconds=round(stats.latency_sum, 6),
+          latency_buckets=dict(zip(
+              ['%g' % b for b in LATENCY_BUCKETS] + ['+Inf'],
+              _Cumulate(stats.buckets))),
+          response_bytes=stats.response_bytes,
+          **percentiles)
+    return snapshot
+
+  def FormatPrometheus(self):
+    """Returns the metrics in the Prometheus text exposition format."""
+    rpcs = [(_EscapeLabel(rpc), stats)
+            for rpc, stats in sorted(self._Copy().items())]
+    lines = [
+        '# HELP devserver_rpc_requests_total Finished requests per RPC and '
+        'status code.',
+        '# TYPE devserver_rpc_requests_total counter',
+    ]
+    for label, stats in rpcs:
+      for code, count in sorted(stats.responses.items()):
+        lines.append('devserver_rpc_requests_total{rpc="%s",code="%s"} %d' %
+                     (label, code, count))
+    lines += [
+        '# HELP devserver_rpc_in_flight Requests being handled per RPC.',
+        '# TYPE devserver_rpc_in_flight gauge',
+    ]
+    for label, stats in rpcs:
+      lines.append('devserver_rpc_in_flight{rpc="%s"} %d' %
+                   (label, stats.in_flight))
+    lines += [
+        '# HELP devserver_rpc_latency_seconds Request latency per RPC, '
+        'response streaming included.',
+        '# TYPE devserver_rpc_latency_seconds histogram',
+    ]
+    for label, stats in rpcs:
+      bounds = ['%g' % b for b in LATENCY_BUCKETS] + ['+Inf']
+      for bound, count in zip(bounds, _Cumulate(stats.buckets)):
+        lines.append('devserver_rpc_latency_seconds_bucket{rpc="%s",le="%s"} '
+                     '%d' % (label, bound, count))
+      lines.append('devserver_rpc_latency_seconds_sum{rpc="%s"} %.6f' %
+                   (label, stats.latency_sum))
+      lines.append('devserver_rpc_latency_seconds_count{rpc="%s"} %d' %
+                   (label, sum(stats.buckets)))
+    lines += [
+        '# HELP devserver_rpc_response_bytes_total Response body bytes per '
+        'RPC.',
+        '# TYPE devserver_rpc_response_bytes_total counter',
+    ]
+    for label, stats in rpcs:
+      lines.append('devserver_rpc_response_bytes_total{rpc="%s"} %d' %
+                   (label, stats.response_bytes))
+    return '\n'.join(lines) + '\n'
+
+
+def _EscapeLabel(value):
+  """Escapes a label value for the Prometheus text exposition format."""
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _Cumulate(buckets):
+  """Returns the cumulative counts of |buckets|."""
+  total = 0
+  cumulated = []
+  for count in buckets:
+    total += count
+    cumulated.append(total)
+  return cumulated
+
+
+def _EstimateQuantile(buckets, count, quantile):
+  """Returns the upper bound of the bucket holding |quantile|, or None."""
+  if not count:
+    return None
+  rank = quantile * count
+  for bound, cumulated in zip(LATENCY_BUCKETS, _Cumulate(buckets)):
+    if cumulated >= rank:
+      return bound
+  return float('inf')
+
+
+def _CountingBody(body, request):
+  """Yields the chunks of |body|, counting their size in |request|."""
+  for chunk in body:
+    request.response_bytes += len(chunk)
+    yield chunk
+
+
+class RpcMetricsTool(cherrypy.Tool):
+  """Cherrypy tool recording the requests in an RpcMetrics."""
+
+  def __init__(self, metrics):
+    super(RpcMetricsTool, self).__init__('on_start_resource', self._NoOp,
+                                         name='rpc_metrics')
+    self.metrics = metrics
+
+  @staticmethod
+  def _NoOp():
+    pass
+
+  @staticmethod
+  def _GetRpc(request):
+    """Returns the RPC name of |request|, once its handler is dispatched.
+
+    The name is that of the exposed attribute of the root application matching
+    the request, or the mount point of the other applications, so that the
+    names are bounded by the code and not by the requested paths. Requests
+    without a handler, answered with 404, are counted under _OTHER_RPC.
+    """
+    if (request.handler is None or
+        isinstance(request.handler, cherrypy.NotFound)):
+      return _OTHER_RPC
+    if request.script_name:
+      return request.script_name.strip('/').split('/', 1)[0]
+    name = request.path_info.strip('/').split('/', 1)[0]
+    if not name:
+      return 'index'
+    # The default dispatcher looks attributes up with dots replaced.
+    name = name.replace('.', '_')
+    if getattr(request.app.root, name, None) is None:
+      return _OTHER_RPC
+    return name
+
+  def _setup(self):
+    """Hooks the current request; called by cherrypy when the tool is on."""
+    request = cherrypy.serving.request
+    state = self.metrics.Start(self._GetRpc(request))
+    request.hooks.attach('before_finalize', self._WrapBody, state=state)
+    request.hooks.attach('on_end_request', self._Finish, failsafe=True,
+                         state=state)
+
+  @staticmethod
+  def _WrapBody(state):
+    """Counts the bytes of streamed bodies, whose size is not known."""
+    response = cherrypy.serving.response
+    if response.stream and 'Content-Length' not in response.headers:
+      state.response_bytes = 0
+      response.body = _CountingBody(response.body, state)
+
+  def _Finish(self, state):
+    response = cherrypy.serving.response
+    try:
+      status = int(str(response.status).split(None, 1)[0])
+    except ValueError:
+      status = 500
+    response_bytes = state.response_bytes
+    if response_bytes is None:
+      try:
+        response_bytes = int(response.headers.get('Content-Length', 0))
+      except ValueError:
+        response_bytes = 0
+    self.metrics.Finish(state, status, response_bytes)
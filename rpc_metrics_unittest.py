@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for rpc_metrics.py."""
+
+from __future__ import print_function
+
+import json
+import time
+import unittest
+
+import cherrypy  # pylint: disable=import-error
+import mock
+from six.moves import http_client
+
+import rpc_metrics
+
+
+class RpcMetricsTest(unittest.TestCase):
+  """Tests for the RpcMetrics class."""
+
+  def setUp(self):
+    self.metrics = rpc_metrics.RpcMetrics()
+
+  def _Record(self, rpc, latency, status=200, response_bytes=10):
+    with mock.patch('time.time', return_value=100.0):
+      state = self.metrics.Start(rpc)
+    with mock.patch('time.time', return_value=100.0 + latency):
+      self.metrics.Finish(state, status, response_bytes)
+
+  def testSnapshot(self):
+    """Tests counts, latency percentiles and bytes are reported."""
+    for _ in range(9):
+      self._Record('stage', 0.0015)
+    self._Record('stage', 3, status=500, response_bytes=5)
+    in_flight = self.metrics.Start('stage')
+
+    snapshot = self.metrics.GetSnapshot()['stage']
+    self.assertEqual(snapshot['requests'], 10)
+    self.assertEqual(snapshot['responses'], {'200': 9, '500': 1})
+    self.assertEqual(snapshot['in_flight'], 1)
+    self.assertEqual(snapshot['response_bytes'], 95)
+    self.assertEqual(snapshot['latency_p50_seconds'], 0.002)
+    self.assertEqual(snapshot['latency_p99_seconds'], 4.096)
+    self.assertEqual(snapshot['latency_buckets']['0.002'], 9)
+    self.assertEqual(snapshot['latency_buckets']['+Inf'], 10)
+
+    self.metrics.Finish(in_flight, 200, 0)
+    self.assertEqual(self.metrics.GetSnapshot()['stage']['in_flight'], 0)
+
+  def testPrometheus(self):
+    """Tests the Prometheus text format."""
+    self._Record('update', 0.0005)
+    text = self.metrics.FormatPrometheus()
+    self.assertIn('devserver_rpc_requests_total{rpc="update",code="200"} 1\n',
+                  text)
+    self.assertIn('devserver_rpc_in_flight{rpc="update"} 0\n', text)
+    self.assertIn(
+        'devserver_rpc_latency_seconds_bucket{rpc="update",le="0.001"} 1\n',
+        text)
+    self.assertIn(
+        'devserver_rpc_latency_seconds_bucket{rpc="update",le="+Inf"} 1\n',
+        text)
+    self.assertIn('devserver_rpc_latency_seconds_count{rpc="update"} 1\n',
+                  text)
+    self.assertIn('devserver_rpc_response_bytes_total{rpc="update"} 10\n',
+                  text)
+
+  def testMerge(self):
+    """Tests the states of several RpcMetrics are summed."""
+    self._Record('stage', 0.0015)
+    self._Record('stage', 3, status=500, response_bytes=5)
+    other = rpc_metrics.RpcMetrics()
+    other.Start('stage')
+    other.Finish(other.Start('stage'), 200, 20)
+    other.Finish(other.Start('update'), 200, 1)
+    # The states are published as JSON.
+    states = [json.loads(json.dumps(m.GetState()))
+              for m in (self.metrics, other)]
+
+    snapshot = rpc_metrics.RpcMetrics.Merge(states + [None]).GetSnapshot()
+    self.assertEqual(snapshot['stage']['requests'], 3)
+    self.assertEqual(snapshot['stage']['responses'], {'200': 2, '500': 1})
+    self.assertEqual(snapshot['stage']['in_flight'], 1)
+    self.assertEqual(snapshot['stage']['response_bytes'], 35)
+    self.assertEqual(snapshot['stage']['latency_buckets']['+Inf'], 3)
+    self.assertEqual(snapshot['update']['requests'], 1)
+
+  def testPrometheusEscapesLabels(self):
+    """Tests label values are escaped."""
+    self._Record('a"b\\c\nd', 0)
+    self.assertIn('devserver_rpc_in_flight{rpc="a\\"b\\\\c\\nd"} 0\n',
+                  self.metrics.FormatPrometheus())
+
+  def testRpcNamesBounded(self):
+    """Tests unbounded RPC names are folded together."""
+    for i in range(200):
+      self._Record('random%d' % i, 0)
+    snapshot = self.metrics.GetSnapshot()
+    self.assertLessEqual(len(snapshot), 65)
+    self.assertIn('other', snapshot)
+
+
+class RpcMetricsToolTest(unittest.TestCase):
+  """Tests the tool through a running cherrypy server."""
+
+  class _App(object):
+    """A small cherrypy application."""
+
+    @cherrypy.expose
+    def index(self):
+      return 'index'
+
+    @cherrypy.expose
+    def stream(self):
+      def _Body():
+        for _ in range(3):
+          yield b'x' * 100
+      return _Body()
+    stream._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def fail(self):
+      raise cherrypy.HTTPError(503)
+
+  @classmethod
+  def setUpClass(cls):
+    cls.metrics = rpc_metrics.RpcMetrics()
+    cherrypy.tools.rpc_metrics = rpc_metrics.RpcMetricsTool(cls.metrics)
+    cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                            'server.socket_port': 0,
+                            'log.screen': False,
+                            'engine.autoreload.on': False,
+                            'tools.rpc_metrics.on': True})
+    cherrypy.tree.mount(cls._App(), '/')
+    cherrypy.engine.start()
+    cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+    cls.port = cherrypy.server.bound_addr[1]
+
+  @classmethod
+  def tearDownClass(cls):
+    cherrypy.engine.exit()
+    cherrypy.config.update({'tools.rpc_metrics.on': False})
+
+  def _Get(self, path):
+    conn = http_client.HTTPConnection('127.0.0.1', self.port)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status
+
+  def testRequestsRecorded(self):
+    """Tests handled, streamed and failed requests are recorded."""
+    self.assertEqual(self._Get('/'), 200)
+    self.assertEqual(self._Get('/stream'), 200)
+    self.assertEqual(self._Get('/fail'), 503)
+    # Requests are recorded once the response is sent, wait for the last one.
+    for _ in range(100):
+      snapshot = self.metrics.GetSnapshot()
+      if snapshot.get('fail', {}).get('requests'):
+        break
+      time.sleep(0.01)
+    self.assertEqual(snapshot['index']['responses'], {'200': 1})
+    self.assertEqual(snapshot['index']['response_bytes'], 5)
+    self.assertEqual(snapshot['stream']['response_bytes'], 300)
+    self.assertEqual(snapshot['fail']['responses'], {'503': 1})
+    self.assertEqual(snapshot['fail']['in_flight'], 0)
+
+  def testUnknownPathsNotNamed(self):
+    """Tests requests without a handler are counted as other RPCs."""
+    for i in range(70):
+      self.assertEqual(self._Get('/junk%d%%22x' % i), 404)
+    self.assertEqual(self._Get('/stream/'), 200)
+    for _ in range(100):
+      snapshot = self.metrics.GetSnapshot()
+      if snapshot.get('other', {}).get('requests') == 70:
+        break
+      time.sleep(0.01)
+    self.assertEqual(snapshot['other']['responses'], {'404': 70})
+    self.assertFalse([rpc for rpc in snapshot if rpc.startswith('junk')])
+    self.assertGreaterEqual(snapshot['stream']['requests'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
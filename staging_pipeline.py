@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Concurrent staging of the artifacts of builds.
+
+A stage request naming several artifacts used to download and process
+(extract, verify) them one after another. The StagingPipeline runs one job per
+artifact instead, each downloading and processing its artifact, so that large
+artifacts download side by side and the extraction of an artifact overlaps the
+download of the next ones.
+
+The number of jobs running at once is bounded per build and for the whole
+devserver, to not saturate the network link or the disks. The duration of the
+jobs and how long they waited for their turn are recorded per artifact.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import sys
+import threading
+import time
+
+import six
+
+
+# Default number of jobs running at once on the devserver.
+DEFAULT_MAX_JOBS = 8
+# Default number of jobs running at once for a single build.
+DEFAULT_MAX_JOBS_PER_BUILD = 4
+
+
+class StagingPipeline(object):
+  """Runs the staging jobs of builds concurrently, within bounds."""
+
+  def __init__(self, max_jobs=DEFAULT_MAX_JOBS,
+               max_jobs_per_build=DEFAULT_MAX_JOBS_PER_BUILD,
+               job_semaphore=None, clock=time.time):
+    """Initializes the pipeline.
+
+    Args:
+      max_jobs: Maximum number of jobs running at once, for all builds.
+      max_jobs_per_build: Maximum number of jobs running at once for a build.
+      job_semaphore: The semaphore bounding the jobs of all builds, e.g. a
+        multiprocessing.BoundedSemaphore shared by the workers of a pre-fork
+        devserver. Defaults to a semaphore of |max_jobs|.
+      clock: The function returning the current time in seconds.
+    """
+    if max_jobs < 1 or max_jobs_per_build < 1:
+      raise ValueError('The staging job bounds must be at least 1: %d, %d' %
+                       (max_jobs, max_jobs_per_build))
+    self.max_jobs = max_jobs
+    self.max_jobs_per_build = max_jobs_per_build
+    self._job_semaphore = job_semaphore or threading.BoundedSemaphore(max_jobs)
+    self._clock = clock
+    self._lock = threading.Lock()
+    # Semaphore of each build being staged, with the number of Stage() calls
+    # using it.
+    self._builds = {}
+    self._queued = 0
+    self._running = 0
+    self._stats = collections.defaultdict(collections.Counter)
+
+  def _AcquireBuild(self, build):
+    """Returns the semaphore of |build|, creating it if needed."""
+    with self._lock:
+      entry = self._builds.get(build)
+      if entry is None:
+        entry = self._builds[build] = [
+            threading.BoundedSemaphore(self.max_jobs_per_build), 0]
+      entry[1] += 1
+      return entry[0]
+
+  def _ReleaseBuild(self, build):
+    """Forgets the semaphore of |build| once no Stage() call uses it."""
+    with self._lock:
+      entry = self._builds[build]
+      entry[1] -= 1
+      if not entry[1]:
+        del self._builds[build]
+
+  def _Record(self, name, wait, duration, failed):
+    """Records a job of artifact |name|, all times in seconds."""
+    with self._lock:
+      stats = self._stats[name]
+      stats['count'] += 1
+      stats['errors'] += int(failed)
+      stats['total_seconds'] += duration
+      stats['max_ms'] = max(stats['max_ms'], duration * 1000)
+      stats['last_ms'] = duration * 1000
+      stats['queue_wait_max_ms'] = max(stats['queue_wait_max_ms'], wait * 1000)
+
+  def _Run(self, build_semaphore, name, job):
+    """Runs |job| once the build and global bounds allow it."""
+    queued = self._clock()
+    with self._lock:
+      self._queued += 1
+    with build_semaphore, self._job_semaphore:
+      start = self._clock()
+      with self._lock:
+        self._queued -= 1
+        self._running += 1
+      failed = True
+      try:
+        job()
+        failed = False
+      finally:
+        with self._lock:
+          self._running -= 1
+        self._Record(name, start - queued, self._clock() - start, failed)
+
+  def Stage(self, build, jobs):
+    """Runs the staging jobs of |build| concurrently.
+
+    All the jobs are run, even if some fail. Each job runs in its own thread,
+    waiting for the bounds to allow it.
+
+    Args:
+      build: A key identifying the build, e.g. its staging directory.
+      jobs: A list of (name, function) pairs, |name| being the artifact under
+        which the timings of the function are recorded.
+
+    Raises:
+      The exception raised by the first failed job, in the order of |jobs|.
+    """
+    if not jobs:
+      return
+    build_semaphore = self._AcquireBuild(build)
+    try:
+      if len(jobs) == 1:
+        name, job = jobs[0]
+        self._Run(build_semaphore, name, job)
+        return
+      errors = [None] * len(jobs)
+
+      def _RunJob(index, name, job):
+        try:
+          self._Run(build_semaphore, name, job)
+        except Exception:  # pylint: disable=broad-except
+          errors[index] = sys.exc_info()
+
+      threads = [threading.Thread(target=_RunJob, args=(index, name, job),
+                                  name='stage-%s' % name)
+                 for index, (name, job) in enumerate(jobs)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      for error in errors:
+        if error:
+          six.reraise(*error)
+    finally:
+      self._ReleaseBuild(build)
+
+  def GetStats(self):
+    """Returns the number of current jobs and the timings of the artifacts."""
+    with self._lock:
+      artifacts = {}
+      for name, counters in self._stats.items():
+        stats = dict(counters)
+        stats['total_seconds'] = round(stats['total_seconds'], 3)
+        for key in ('max_ms', 'last_ms', 'queue_wait_max_ms'):
+          stats[key] = round(stats[key], 1)
+        artifacts[name] = stats
+      return {
+          'running_jobs': self._running,
+          'queued_jobs': self._queued,
+          'artifacts': artifacts,
+      }
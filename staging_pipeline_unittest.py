@@ -0,0 +1,179 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for staging_pipeline.py."""
+
+from __future__ import print_function
+
+import collections
+import functools
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+import staging_pipeline
+
+
+class FakeDownloader(object):
+  """Stages the tarball artifacts of a build from a local fake GS directory.
+
+  Each artifact is copied, as slowly as its download delay says, then
+  extracted in a directory of the build named after it. The start and end of
+  each step are logged.
+  """
+
+  def __init__(self, gs_dir, build_dir, delays):
+    self.gs_dir = gs_dir
+    self.build_dir = build_dir
+    self.delays = delays
+    self.log = []
+    self.running = 0
+    self.max_running = 0
+    self._lock = threading.Lock()
+
+  def _Log(self, artifact, event):
+    with self._lock:
+      self.log.append((artifact, event))
+
+  def Download(self, artifact):
+    with self._lock:
+      self.running += 1
+      self.max_running = max(self.max_running, self.running)
+    try:
+      tarball = os.path.join(self.build_dir, artifact + '.tar')
+      self._Log(artifact, 'download')
+      shutil.copy(os.path.join(self.gs_dir, artifact + '.tar'), tarball)
+      time.sleep(self.delays.get(artifact, 0.01))
+      self._Log(artifact, 'downloaded')
+      tar = tarfile.open(tarball)
+      tar.extractall(os.path.join(self.build_dir, artifact))
+      tar.close()
+      self._Log(artifact, 'extracted')
+    finally:
+      with self._lock:
+        self.running -= 1
+
+
+class StagingPipelineTest(unittest.TestCase):
+  """Tests for the StagingPipeline class."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp(prefix='staging_pipeline')
+    self.gs_dir = os.path.join(self.tempdir, 'gs')
+    os.mkdir(self.gs_dir)
+    for artifact in ('autotest_packages', 'test_suites', 'full_payload',
+                     'stateful'):
+      tar = tarfile.open(os.path.join(self.gs_dir, artifact + '.tar'), 'w')
+      data = artifact.encode('utf-8')
+      info = tarfile.TarInfo(artifact + '.txt')
+      info.size = len(data)
+      tar.addfile(info, io.BytesIO(data))
+      tar.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _Downloader(self, build, delays=None):
+    build_dir = os.path.join(self.tempdir, build)
+    os.mkdir(build_dir)
+    return FakeDownloader(self.gs_dir, build_dir, delays or {})
+
+  @staticmethod
+  def _Jobs(dl, artifacts):
+    return [(artifact, functools.partial(dl.Download, artifact))
+            for artifact in artifacts]
+
+  def testStage(self):
+    """Tests all the artifacts are staged and their timings recorded."""
+    pipeline = staging_pipeline.StagingPipeline()
+    dl = self._Downloader('build')
+    artifacts = ['autotest_packages', 'test_suites', 'stateful']
+    pipeline.Stage(dl.build_dir, self._Jobs(dl, artifacts))
+    for artifact in artifacts:
+      with open(os.path.join(dl.build_dir, artifact,
+                             artifact + '.txt')) as f:
+        self.assertEqual(f.read(), artifact)
+
+    stats = pipeline.GetStats()
+    self.assertEqual((stats['running_jobs'], stats['queued_jobs']), (0, 0))
+    self.assertEqual(sorted(stats['artifacts']), sorted(artifacts))
+    for artifact in artifacts:
+      self.assertEqual(stats['artifacts'][artifact]['count'], 1)
+      self.assertEqual(stats['artifacts'][artifact]['errors'], 0)
+      self.assertGreater(stats['artifacts'][artifact]['max_ms'], 0)
+
+  def testExtractionOverlapsDownloads(self):
+    """Tests an artifact is extracted while a larger one downloads."""
+    pipeline = staging_pipeline.StagingPipeline()
+    dl = self._Downloader('build', {'full_payload': 0.5, 'stateful': 0.01})
+    pipeline.Stage(dl.build_dir,
+                   self._Jobs(dl, ['full_payload', 'stateful']))
+    log = dl.log
+    self.assertLess(log.index(('stateful', 'extracted')),
+                    log.index(('full_payload', 'downloaded')))
+
+  def testBounds(self):
+    """Tests the number of jobs running at once is bounded."""
+    pipeline = staging_pipeline.StagingPipeline(max_jobs=3,
+                                                max_jobs_per_build=2)
+    artifacts = ['autotest_packages', 'test_suites', 'full_payload',
+                 'stateful']
+    delays = dict.fromkeys(artifacts, 0.05)
+    downloaders = [self._Downloader(build, delays)
+                   for build in ('build1', 'build2')]
+    running = collections.Counter()
+    lock = threading.Lock()
+
+    def _Job(dl, artifact):
+      with lock:
+        running['total'] += 1
+        running['max'] = max(running['max'], running['total'])
+      try:
+        dl.Download(artifact)
+      finally:
+        with lock:
+          running['total'] -= 1
+
+    threads = [threading.Thread(
+        target=pipeline.Stage,
+        args=(dl.build_dir, [(a, functools.partial(_Job, dl, a))
+                             for a in artifacts]))
+               for dl in downloaders]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(running['max'], 3)
+    for dl in downloaders:
+      self.assertLessEqual(dl.max_running, 2)
+      self.assertEqual(len(dl.log), 3 * len(artifacts))
+    self.assertEqual(pipeline.GetStats()['artifacts']['stateful']['count'], 2)
+
+  def testErrors(self):
+    """Tests the other jobs run when one fails, whose error is raised."""
+    pipeline = staging_pipeline.StagingPipeline()
+    dl = self._Downloader('build')
+    jobs = self._Jobs(dl, ['missing', 'test_suites', 'stateful'])
+    with self.assertRaises(IOError):
+      pipeline.Stage(dl.build_dir, jobs)
+    self.assertTrue(os.path.isdir(os.path.join(dl.build_dir, 'stateful')))
+    self.assertTrue(os.path.isdir(os.path.join(dl.build_dir, 'test_suites')))
+    artifacts = pipeline.GetStats()['artifacts']
+    self.assertEqual(artifacts['missing']['errors'], 1)
+    self.assertEqual(artifacts['stateful']['errors'], 0)
+
+    # Builds being staged are forgotten once done.
+    self.assertEqual(pipeline._builds, {})  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+  unittest.main()
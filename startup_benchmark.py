@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Startup time benchmark of the devserver.
+
+Imports devserver (or --module) in fresh interpreters with python -X importtime
+and summarizes the cumulative import time of the module and of its slowest
+direct imports. Then starts devserver.py on an empty static directory and
+measures the time until it answers its first /check_health request. Both are
+the minimum over --runs runs, after a run warming up the bytecode caches.
+
+Fails if a module which should only be imported by the RPCs using it (see
+_LAZY_MODULES) is imported at startup, or if the import time exceeds
+--max_import_ms.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from six.moves import http_client
+
+
+_DEVSERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules importing most of chromite, which must not be imported before an RPC
+# needs them.
+_LAZY_MODULES = (
+    'chromite.lib.cros_build_lib',
+    'chromite.lib.cros_update_progress',
+    'chromite.lib.xbuddy.android_build',
+    'chromite.lib.xbuddy.build_artifact',
+    'chromite.lib.xbuddy.downloader',
+    'chromite.lib.xbuddy.xbuddy',
+)
+
+# Matches a line of python -X importtime:
+# import time: <self us> | <cumulative us> | <indentation><module>
+_IMPORT_TIME_RE = re.compile(
+    r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|'
+    r'(?P<indent> *)(?P<module>\S+)$')
+
+# Number of seconds to wait for the devserver to answer.
+_START_TIMEOUT = 60
+
+
+def ImportTimes(module):
+  """Imports |module| in a new interpreter.
+
+  Returns:
+    The cumulative import time of |module| in milliseconds, a dictionary of
+    the cumulative import time of each of its direct imports, and the set of
+    all the modules imported.
+  """
+  output = subprocess.check_output(
+      [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+      cwd=_DEVSERVER_DIR, stderr=subprocess.STDOUT).decode('utf-8')
+  total = None
+  direct = {}
+  imported = set()
+  for line in output.splitlines():
+    match = _IMPORT_TIME_RE.match(line)
+    if not match:
+      continue
+    name = match.group('module')
+    cumulative = int(match.group('cumulative')) / 1000
+    imported.add(name)
+    # Nested imports are listed before their importer, indented once more.
+    depth = (len(match.group('indent')) - 1) // 2
+    if depth == 0 and name == module:
+      total = cumulative
+    elif depth == 1:
+      direct[name] = direct.get(name, 0) + cumulative
+  if total is None:
+    raise AssertionError('%s was not imported: %s' % (module, output))
+  return total, direct, imported
+
+
+def TimeToFirstRequest():
+  """Starts devserver.py and returns the seconds until it answers."""
+  static_dir = tempfile.mkdtemp(prefix='startup_benchmark')
+  portfile = os.path.join(static_dir, 'port')
+  devnull = open(os.devnull, 'w')
+  start = time.time()
+  devserver = subprocess.Popen(
+      [sys.executable, os.path.join(_DEVSERVER_DIR, 'devserver.py'),
+       '--static_dir', static_dir, '--port', '0', '--portfile', portfile],
+      cwd=_DEVSERVER_DIR, stdout=devnull, stderr=devnull)
+  try:
+    while time.time() - start < _START_TIMEOUT:
+      if devserver.poll() is not None:
+        raise AssertionError('The devserver exited with %d' %
+                             devserver.returncode)
+      try:
+        with open(portfile) as f:
+          port = int(f.read())
+        conn = http_client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/check_health')
+        if conn.getresponse().status == http_client.OK:
+          return time.time() - start
+      except (IOError, ValueError, http_client.HTTPException):
+        pass
+      time.sleep(0.01)
+    raise AssertionError('The devserver did not answer in %ds' %
+                         _START_TIMEOUT)
+  finally:
+    devserver.send_signal(signal.SIGTERM)
+    devserver.wait()
+    devnull.close()
+    shutil.rmtree(static_dir)
+
+
+def ParseArguments(argv):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--module', default='devserver',
+                      help='Module whose import is measured.')
+  parser.add_argument('--runs', type=int, default=5,
+                      help='Number of measured runs.')
+  parser.add_argument('--top', type=int, default=10,
+                      help='Number of the slowest direct imports to report.')
+  parser.add_argument('--max_import_ms', type=float,
+                      help='Fail if importing the module takes longer.')
+  parser.add_argument('--no_server', action='store_true',
+                      help='Do not measure the time to the first request.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  opts = ParseArguments(argv)
+  ImportTimes(opts.module)
+  totals = []
+  direct = collections.defaultdict(list)
+  imported = set()
+  for _ in range(opts.runs):
+    total, run_direct, run_imported = ImportTimes(opts.module)
+    totals.append(total)
+    for name, cumulative in run_direct.items():
+      direct[name].append(cumulative)
+    imported |= run_imported
+
+  slowest = sorted(((min(times), name) for name, times in direct.items()),
+                   reverse=True)[:opts.top]
+  lazy_imported = sorted(imported.intersection(_LAZY_MODULES))
+  results = {
+      'import_ms': round(min(totals), 1),
+      'modules_imported': len(imported),
+      'slowest_direct_imports_ms': collections.OrderedDict(
+          (name, round(cumulative, 1)) for cumulative, name in slowest),
+      'lazy_modules_imported': lazy_imported,
+  }
+  if not opts.no_server:
+    TimeToFirstRequest()
+    results['time_to_first_request_ms'] = round(
+        min(TimeToFirstRequest() for _ in range(opts.runs)) * 1000, 1)
+  print(json.dumps(results, indent=2))
+
+  errors = []
+  if lazy_imported:
+    errors.append('Importing %s imports %s.' %
+                  (opts.module, ', '.join(lazy_imported)))
+  if opts.max_import_ms is not None and min(totals) > opts.max_import_ms:
+    errors.append('Importing %s takes %.1fms, more than %.1fms.' %
+                  (opts.module, min(totals), opts.max_import_ms))
+  for error in errors:
+    print(error, file=sys.stderr)
+  return 1 if errors else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
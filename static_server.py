@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A cherrypy application serving the devserver static directory.
+
+Payloads and images served from /static are several GB each, so this handler
+avoids copying them through Python where it can:
+  - file contents are sent with os.sendfile() straight from the page cache to
+    the client socket, falling back to reading chunks when sendfile is not
+    available (python 2, TLS sockets, other servers than cheroot),
+  - single and multiple byte ranges (multipart/byteranges) are supported, as
+    well as If-Range, If-None-Match and If-Modified-Since,
+  - accesses are reported to a callback which is expected to be cheap; see
+    AccessTimeBatcher to batch the resulting timestamp updates off the request
+    path.
+"""
+
+from __future__ import print_function
+
+import calendar
+import email.utils
+import errno
+import mimetypes
+import os
+import select
+import socket
+import stat
+import threading
+import uuid
+
+import cherrypy  # pylint: disable=import-error
+from cherrypy.process import plugins  # pylint: disable=import-error
+
+
+# Size of the chunks read when sendfile cannot be used.
+CHUNK_SIZE = 1024 * 1024
+
+# Size of the chunk yielded to get the response headers out before sendfile
+# takes over.
+_FIRST_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of bytes handed to one sendfile call.
+_SENDFILE_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Maximum number of ranges accepted in one request; more are served whole.
+_MAX_RANGES = 64
+
+
+def get_config():
+  """Get cherrypy config for this application."""
+  return {
+      '/': {
+          # Bodies are generators that must be sent as they are produced.
+          'response.stream': True,
+          'response.timeout': 10000,
+          'tools.encode.on': False,
+          'tools.gzip.on': False,
+      }
+  }
+
+
+def _HTTPDate(timestamp):
+  return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def _ParseHTTPDate(value):
+  """Returns the timestamp of an HTTP date, or None if it is invalid."""
+  parsed = email.utils.parsedate(value or '')
+  return calendar.timegm(parsed) if parsed else None
+
+
+def ParseRanges(header, size):
+  """Parses a Range header.
+
+  Args:
+    header: Value of the Range header.
+    size: Size of the resource.
+
+  Returns:
+    None if the whole resource should be served (no, invalid or too many
+    ranges), an empty list if no range is satisfiable, else a list of
+    (start, stop) tuples with |stop| excluded.
+  """
+  if not header:
+    return None
+  unit, _, specs = header.partition('=')
+  if unit.strip().lower() != 'bytes':
+    return None
+  specs = [s.strip() for s in specs.split(',') if s.strip()]
+  if not specs or len(specs) > _MAX_RANGES:
+    return None
+
+  ranges = []
+  for spec in specs:
+    first, sep, last = spec.partition('-')
+    try:
+      if not sep:
+        return None
+      if first:
+        start = int(first)
+        stop = int(last) + 1 if last else None
+        if stop is not None and stop <= start:
+          return None
+        if start >= size:
+          continue
+        stop = size if stop is None else stop
+        ranges.append((start, min(stop, size)))
+      else:
+        suffix = int(last)
+        if suffix <= 0:
+          continue
+        ranges.append((max(size - suffix, 0), size))
+    except ValueError:
+      return None
+  return ranges
+
+
+def _GetSendfileSocket():
+  """Returns the client socket of the current request if sendfile can use it.
+
+  cheroot worker threads keep the connection they are serving in their conn
+  attribute; its socket is only usable when it is a plain TCP socket.
+  """
+  if not hasattr(os, 'sendfile'):
+    return None, None
+  conn = getattr(threading.current_thread(), 'conn', None)
+  sock = getattr(conn, 'socket', None)
+  wfile = getattr(conn, 'wfile', None)
+  if type(sock) is not socket.socket or not hasattr(wfile, 'flush'):
+    return None, None
+  return sock, wfile
+
+
+def _SendFile(sock, fileobj, offset, count):
+  """Sends |count| bytes of |fileobj| from |offset| on |sock| with sendfile."""
+  out_fd = sock.fileno()
+  in_fd = fileobj.fileno()
+  timeout = sock.gettimeout()
+  while count > 0:
+    try:
+      # pylint: disable=no-member
+      sent = os.sendfile(out_fd, in_fd, offset,
+                         min(count, _SENDFILE_CHUNK_SIZE))
+    except OSError as e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise
+      # The socket is non-blocking when it has a timeout.
+      _, writable, _ = select.select([], [out_fd], [], timeout)
+      if not writable:
+        raise socket.timeout('timed out sending %s' % fileobj.name)
+      continue
+    if not sent:
+      raise IOError('%s was truncated while being sent.' % fileobj.name)
+    offset += sent
+    count -= sent
+
+
+class StaticServer(object):
+  """Cherrypy application serving the files of a directory."""
+
+  def __init__(self, static_dir, on_access=None, use_sendfile=True):
+    """Initializes the application.
+
+    Args:
+      static_dir: Directory to serve.
+      on_access: Optional function called with the full request path (e.g.
+        /static/board-release/R1-2.0.0/update.gz) of every file served.
+      use_sendfile: Whether to use sendfile when possible.
+    """
+    self._static_dir = os.path.realpath(static_dir)
+    self._on_access = on_access
+    self._use_sendfile = use_sendfile
+    self._lock = threading.Lock()
+    self._stats = {'sendfile_bytes': 0, 'copied_bytes': 0}
+
+  def get_stats(self):
+    """Returns the number of bytes sent with and without sendfile."""
+    with self._lock:
+      return dict(self._stats)
+
+  def _Count(self, name, value):
+    with self._lock:
+      self._stats[name] += value
+
+  def _GetPath(self, path_info):
+    """Maps a request path to a file in the static dir, or raises NotFound."""
+    path = os.path.normpath(os.path.join(self._static_dir,
+                                         path_info.lstrip('/')))
+    if not path.startswith(self._static_dir + os.sep):
+      raise cherrypy.NotFound()
+    return path
+
+  @cherrypy.expose
+  def default(self, *_args, **_kwargs):
+    """Serves the file at the request path."""
+    request = cherrypy.request
+    response = cherrypy.response
+    if request.method not in ('GET', 'HEAD'):
+      response.headers['Allow'] = 'GET, HEAD'
+      raise cherrypy.HTTPError(405)
+
+    path = self._GetPath(request.path_info)
+    try:
+      fileobj = open(path, 'rb')
+    except IOError as e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
+        raise cherrypy.NotFound()
+      if e.errno == errno.EACCES:
+        raise cherrypy.HTTPError(403)
+      raise
+    try:
+      st = os.fstat(fileobj.fileno())
+      if not stat.S_ISREG(st.st_mode):
+        raise cherrypy.NotFound()
+      body = self._Respond(request, response, fileobj, st)
+    except Exception:
+      fileobj.close()
+      raise
+
+    if self._on_access:
+      self._on_access(request.script_name + request.path_info)
+    if body is None:
+      fileobj.close()
+      return []
+    return body
+
+  def _Respond(self, request, response, fileobj, st):
+    """Sets the response status and headers, returns the body generator."""
+    size = st.st_size
+    etag = '"%x-%x-%x"' % (st.st_ino, size, int(st.st_mtime * 1000000))
+    last_modified = _HTTPDate(st.st_mtime)
+    content_type = (mimetypes.guess_type(fileobj.name)[0] or
+                    'application/octet-stream')
+    headers = response.headers
+    headers['ETag'] = etag
+    headers['Last-Modified'] = last_modified
+    headers['Accept-Ranges'] = 'bytes'
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+      tags = [t.strip() for t in if_none_match.split(',')]
+      not_modified = '*' in tags or etag in tags
+    else:
+      since = _ParseHTTPDate(request.headers.get('If-Modified-Since'))
+      not_modified = since is not None and int(st.st_mtime) <= since
+    if not_modified:
+      response.status = 304
+      return None
+
+    ranges = ParseRanges(request.headers.get('Range'), size)
+    if_range = request.headers.get('If-Range')
+    if ranges is not None and if_range and if_range not in (etag,
+                                                            last_modified):
+      # The client's copy is stale, send the whole file instead.
+      ranges = None
+
+    if ranges == []:
+      headers['Content-Range'] = 'bytes */%d' % size
+      raise cherrypy.HTTPError(416)
+
+    if ranges is None:
+      response.status = 200
+      headers['Content-Type'] = content_type
+      headers['Content-Length'] = str(size)
+      parts = [(b'', 0, size)]
+      trailer = b''
+    elif len(ranges) == 1:
+      start, stop = ranges[0]
+      response.status = 206
+      headers['Content-Type'] = content_type
+      headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+      headers['Content-Length'] = str(stop - start)
+      parts = [(b'', start, stop)]
+      trailer = b''
+    else:
+      boundary = uuid.uuid4().hex
+      response.status = 206
+      headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+      parts = []
+      for start, stop in ranges:
+        part_header = ('--%s\r\nContent-Type: %s\r\n'
+                       'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                       (boundary, content_type, start, stop - 1, size))
+        parts.append((part_header.encode('ascii'), start, stop))
+      parts = [(h if i == 0 else b'\r\n' + h, start, stop)
+               for i, (h, start, stop) in enumerate(parts)]
+      trailer = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+      headers['Content-Length'] = str(
+          sum(len(h) + stop - start for h, start, stop in parts) +
+          len(trailer))
+
+    if request.method == 'HEAD':
+      return None
+    return self._Body(fileobj, parts, trailer)
+
+  def _Body(self, fileobj, parts, trailer):
+    """Yields the response body.
+
+    Data is yielded through the WSGI server until the headers went out; the
+    rest is then sent with sendfile on the client socket when possible.
+    Nothing is yielded after sendfile took over but empty chunks, which the
+    WSGI servers skip.
+    """
+    sock, wfile = (_GetSendfileSocket() if self._use_sendfile
+                   else (None, None))
+    headers_sent = False
+    with fileobj:
+      for part_header, start, stop in parts:
+        if part_header:
+          yield part_header
+          headers_sent = True
+        offset = start
+        while offset < stop:
+          if sock is not None and headers_sent:
+            wfile.flush()
+            _SendFile(sock, fileobj, offset, stop - offset)
+            self._Count('sendfile_bytes', stop - offset)
+            break
+          fileobj.seek(offset)
+          data = fileobj.read(min(
+              _FIRST_CHUNK_SIZE if sock is not None else CHUNK_SIZE,
+              stop - offset))
+          if not data:
+            raise IOError('%s was truncated while being sent.' % fileobj.name)
+          offset += len(data)
+          self._Count('copied_bytes', len(data))
+          yield data
+          headers_sent = True
+      if trailer:
+        yield trailer
+
+
+class AccessTimeBatcher(plugins.Monitor):
+  """CherryPy plugin batching access timestamp updates.
+
+  Keys added with Add() are collected in a set and |touch| is called once per
+  distinct key every |frequency| seconds from a background thread, instead of
+  once per request on the request thread.
+  """
+
+  def __init__(self, bus, touch, frequency=5):
+    """Initializes the plugin.
+
+    Args:
+      bus: The WSPBus to subscribe to.
+      touch: Function called with each key added since the last flush.
+      frequency: Number of seconds between two flushes.
+    """
+    super(AccessTimeBatcher, self).__init__(bus, self.Flush,
+                                            frequency=frequency,
+                                            name='AccessTimeBatcher')
+    self._touch = touch
+    self._pending = set()
+    self._lock = threading.Lock()
+
+  def Add(self, key):
+    """Queues a timestamp update of |key|."""
+    with self._lock:
+      self._pending.add(key)
+
+  def Flush(self):
+    """Calls the touch function on every queued key."""
+    with self._lock:
+      pending, self._pending = self._pending, set()
+    for key in pending:
+      try:
+        self._touch(key)
+      except Exception as e:  # pylint: disable=broad-except
+        self.bus.log('Failed to update the timestamp of %s: %s' % (key, e))
+
+  def stop(self):
+    super(AccessTimeBatcher, self).stop()
+    self.Flush()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Throughput benchmark for serving /static.
+
+Serves a generated payload with cherrypy's staticdir tool (what /static used
+to be), with static_server.StaticServer copying through python and with
+StaticServer using sendfile, and has concurrent clients download it, either
+whole or in byte ranges as update_engine and quick-provision do.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import cherrypy  # pylint: disable=import-error
+from six.moves import http_client
+
+import static_server
+
+
+_PAYLOAD = 'board-release/R1-1.0.0/update.gz'
+
+
+def Download(port, size, requests, range_size, results):
+  """Issues |requests| GETs on one keep-alive connection, records the bytes."""
+  conn = http_client.HTTPConnection('127.0.0.1', port)
+  received = 0
+  for _ in range(requests):
+    headers = {}
+    if range_size:
+      start = random.randrange(0, max(size - range_size, 1))
+      headers['Range'] = 'bytes=%d-%d' % (start, start + range_size - 1)
+    conn.request('GET', '/static/' + _PAYLOAD, headers=headers)
+    response = conn.getresponse()
+    while True:
+      data = response.read(1024 * 1024)
+      if not data:
+        break
+      received += len(data)
+  conn.close()
+  results.append(received)
+
+
+def Run(app, config, opts, port):
+  """Mounts |app|, runs the clients and returns the measured throughput."""
+  cherrypy.tree.apps.clear()
+  cherrypy.tree.mount(app, '/static', config=config)
+  cherrypy.engine.start()
+  cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+  try:
+    results = []
+    threads = [threading.Thread(target=Download,
+                                args=(port, opts.size, opts.requests,
+                                      opts.range_size, results))
+               for _ in range(opts.clients)]
+    start = time.time()
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    elapsed = time.time() - start
+  finally:
+    cherrypy.engine.stop()
+  total = sum(results)
+  return {
+      'seconds': round(elapsed, 3),
+      'megabytes': round(total / 1e6, 1),
+      'megabytes_per_second': round(total / 1e6 / elapsed, 1),
+  }
+
+
+def ParseArguments(argv):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--size', type=int, default=512 * 1024 * 1024,
+                      help='Size of the served payload in bytes.')
+  parser.add_argument('--clients', type=int, default=16,
+                      help='Number of concurrent clients.')
+  parser.add_argument('--requests', type=int, default=4,
+                      help='Number of requests per client.')
+  parser.add_argument('--range-size', type=int, default=0,
+                      help='Size of the requested byte ranges, 0 to download '
+                      'the whole payload.')
+  parser.add_argument('--port', type=int, default=18080,
+                      help='Port to serve on.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  opts = ParseArguments(argv)
+  static_dir = tempfile.mkdtemp(prefix='static_server_benchmark')
+  try:
+    payload = os.path.join(static_dir, _PAYLOAD)
+    os.makedirs(os.path.dirname(payload))
+    with open(payload, 'wb') as f:
+      block = os.urandom(1024 * 1024)
+      for _ in range(opts.size // len(block)):
+        f.write(block)
+      f.write(block[:opts.size % len(block)])
+
+    cherrypy.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': opts.port,
+        'server.thread_pool': opts.clients,
+        'server.protocol_version': 'HTTP/1.1',
+        'log.screen': False,
+        'engine.autoreload.on': False,
+    })
+    staticdir_config = {'/': {'tools.staticdir.on': True,
+                              'tools.staticdir.dir': static_dir}}
+    results = {
+        'staticdir': Run(type('StaticDir', (object,), {})(), staticdir_config,
+                         opts, opts.port),
+        'static_server_copy': Run(
+            static_server.StaticServer(static_dir, use_sendfile=False),
+            static_server.get_config(), opts, opts.port),
+        'static_server_sendfile': Run(
+            static_server.StaticServer(static_dir),
+            static_server.get_config(), opts, opts.port),
+    }
+    cherrypy.engine.exit()
+    print(json.dumps(results, indent=2, sort_keys=True))
+  finally:
+    shutil.rmtree(static_dir)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for static_server.py."""
+
+from __future__ import print_function
+
+import email
+import os
+import shutil
+import tempfile
+import unittest
+
+import cherrypy  # pylint: disable=import-error
+import mock
+from six.moves import http_client
+
+import static_server
+
+
+class ParseRangesTest(unittest.TestCase):
+  """Tests for ParseRanges."""
+
+  def testRanges(self):
+    """Tests valid range headers."""
+    self.assertEqual(static_server.ParseRanges('bytes=0-9', 100), [(0, 10)])
+    self.assertEqual(static_server.ParseRanges('bytes=90-', 100), [(90, 100)])
+    self.assertEqual(static_server.ParseRanges('bytes=-10', 100), [(90, 100)])
+    self.assertEqual(static_server.ParseRanges('bytes=-500', 100), [(0, 100)])
+    self.assertEqual(static_server.ParseRanges('bytes=50-500', 100),
+                     [(50, 100)])
+    self.assertEqual(static_server.ParseRanges('bytes=0-0, 5-9', 100),
+                     [(0, 1), (5, 10)])
+
+  def testUnsatisfiable(self):
+    """Tests ranges past the end of the resource."""
+    self.assertEqual(static_server.ParseRanges('bytes=100-', 100), [])
+    self.assertEqual(static_server.ParseRanges('bytes=200-300, 100-', 100), [])
+
+  def testIgnored(self):
+    """Tests invalid range headers are ignored."""
+    for header in (None, '', 'bytes=', 'items=0-1', 'bytes=5-1', 'bytes=a-b',
+                   'bytes=5', ','.join(['bytes=0-1'] * 100)):
+      self.assertIsNone(static_server.ParseRanges(header, 100), header)
+
+
+class AccessTimeBatcherTest(unittest.TestCase):
+  """Tests for AccessTimeBatcher."""
+
+  def testFlushDeduplicates(self):
+    """Tests each key is touched once per flush."""
+    touch = mock.Mock()
+    batcher = static_server.AccessTimeBatcher(cherrypy.engine, touch)
+    for key in ('a', 'b', 'a', 'a'):
+      batcher.Add(key)
+    batcher.Flush()
+    self.assertEqual(sorted(c[0][0] for c in touch.call_args_list), ['a', 'b'])
+    batcher.Flush()
+    self.assertEqual(touch.call_count, 2)
+
+
+class StaticServerTest(unittest.TestCase):
+  """Tests serving files through a running cherrypy server."""
+
+  @classmethod
+  def setUpClass(cls):
+    cls.static_dir = tempfile.mkdtemp('static_server')
+    cls.content = os.urandom(3 * static_server.CHUNK_SIZE + 123)
+    os.makedirs(os.path.join(cls.static_dir, 'board-release', 'R1-1.0.0'))
+    with open(os.path.join(cls.static_dir, 'board-release', 'R1-1.0.0',
+                           'update.gz'), 'wb') as f:
+      f.write(cls.content)
+    cls.accessed = []
+    cls.app = static_server.StaticServer(cls.static_dir,
+                                         on_access=cls.accessed.append)
+    cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                            'server.socket_port': 0,
+                            'log.screen': False,
+                            'engine.autoreload.on': False})
+    cherrypy.tree.mount(cls.app, '/static', config=static_server.get_config())
+    cherrypy.engine.start()
+    cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+    cls.port = cherrypy.server.bound_addr[1]
+
+  @classmethod
+  def tearDownClass(cls):
+    cherrypy.engine.exit()
+    shutil.rmtree(cls.static_dir)
+
+  def _Get(self, path='/static/board-release/R1-1.0.0/update.gz',
+           method='GET', **headers):
+    conn = http_client.HTTPConnection('127.0.0.1', self.port)
+    conn.request(method, path, headers=headers)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response, body
+
+  def testFullFile(self):
+    """Tests the whole file is served with its validators."""
+    response, body = self._Get()
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, self.content)
+    self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+    self.assertTrue(response.getheader('ETag'))
+    self.assertIn('/static/board-release/R1-1.0.0/update.gz', self.accessed)
+    stats = self.app.get_stats()
+    self.assertEqual(stats['sendfile_bytes'] + stats['copied_bytes'] > 0, True)
+
+  def testHead(self):
+    """Tests HEAD requests get the headers only."""
+    response, body = self._Get(method='HEAD')
+    self.assertEqual(response.status, 200)
+    self.assertEqual(body, b'')
+    self.assertEqual(int(response.getheader('Content-Length')),
+                     len(self.content))
+
+  def testSingleRange(self):
+    """Tests a single range request."""
+    response, body = self._Get(Range='bytes=100-2097251')
+    self.assertEqual(response.status, 206)
+    self.assertEqual(body, self.content[100:2097252])
+    self.assertEqual(response.getheader('Content-Range'),
+                     'bytes 100-2097251/%d' % len(self.content))
+
+  def testMultipleRanges(self):
+    """Tests a multiple range request is answered with multipart parts."""
+    response, body = self._Get(Range='bytes=0-9,-20')
+    self.assertEqual(response.status, 206)
+    content_type = response.getheader('Content-Type')
+    self.assertTrue(content_type.startswith('multipart/byteranges'))
+    message = email.message_from_string(
+        'Content-Type: %s\r\n\r\n' % content_type +
+        body.decode('latin-1'))
+    parts = [p.get_payload().encode('latin-1') for p in message.get_payload()]
+    self.assertEqual(parts, [self.content[:10], self.content[-20:]])
+    self.assertEqual(int(response.getheader('Content-Length')), len(body))
+
+  def testUnsatisfiableRange(self):
+    """Tests ranges past the end of the file are rejected."""
+    response, _ = self._Get(Range='bytes=%d-' % len(self.content))
+    self.assertEqual(response.status, 416)
+    self.assertEqual(response.getheader('Content-Range'),
+                     'bytes */%d' % len(self.content))
+
+  def testIfRange(self):
+    """Tests stale If-Range validators get the whole file."""
+    etag = self._Get(method='HEAD')[0].getheader('ETag')
+    response, body = self._Get(Range='bytes=0-9', **{'If-Range': etag})
+    self.assertEqual((response.status, body), (206, self.content[:10]))
+    response, body = self._Get(Range='bytes=0-9', **{'If-Range': '"stale"'})
+    self.assertEqual((response.status, body), (200, self.content))
+
+  def testNotModified(self):
+    """Tests conditional requests."""
+    head = self._Get(method='HEAD')[0]
+    response, _ = self._Get(**{'If-None-Match': head.getheader('ETag')})
+    self.assertEqual(response.status, 304)
+    response, _ = self._Get(
+        **{'If-Modified-Since': head.getheader('Last-Modified')})
+    self.assertEqual(response.status, 304)
+
+  def testNotFound(self):
+    """Tests missing files, directories and paths out of the static dir."""
+    for path in ('/static/missing', '/static/board-release',
+                 '/static/../etc/passwd', '/static/%2e%2e/etc/passwd'):
+      self.assertEqual(self._Get(path)[0].status, 404, path)
+
+  def testMethodNotAllowed(self):
+    """Tests only GET and HEAD are accepted."""
+    self.assertEqual(self._Get(method='POST')[0].status, 405)
+
+
+if __name__ == '__main__':
+  unittest.main()
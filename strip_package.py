@@ -24,6 +24,10 @@ def main():
                             'This is incompatible with --board.'))
   parser.add_argument('--deep', action='store_true',
                       help='Also strip dependencies of packages.')
+  parser.add_argument('--jobs', type=int, default=None,
+                      help='Number of CPUs used to strip the packages, '
+                      'shared between the packages stripped at the same time '
+                      '(default: all of them).')
   parser.add_argument('packages', nargs='+', metavar='package',
                       help='Package to strip.')
 
@@ -31,7 +35,8 @@ def main():
   sysroot = options.sysroot or '/build/%s' % options.board
 
   # Check if packages were installed.
-  if not builder.UpdateGmergeBinhost(sysroot, options.packages, options.deep):
+  if not builder.UpdateGmergeBinhost(sysroot, options.packages, options.deep,
+                                     jobs=options.jobs):
     sys.exit(1)
 
 
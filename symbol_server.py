@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Symbolication service used by the devserver symbolicate_dump RPC.
+
+Instead of forking minidump_stackwalk inline on the request thread for every
+dump, the SymbolServer:
+  - runs stackwalks on a bounded pool of workers (never more than the number
+    of CPUs, since minidump_stackwalk is CPU bound),
+  - keeps a per-build index of the breakpad symbol tree, mapping
+    (module name, debug id) to the .sym file, to tell which symbol files a
+    dump resolves to and which of its modules have none,
+  - caches results keyed by the minidump hash and the symbol files it
+    resolves to, and collapses concurrent requests for the same dump into a
+    single stackwalk.
+
+minidump_stackwalk is always given the whole symbol tree, from which it only
+opens the symbol files it needs.
+"""
+
+from __future__ import print_function
+
+import binascii
+import collections
+import hashlib
+import multiprocessing
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+
+from concurrent import futures
+
+import setup_chromite  # pylint: disable=unused-import
+from chromite.lib.xbuddy import cherrypy_log_util
+
+
+def _Log(message, *args):
+  """Module-local log function."""
+  return cherrypy_log_util.LogWithTag('SYMBOLS', message, *args)
+
+
+# The location of minidump_stackwalk is defined in chromeos-admin.
+MINIDUMP_STACKWALK = '/usr/local/bin/minidump_stackwalk'
+
+# Default number of symbolication results kept in memory.
+DEFAULT_CACHE_SIZE = 256
+
+# Number of build symbol indexes kept in memory.
+_INDEX_CACHE_SIZE = 16
+
+_READ_CHUNK_SIZE = 64 * 1024
+
+# Minidump format constants, see breakpad's minidump_format.h.
+_MD_HEADER_SIGNATURE = 0x504d444d  # 'MDMP'
+_MD_HEADER = struct.Struct('<IIIIIIQ')
+_MD_DIRECTORY = struct.Struct('<III')
+_MD_MODULE_LIST_STREAM = 4
+_MD_MODULE = struct.Struct('<QIIII52sIIIIQQ')
+_MD_CVINFOPDB70_SIGNATURE = 0x53445352  # 'RSDS'
+_MD_CVINFOELF_SIGNATURE = 0x4270454c  # 'BpEL'
+_MD_GUID = struct.Struct('<IHH8s')
+
+
+class SymbolServerError(Exception):
+  """Exception class used by this module."""
+
+
+class MinidumpModule(collections.namedtuple('MinidumpModule',
+                                            ('name', 'debug_id'))):
+  """A module referenced by a minidump.
+
+  Attributes:
+    name: The basename of the module, as used in the breakpad symbol tree.
+    debug_id: The breakpad debug identifier of the module.
+  """
+
+
+def _FormatDebugId(guid, age):
+  """Formats a 16 byte GUID and an age the way breakpad names symbol dirs."""
+  data1, data2, data3, data4 = _MD_GUID.unpack(guid)
+  return '%08X%04X%04X%s%X' % (
+      data1, data2, data3, binascii.hexlify(data4).decode('ascii').upper(),
+      age)
+
+
+def _ReadMinidumpString(data, rva):
+  """Returns the UTF-16 MINIDUMP_STRING found at |rva| in |data|."""
+  (length,) = struct.unpack_from('<I', data, rva)
+  raw = data[rva + 4:rva + 4 + length]
+  return raw.decode('utf-16-le', 'replace')
+
+
+def _ReadCodeViewDebugId(data, rva, size):
+  """Returns the breakpad debug id stored in a CodeView record, or None."""
+  if size < 4 or rva + size > len(data):
+    return None
+  (signature,) = struct.unpack_from('<I', data, rva)
+  if signature == _MD_CVINFOPDB70_SIGNATURE and size >= 24:
+    guid = data[rva + 4:rva + 20]
+    (age,) = struct.unpack_from('<I', data, rva + 20)
+    return _FormatDebugId(guid, age)
+  if signature == _MD_CVINFOELF_SIGNATURE:
+    # ELF build ids are folded into a GUID the same way dump_syms does it.
+    build_id = data[rva + 4:rva + size][:_MD_GUID.size]
+    build_id += b'\0' * (_MD_GUID.size - len(build_id))
+    return _FormatDebugId(build_id, 0)
+  return None
+
+
+def ReadMinidumpModules(data):
+  """Lists the modules referenced by a minidump.
+
+  Only the header, stream directory and module list stream are looked at, so
+  this is cheap even for large dumps.
+
+  Args:
+    data: The contents of the minidump, as bytes.
+
+  Returns:
+    A list of MinidumpModule. Modules without a usable CodeView record are
+    skipped.
+
+  Raises:
+    SymbolServerError: if |data| is not a minidump.
+  """
+  if len(data) < _MD_HEADER.size:
+    raise SymbolServerError('Minidump is truncated.')
+  signature, _, stream_count, directory_rva = _MD_HEADER.unpack_from(data)[:4]
+  if signature != _MD_HEADER_SIGNATURE:
+    raise SymbolServerError('Not a minidump (bad signature %#x).' % signature)
+
+  modules = []
+  try:
+    for i in range(stream_count):
+      stream_type, _, stream_rva = _MD_DIRECTORY.unpack_from(
+          data, directory_rva + i * _MD_DIRECTORY.size)
+      if stream_type != _MD_MODULE_LIST_STREAM:
+        continue
+
+      (module_count,) = struct.unpack_from('<I', data, stream_rva)
+      offset = stream_rva + 4
+      for _ in range(module_count):
+        fields = _MD_MODULE.unpack_from(data, offset)
+        offset += _MD_MODULE.size
+        name_rva, cv_size, cv_rva = fields[4], fields[6], fields[7]
+        debug_id = _ReadCodeViewDebugId(data, cv_rva, cv_size)
+        if debug_id is None:
+          continue
+        name = _ReadMinidumpString(data, name_rva)
+        modules.append(MinidumpModule(
+            os.path.basename(name.replace('\\', '/')), debug_id))
+  except struct.error as e:
+    raise SymbolServerError('Minidump is truncated: %s' % e)
+
+  return modules
+
+
+class SymbolIndex(object):
+  """Index of a breakpad symbol tree.
+
+  The tree is laid out as <symbols_dir>/<module>/<debug id>/<module>.sym, so
+  the index costs one listdir per module directory to build, and one stat per
+  module directory to check.
+  """
+
+  def __init__(self, symbols_dir):
+    """Builds the index for |symbols_dir|.
+
+    Args:
+      symbols_dir: Path to the debug/breakpad directory of a staged build.
+    """
+    self.symbols_dir = symbols_dir
+    self._paths = {}
+    self._modules = sorted(_ListDir(symbols_dir))
+    self.version = self._Version()
+    for module in self._modules:
+      module_dir = os.path.join(symbols_dir, module)
+      for debug_id in _ListDir(module_dir):
+        path = os.path.join(module_dir, debug_id, module + '.sym')
+        if os.path.isfile(path):
+          self._paths[(module, debug_id.upper())] = path
+
+  def __len__(self):
+    return len(self._paths)
+
+  def Lookup(self, module):
+    """Returns the symbol file for a MinidumpModule, or None."""
+    return self._paths.get((module.name, module.debug_id))
+
+  def _Version(self):
+    """Returns a value that changes when modules or debug ids are added."""
+    return (_DirVersion(self.symbols_dir),
+            tuple(_DirVersion(os.path.join(self.symbols_dir, module))
+                  for module in self._modules))
+
+  def IsCurrent(self):
+    """Returns whether the symbol tree is unchanged since it was indexed."""
+    return self._Version() == self.version
+
+
+def _ListDir(path):
+  try:
+    return os.listdir(path)
+  except OSError:
+    return []
+
+
+def _DirVersion(path):
+  """Returns a value that changes whenever |path| is restaged."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_ino, st.st_mtime)
+
+
+class _LRUCache(object):
+  """A small thread-safe LRU mapping."""
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def Get(self, key):
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is not None:
+        self._entries[key] = value
+      return value
+
+  def Put(self, key, value):
+    if self._max_size <= 0:
+      return
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = value
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+
+class SymbolServer(object):
+  """Symbolicates minidumps on a worker pool with cached results."""
+
+  def __init__(self, stackwalk=MINIDUMP_STACKWALK, max_workers=None,
+               cache_size=DEFAULT_CACHE_SIZE):
+    """Initializes the server.
+
+    Args:
+      stackwalk: Path to the minidump_stackwalk binary.
+      max_workers: Maximum number of concurrent stackwalks. Defaults to, and is
+        capped at, the number of CPUs.
+      cache_size: Number of symbolication results to keep in memory.
+
+    Raises:
+      SymbolServerError: if |max_workers| is less than 1.
+    """
+    cpus = multiprocessing.cpu_count()
+    if max_workers is None:
+      max_workers = cpus
+    if max_workers < 1:
+      raise SymbolServerError('Invalid number of symbolication workers: %d' %
+                              max_workers)
+    self._stackwalk = stackwalk
+    self.max_workers = min(max_workers, cpus)
+    self._pool = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+    self._results = _LRUCache(cache_size)
+    self._indexes = _LRUCache(_INDEX_CACHE_SIZE)
+    self._inflight = {}
+    self._lock = threading.Lock()
+    self._stats = collections.Counter()
+
+  def GetStats(self):
+    """Returns a dict of counters describing the server activity."""
+    with self._lock:
+      stats = dict(self._stats)
+    stats.update(workers=self.max_workers, cached_results=len(self._results),
+                 cached_indexes=len(self._indexes))
+    return stats
+
+  def Shutdown(self):
+    """Waits for running stackwalks and stops the worker pool."""
+    self._pool.shutdown(wait=True)
+
+  def GetIndex(self, symbols_dir):
+    """Returns an up to date SymbolIndex for |symbols_dir|."""
+    index = self._indexes.Get(symbols_dir)
+    if index is None or not index.IsCurrent():
+      index = SymbolIndex(symbols_dir)
+      self._indexes.Put(symbols_dir, index)
+      self._Count('index_builds')
+      _Log('Indexed %d symbol files in %s', len(index), symbols_dir)
+    return index
+
+  def Symbolicate(self, minidump, symbols_dir):
+    """Symbolicates a minidump.
+
+    Args:
+      minidump: A file-like object with the binary minidump.
+      symbols_dir: Path to the breakpad symbol tree of the build.
+
+    Returns:
+      The output of minidump_stackwalk.
+
+    Raises:
+      SymbolServerError: if minidump_stackwalk failed.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.dmp') as local:
+      digest = hashlib.sha256()
+      chunks = []
+      while True:
+        data = minidump.read(_READ_CHUNK_SIZE)
+        if not data:
+          break
+        digest.update(data)
+        local.write(data)
+        chunks.append(data)
+      local.flush()
+      data = b''.join(chunks)
+
+      index = self.GetIndex(symbols_dir)
+      try:
+        modules = ReadMinidumpModules(data)
+      except SymbolServerError as e:
+        # Leave it to minidump_stackwalk to report on malformed dumps.
+        _Log('Could not list minidump modules: %s', e)
+        modules = []
+      symbol_files = tuple(sorted(
+          set(filter(None, (index.Lookup(m) for m in modules)))))
+      key = (symbols_dir, index.version, digest.hexdigest(), symbol_files)
+
+      result = self._results.Get(key)
+      if result is not None:
+        self._Count('cache_hits')
+        return result
+
+      with self._lock:
+        future = self._inflight.get(key)
+        owner = future is None
+        if owner:
+          future = self._pool.submit(self._RunStackwalk, local.name,
+                                     symbols_dir)
+          self._inflight[key] = future
+          self._stats['stackwalks'] += 1
+          self._stats['missing_symbols'] += len(modules) - len(symbol_files)
+        else:
+          self._stats['coalesced'] += 1
+
+      try:
+        result = future.result()
+      finally:
+        if owner:
+          with self._lock:
+            self._inflight.pop(key, None)
+      if owner:
+        self._results.Put(key, result)
+      return result
+
+  def _Count(self, name):
+    with self._lock:
+      self._stats[name] += 1
+
+  def _RunStackwalk(self, minidump_path, symbols_dir):
+    """Runs minidump_stackwalk on |symbols_dir| and returns its output."""
+    stackwalk = subprocess.Popen(
+        [self._stackwalk, minidump_path, symbols_dir],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error_text = stackwalk.communicate()
+    if stackwalk.returncode != 0:
+      self._Count('errors')
+      raise SymbolServerError(
+          "Can't generate stack trace: %s (rc=%d)" % (error_text,
+                                                      stackwalk.returncode))
+    return output
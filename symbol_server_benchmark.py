@@ -0,0 +1,192 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmark for symbol_server.SymbolServer.
+
+Generates a synthetic breakpad symbol tree and a set of synthetic minidumps,
+then replays a stream of symbolication requests (with repeated dumps, as seen
+from crash-heavy test runs) from concurrent clients. The requests are served
+once the way symbolicate_dump used to, with one stackwalk forked per request,
+and once through a SymbolServer.
+
+By default a fake minidump_stackwalk that parses the symbol files of the
+modules in the dump is used; pass --stackwalk to use the real one.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import symbol_server
+import symbol_server_unittest
+
+
+_FAKE_STACKWALK = """#!%(python)s
+import sys
+sys.path.insert(0, %(repo)r)
+import symbol_server
+dump, symbols_dir = sys.argv[1:3]
+with open(dump, 'rb') as f:
+  modules = symbol_server.ReadMinidumpModules(f.read())
+for module in modules:
+  path = '%%s/%%s/%%s/%%s.sym' %% (symbols_dir, module.name, module.debug_id,
+                                 module.name)
+  try:
+    with open(path) as f:
+      funcs = [l.split(' ', 4) for l in f if l.startswith('FUNC ')]
+  except IOError:
+    funcs = []
+  print('%%s %%s %%d' %% (module.name, module.debug_id, len(funcs)))
+"""
+
+
+def GenerateSymbolTree(symbols_dir, module_count, funcs_per_module):
+  """Writes a breakpad symbol tree and returns its (name, guid) modules."""
+  modules = []
+  for i in range(module_count):
+    name = 'libmodule%d.so' % i
+    guid = os.urandom(16)
+    debug_id = symbol_server.ReadMinidumpModules(
+        symbol_server_unittest.MakeMinidump([(name, guid, 0)]))[0].debug_id
+    module_dir = os.path.join(symbols_dir, name, debug_id)
+    os.makedirs(module_dir)
+    with open(os.path.join(module_dir, name + '.sym'), 'w') as f:
+      f.write('MODULE Linux x86_64 %s %s\n' % (debug_id, name))
+      for j in range(funcs_per_module):
+        f.write('FUNC %x 40 0 function_%d_%d\n' % (j * 64, i, j))
+    modules.append((name, guid))
+  return modules
+
+
+def GenerateMinidumps(modules, dump_count, modules_per_dump):
+  """Returns |dump_count| minidumps referencing random |modules|."""
+  dumps = []
+  for _ in range(dump_count):
+    picked = random.sample(modules, min(modules_per_dump, len(modules)))
+    dumps.append(symbol_server_unittest.MakeMinidump(
+        [('/usr/lib/' + name, guid, 0) for name, guid in picked]))
+  return dumps
+
+
+def ForkPerRequest(stackwalk):
+  """Returns a handler symbolicating a dump the way the devserver used to."""
+  def _Handle(dump, symbols_dir):
+    with tempfile.NamedTemporaryFile() as local:
+      local.write(dump)
+      local.flush()
+      proc = subprocess.Popen([stackwalk, local.name, symbols_dir],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      return proc.communicate()[0]
+  return _Handle
+
+
+def Replay(handler, requests, symbols_dir, clients):
+  """Replays |requests| from |clients| threads, returns latencies and time."""
+  latencies = []
+  lock = threading.Lock()
+  pending = list(requests)
+
+  def _Client():
+    while True:
+      with lock:
+        if not pending:
+          return
+        dump = pending.pop()
+      start = time.time()
+      handler(dump, symbols_dir)
+      with lock:
+        latencies.append(time.time() - start)
+
+  start = time.time()
+  threads = [threading.Thread(target=_Client) for _ in range(clients)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return latencies, time.time() - start
+
+
+def Summarize(latencies, elapsed):
+  latencies = sorted(latencies)
+  return {
+      'requests': len(latencies),
+      'seconds': round(elapsed, 3),
+      'requests_per_second': round(len(latencies) / elapsed, 1),
+      'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+      'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 1),
+  }
+
+
+def ParseArguments(argv):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--modules', type=int, default=200,
+                      help='Number of modules in the symbol tree.')
+  parser.add_argument('--funcs', type=int, default=2000,
+                      help='Number of FUNC records per symbol file.')
+  parser.add_argument('--modules-per-dump', type=int, default=40,
+                      help='Number of modules referenced by each minidump.')
+  parser.add_argument('--dumps', type=int, default=50,
+                      help='Number of distinct minidumps.')
+  parser.add_argument('--requests', type=int, default=400,
+                      help='Number of symbolication requests to replay.')
+  parser.add_argument('--clients', type=int, default=32,
+                      help='Number of concurrent clients.')
+  parser.add_argument('--workers', type=int, default=None,
+                      help='SymbolServer workers, defaults to the CPU count.')
+  parser.add_argument('--stackwalk',
+                      help='Path to a real minidump_stackwalk binary.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  opts = ParseArguments(argv)
+  tempdir = tempfile.mkdtemp(prefix='symbol_server_benchmark')
+  try:
+    symbols_dir = os.path.join(tempdir, 'breakpad')
+    modules = GenerateSymbolTree(symbols_dir, opts.modules, opts.funcs)
+    dumps = GenerateMinidumps(modules, opts.dumps, opts.modules_per_dump)
+    requests = [random.choice(dumps) for _ in range(opts.requests)]
+
+    stackwalk = opts.stackwalk
+    if not stackwalk:
+      stackwalk = os.path.join(tempdir, 'minidump_stackwalk')
+      with open(stackwalk, 'w') as f:
+        f.write(_FAKE_STACKWALK % {
+            'python': sys.executable,
+            'repo': os.path.dirname(os.path.abspath(__file__))})
+      os.chmod(stackwalk, stat.S_IRWXU)
+
+    results = {}
+    latencies, elapsed = Replay(ForkPerRequest(stackwalk), requests,
+                                symbols_dir, opts.clients)
+    results['fork_per_request'] = Summarize(latencies, elapsed)
+
+    server = symbol_server.SymbolServer(stackwalk=stackwalk,
+                                        max_workers=opts.workers)
+    handler = lambda dump, d: server.Symbolicate(io.BytesIO(dump), d)
+    latencies, elapsed = Replay(handler, requests, symbols_dir, opts.clients)
+    results['symbol_server'] = Summarize(latencies, elapsed)
+    results['symbol_server'].update(server.GetStats())
+    server.Shutdown()
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+  finally:
+    shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for symbol_server.py."""
+
+from __future__ import print_function
+
+import io
+import multiprocessing
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import unittest
+
+import symbol_server
+
+
+def MakeMinidump(modules):
+  """Builds a minimal minidump with a module list stream.
+
+  Args:
+    modules: A list of (path, guid, age) tuples, guid being 16 bytes.
+
+  Returns:
+    The minidump as bytes.
+  """
+  header_size = struct.calcsize('<IIIIIIQ')
+  directory_size = struct.calcsize('<III')
+  module_size = struct.calcsize('<QIIII52sIIIIQQ')
+  list_rva = header_size + directory_size
+  list_size = 4 + module_size * len(modules)
+
+  extra = b''
+  entries = b''
+  for path, guid, age in modules:
+    name_rva = list_rva + list_size + len(extra)
+    name = path.encode('utf-16-le')
+    extra += struct.pack('<I', len(name)) + name
+    cv_rva = list_rva + list_size + len(extra)
+    cv = struct.pack('<I', 0x53445352) + guid + struct.pack('<I', age) + b'\0'
+    extra += cv
+    entries += struct.pack('<QIIII52sIIIIQQ', 0, 0, 0, 0, name_rva, b'',
+                           len(cv), cv_rva, 0, 0, 0, 0)
+
+  return (struct.pack('<IIIIIIQ', 0x504d444d, 0xa793, 1, header_size, 0, 0, 0)
+          + struct.pack('<III', 4, list_size, list_rva)
+          + struct.pack('<I', len(modules)) + entries + extra)
+
+
+_GUID = b'\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10'
+_DEBUG_ID = '040302010605080709' + '0A0B0C0D0E0F10' + '2'
+
+
+class MinidumpParserTest(unittest.TestCase):
+  """Tests for ReadMinidumpModules."""
+
+  def testReadModules(self):
+    """Tests module names and debug ids are extracted."""
+    dump = MakeMinidump([('/opt/google/chrome/chrome', _GUID, 2),
+                         ('/lib/libc.so.6', b'\0' * 16, 0)])
+    self.assertEqual(
+        symbol_server.ReadMinidumpModules(dump),
+        [symbol_server.MinidumpModule('chrome', _DEBUG_ID),
+         symbol_server.MinidumpModule('libc.so.6', '0' * 33)])
+
+  def testBadSignature(self):
+    """Tests non-minidumps are rejected."""
+    with self.assertRaises(symbol_server.SymbolServerError):
+      symbol_server.ReadMinidumpModules(b'x' * 64)
+
+  def testTruncated(self):
+    """Tests truncated minidumps are rejected."""
+    dump = MakeMinidump([('chrome', _GUID, 2)])
+    with self.assertRaises(symbol_server.SymbolServerError):
+      symbol_server.ReadMinidumpModules(dump[:60])
+
+
+class SymbolServerTest(unittest.TestCase):
+  """Tests for the SymbolServer class."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp('symbol_server')
+    self.symbols_dir = os.path.join(self.tempdir, 'breakpad')
+    self.sym_file = os.path.join(self.symbols_dir, 'chrome', _DEBUG_ID,
+                                 'chrome.sym')
+    os.makedirs(os.path.dirname(self.sym_file))
+    with open(self.sym_file, 'w') as f:
+      f.write('MODULE Linux x86_64 %s chrome\n' % _DEBUG_ID)
+    # A module the dumps do not reference.
+    other_file = os.path.join(self.symbols_dir, 'libc.so.6', '0' * 33,
+                              'libc.so.6.sym')
+    os.makedirs(os.path.dirname(other_file))
+    open(other_file, 'w').close()
+
+    # A fake stackwalk logging each call and listing the symbol files of the
+    # tree it is given.
+    self.calls = os.path.join(self.tempdir, 'calls')
+    self.stackwalk = os.path.join(self.tempdir, 'minidump_stackwalk')
+    with open(self.stackwalk, 'w') as f:
+      f.write('#!/bin/sh\necho x >> %s\nsleep 0.2\n'
+              'cd "$2" && find . -name "*.sym" | sort\n' % self.calls)
+    os.chmod(self.stackwalk, stat.S_IRWXU)
+
+    self.server = symbol_server.SymbolServer(stackwalk=self.stackwalk,
+                                             max_workers=4)
+    self.dump = MakeMinidump([('chrome', _GUID, 2)])
+
+  def tearDown(self):
+    self.server.Shutdown()
+    shutil.rmtree(self.tempdir)
+
+  def _CallCount(self):
+    if not os.path.exists(self.calls):
+      return 0
+    with open(self.calls) as f:
+      return len(f.readlines())
+
+  def testIndex(self):
+    """Tests the symbol index resolves modules to symbol files."""
+    index = self.server.GetIndex(self.symbols_dir)
+    self.assertEqual(len(index), 2)
+    self.assertEqual(
+        index.Lookup(symbol_server.MinidumpModule('chrome', _DEBUG_ID)),
+        self.sym_file)
+    self.assertIsNone(
+        index.Lookup(symbol_server.MinidumpModule('chrome', '0' * 33)))
+    self.assertIs(self.server.GetIndex(self.symbols_dir), index)
+
+  def testSymbolicateCachesResults(self):
+    """Tests identical dumps only run the stackwalker once."""
+    for _ in range(3):
+      output = self.server.Symbolicate(io.BytesIO(self.dump), self.symbols_dir)
+      self.assertIn(b'./chrome/%s/chrome.sym\n' % _DEBUG_ID.encode(), output)
+    self.assertEqual(self._CallCount(), 1)
+    self.assertEqual(self.server.GetStats()['cache_hits'], 2)
+
+    self.server.Symbolicate(io.BytesIO(self.dump + b'\0'), self.symbols_dir)
+    self.assertEqual(self._CallCount(), 2)
+
+  def testSymbolicateUsesWholeTree(self):
+    """Tests stackwalks get the whole tree, whatever the index finds."""
+    dump = MakeMinidump([('chrome', b'\0' * 16, 1)])
+    output = self.server.Symbolicate(io.BytesIO(dump), self.symbols_dir)
+    self.assertEqual(output.splitlines(), [
+        b'./chrome/%s/chrome.sym' % _DEBUG_ID.encode(),
+        b'./libc.so.6/%s/libc.so.6.sym' % (b'0' * 33)])
+    self.assertEqual(self.server.GetStats()['missing_symbols'], 1)
+
+  def testSymbolicateNewDebugId(self):
+    """Tests symbol files added to a known module are not missed."""
+    self.server.Symbolicate(io.BytesIO(self.dump), self.symbols_dir)
+    index = self.server.GetIndex(self.symbols_dir)
+    sym_file = os.path.join(self.symbols_dir, 'chrome', '1' * 33, 'chrome.sym')
+    os.makedirs(os.path.dirname(sym_file))
+    open(sym_file, 'w').close()
+    # Directory timestamps may not be fine grained enough to change.
+    os.utime(os.path.dirname(os.path.dirname(sym_file)), (0, 0))
+
+    self.assertFalse(index.IsCurrent())
+    output = self.server.Symbolicate(io.BytesIO(self.dump), self.symbols_dir)
+    self.assertIn(b'./chrome/%s/chrome.sym' % (b'1' * 33), output)
+    self.assertEqual(self._CallCount(), 2)
+
+  def testSymbolicateCoalescesConcurrentRequests(self):
+    """Tests concurrent requests for one dump share a single stackwalk."""
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        self.server.Symbolicate(io.BytesIO(self.dump), self.symbols_dir)))
+               for _ in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(len(set(results)), 1)
+    self.assertEqual(self._CallCount(), 1)
+
+  def testSymbolicateError(self):
+    """Tests stackwalk failures are reported and not cached."""
+    with open(self.stackwalk, 'w') as f:
+      f.write('#!/bin/sh\necho x >> %s\necho broken >&2\nexit 3\n' % self.calls)
+    for _ in range(2):
+      with self.assertRaises(symbol_server.SymbolServerError):
+        self.server.Symbolicate(io.BytesIO(self.dump), self.symbols_dir)
+    self.assertEqual(self._CallCount(), 2)
+
+  def testWorkersCappedByCpus(self):
+    """Tests the worker count never exceeds the number of CPUs."""
+    server = symbol_server.SymbolServer(max_workers=100000)
+    self.assertEqual(server.max_workers, multiprocessing.cpu_count())
+    server.Shutdown()
+    with self.assertRaises(symbol_server.SymbolServerError):
+      symbol_server.SymbolServer(max_workers=0)
+
+
+if __name__ == '__main__':
+  unittest.main()
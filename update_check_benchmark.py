@@ -0,0 +1,442 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Throughput and latency benchmark of update checks.
+
+Generates Omaha requests as update_engine sends them (the platform app and a
+number of DLC apps) mixing update checks, DLC installs and events, and a
+payload metadata directory with the payloads of these apps and of as many
+other apps as requested. Then replays the requests:
+  - nebraska: in process, through Request and Nebraska.GetResponseToRequest,
+  - nebraska_server: over HTTP to a NebraskaServer, from concurrent clients,
+  - devserver: over HTTP to the /update RPC of a DevServerRoot served by
+    cherrypy, from concurrent clients.
+Each mode runs in its own process and reports its requests per second, its
+p50 and p99 latencies, overall and per kind of request, and its peak RSS.
+
+The results are printed as JSON, or written to --output. With --baseline, the
+results are compared to a previous output and the benchmark fails if the
+throughput of a mode dropped, or its p99 latency grew, by more than
+--tolerance.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import base64
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from six.moves import http_client
+
+# TODO(crbug.com/872441): We try to import nebraska from different places
+# because when we install the devserver, we copy the nebraska.py into the main
+# directory. Once this bug is resolved, we can always import from nebraska
+# directory.
+try:
+  from nebraska import nebraska
+except ImportError:
+  import nebraska
+
+
+MODES = ('nebraska', 'nebraska_server', 'devserver')
+
+_PLATFORM_APPID = '{4D3D2356-0ABF-4994-B191-9A16A11AC0C6}'
+_SOURCE_VERSION = '13020.0.0'
+_TARGET_VERSION = '13021.0.0'
+_BOARD = 'eve'
+_LABEL = 'eve-release/R86-13021.0.0'
+
+_REQUEST = """<?xml version="1.0" encoding="UTF-8"?>
+<request requestid="{%(id)08d-0000-0000-0000-000000000000}"
+    sessionid="{5B5B6E8A-8E0B-4F45-A2E3-8C6F6B1E0F4A}" protocol="3.0"
+    updater="ChromeOSUpdateEngine" updaterversion="0.1.0.0"
+    installsource="ondemandupdate" ismachine="1">
+  <os version="Indy" platform="Chrome OS" sp="%(version)s_x86_64"></os>
+%(apps)s</request>
+"""
+
+_APP = """  <app appid="%(appid)s" version="%(version)s" track="stable-channel"
+      board="%(board)s" hardware_class="EVE D6B-A5B-F3D" delta_okay="true"
+      installdate="4767" lang="en-US" fw_version="" ec_version="">
+%(tags)s  </app>
+"""
+
+_PING = '    <ping active="1" a="1" r="1"></ping>\n'
+_UPDATE_CHECK = '    <updatecheck targetversionprefix=""></updatecheck>\n'
+_EVENT = ('    <event eventtype="%d" eventresult="1" previousversion="%s">'
+          '</event>\n')
+
+
+def _DlcAppId(index):
+  return '%s_dlc%d' % (_PLATFORM_APPID, index)
+
+
+def _App(appid, version, tags, board=_BOARD):
+  return _APP % {'appid': appid, 'version': version, 'board': board,
+                 'tags': ''.join(tags)}
+
+
+def GenerateRequest(kind, request_id, num_dlcs, rng):
+  """Returns an Omaha request of the platform app and |num_dlcs| DLCs.
+
+  Args:
+    kind: 'update' for an update check of all the apps, 'install' for an
+      install of the DLCs or 'event' for one of the events of an update.
+    request_id: The ID of the request.
+    num_dlcs: The number of DLC apps in the request.
+    rng: A random.Random used to pick events.
+  """
+  dlcs = [_DlcAppId(i) for i in range(num_dlcs)]
+  if kind == 'update':
+    apps = [_App(_PLATFORM_APPID, _SOURCE_VERSION, [_PING, _UPDATE_CHECK])]
+    apps += [_App(appid, _SOURCE_VERSION, [_UPDATE_CHECK]) for appid in dlcs]
+  elif kind == 'install':
+    apps = [_App(_PLATFORM_APPID, _SOURCE_VERSION, [])]
+    apps += [_App(appid, '0.0.0.0', [_UPDATE_CHECK]) for appid in dlcs]
+  elif kind == 'event':
+    event = _EVENT % (rng.choice((
+        nebraska.Request.EVENT_TYPE_UPDATE_DOWNLOAD_STARTED,
+        nebraska.Request.EVENT_TYPE_UPDATE_DOWNLOAD_FINISHED,
+        nebraska.Request.EVENT_TYPE_UPDATE_COMPLETE)), _SOURCE_VERSION)
+    apps = [_App(appid, _SOURCE_VERSION, [event])
+            for appid in [_PLATFORM_APPID] + dlcs]
+  else:
+    raise ValueError('Unknown kind of request %s' % kind)
+  return (_REQUEST % {'id': request_id, 'version': _SOURCE_VERSION,
+                      'apps': ''.join(apps)}).encode('utf-8')
+
+
+def GenerateRequests(count, mix, num_dlcs, seed=0):
+  """Returns |count| (kind, request) tuples following the weights of |mix|."""
+  rng = random.Random(seed)
+  kinds = sorted(mix)
+  weights = [mix[k] for k in kinds]
+  total = sum(weights)
+  requests = []
+  for i in range(count):
+    pick = rng.uniform(0, total)
+    for kind, weight in zip(kinds, weights):
+      pick -= weight
+      if pick <= 0:
+        break
+    requests.append((kind, GenerateRequest(kind, i, num_dlcs, rng)))
+  return requests
+
+
+def _WriteMetadata(directory, appid, name, is_delta, rng):
+  """Writes the metadata of a payload of |appid|."""
+  metadata = {
+      'appid': appid,
+      'target_version': _TARGET_VERSION,
+      'is_delta': is_delta,
+      'size': rng.randrange(1 << 20, 1 << 31),
+      'metadata_signature': base64.b64encode(
+          bytes(bytearray(rng.getrandbits(8) for _ in range(256)))).decode(
+              'utf-8'),
+      'metadata_size': rng.randrange(1 << 10, 1 << 16),
+      'sha256_hex': base64.b64encode(
+          bytes(bytearray(rng.getrandbits(8) for _ in range(32)))).decode(
+              'utf-8'),
+  }
+  if is_delta:
+    metadata['source_version'] = _SOURCE_VERSION
+  with open(os.path.join(directory, name + '.json'), 'w') as f:
+    json.dump(metadata, f)
+
+
+def GenerateMetadataDir(directory, num_dlcs, num_other_apps, seed=0):
+  """Writes the full and delta payload metadata of the apps in |directory|.
+
+  Args:
+    directory: An existing directory.
+    num_dlcs: Number of DLC apps, besides the platform app.
+    num_other_apps: Number of apps which are in no request, to grow the index.
+    seed: Seed of the generated metadata.
+  """
+  rng = random.Random(seed)
+  appids = ([_PLATFORM_APPID] + [_DlcAppId(i) for i in range(num_dlcs)] +
+            ['{%032X}' % rng.getrandbits(128) for _ in range(num_other_apps)])
+  for i, appid in enumerate(appids):
+    _WriteMetadata(directory, appid, 'chromeos_full_%d.bin' % i, False, rng)
+    _WriteMetadata(directory, appid, 'chromeos_delta_%d.bin' % i, True, rng)
+
+
+def Percentile(sorted_values, percentile):
+  """Returns the |percentile| (0-100) of a sorted list, None if it is empty."""
+  if not sorted_values:
+    return None
+  index = int(round(percentile / 100 * (len(sorted_values) - 1)))
+  return sorted_values[index]
+
+
+def Summarize(latencies, elapsed):
+  """Summarizes the (kind, seconds) latencies of requests served in |elapsed|.
+
+  Returns:
+    A dict with the throughput and the latency percentiles, overall and per
+    kind of request, and the peak RSS of the process.
+  """
+  by_kind = collections.defaultdict(list)
+  for kind, latency in latencies:
+    by_kind[kind].append(latency)
+
+  def _Stats(values):
+    values = sorted(values)
+    return {
+        'requests': len(values),
+        'p50_ms': round(Percentile(values, 50) * 1000, 3),
+        'p99_ms': round(Percentile(values, 99) * 1000, 3),
+    }
+
+  summary = _Stats([latency for _, latency in latencies])
+  summary.update({
+      'seconds': round(elapsed, 3),
+      'requests_per_second': round(len(latencies) / elapsed, 1),
+      'per_kind': {kind: _Stats(values) for kind, values in by_kind.items()},
+      # In kilobytes on Linux.
+      'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+  })
+  return summary
+
+
+def _Timed(handle, requests, latencies):
+  """Handles |requests| with |handle|, records their kind and latency."""
+  for kind, request in requests:
+    start = time.time()
+    handle(request)
+    latencies.append((kind, time.time() - start))
+
+
+def RunNebraska(requests, metadata_dir, _opts):
+  """Handles the requests with Nebraska.GetResponseToRequest in process."""
+  neb = nebraska.Nebraska(nebraska.NebraskaProperties(
+      update_payloads_address='http://127.0.0.1/payloads',
+      update_metadata_dir=metadata_dir,
+      install_metadata_dir=metadata_dir))
+  latencies = []
+  start = time.time()
+  _Timed(lambda request: neb.GetResponseToRequest(nebraska.Request(request)),
+         requests, latencies)
+  return Summarize(latencies, time.time() - start)
+
+
+def _Post(port, path, requests, latencies):
+  """POSTs |requests| to |path| on one keep-alive connection."""
+  conn = http_client.HTTPConnection('127.0.0.1', port)
+
+  def _Handle(request):
+    conn.request('POST', path, body=request,
+                 headers={'Content-Type': 'text/xml'})
+    response = conn.getresponse()
+    response.read()
+    if response.status != http_client.OK:
+      raise Exception('%s failed with %d' % (path, response.status))
+
+  try:
+    _Timed(_Handle, requests, latencies)
+  finally:
+    conn.close()
+
+
+def _RunClients(port, path, requests, clients):
+  """Replays |requests| to |path| from |clients| concurrent clients."""
+  latencies = []
+  threads = [threading.Thread(target=_Post,
+                              args=(port, path, requests[i::clients],
+                                    latencies))
+             for i in range(clients)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  if len(latencies) != len(requests):
+    raise Exception('%d requests failed' % (len(requests) - len(latencies)))
+  return Summarize(latencies, elapsed)
+
+
+def RunNebraskaServer(requests, metadata_dir, opts):
+  """Posts the requests to a NebraskaServer."""
+  neb = nebraska.Nebraska(nebraska.NebraskaProperties(
+      update_payloads_address='http://127.0.0.1/payloads',
+      update_metadata_dir=metadata_dir,
+      install_metadata_dir=metadata_dir))
+  # Don't log every request to stderr, this runs in its own process.
+  nebraska.NebraskaServer.NebraskaHandler.log_message = lambda *args: None
+  server = nebraska.NebraskaServer(neb)
+  server.Start()
+  try:
+    return _RunClients(server.GetPort(), '/update', requests, opts.clients)
+  finally:
+    server.Stop()
+
+
+def RunDevserver(requests, metadata_dir, opts):
+  """Posts the requests to the update RPC of a devserver."""
+  # pylint: disable=import-error
+  import cherrypy
+  import autoupdate
+  import devserver
+
+  # The static directory has the payload metadata of the label.
+  static_dir = os.path.dirname(os.path.dirname(metadata_dir))
+  devserver.updater = autoupdate.Autoupdate(None, static_dir=static_dir)
+  cherrypy.config.update({
+      'server.socket_host': '127.0.0.1',
+      'server.socket_port': 0,
+      'server.thread_pool': opts.clients,
+      'server.protocol_version': 'HTTP/1.1',
+      'log.screen': False,
+      'engine.autoreload.on': False,
+      'checker.on': False,
+  })
+  cherrypy.tree.mount(devserver.DevServerRoot(None), '/')
+  cherrypy.engine.start()
+  cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+  try:
+    return _RunClients(cherrypy.server.bound_addr[1], '/update/' + _LABEL,
+                       requests, opts.clients)
+  finally:
+    cherrypy.engine.exit()
+
+
+_RUNNERS = {
+    'nebraska': RunNebraska,
+    'nebraska_server': RunNebraskaServer,
+    'devserver': RunDevserver,
+}
+
+
+def _RunMode(mode, opts, metadata_dir, results):
+  """Generates the requests and runs |mode|, in a child process."""
+  logging.disable(logging.CRITICAL)
+  requests = GenerateRequests(opts.requests, opts.mix, opts.dlcs)
+  try:
+    results.put((mode, _RUNNERS[mode](requests, metadata_dir, opts)))
+  except Exception as e:
+    results.put((mode, {'error': str(e)}))
+
+
+def Compare(results, baseline, tolerance):
+  """Returns the regressions of |results| compared to |baseline|."""
+  regressions = []
+  for mode, result in sorted(results['modes'].items()):
+    before = baseline.get('modes', {}).get(mode)
+    if not before or 'error' in result or 'error' in before:
+      continue
+    if (result['requests_per_second'] <
+        before['requests_per_second'] * (1 - tolerance)):
+      regressions.append('%s: %.1f requests per second, was %.1f' % (
+          mode, result['requests_per_second'], before['requests_per_second']))
+    if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+      regressions.append('%s: p99 of %.3fms, was %.3fms' % (
+          mode, result['p99_ms'], before['p99_ms']))
+  return regressions
+
+
+def _ParseMix(value):
+  """Parses 'kind=weight,...' into a dict."""
+  mix = {}
+  for item in value.split(','):
+    kind, _, weight = item.partition('=')
+    if kind not in ('update', 'install', 'event'):
+      raise argparse.ArgumentTypeError('Unknown kind of request %s' % kind)
+    mix[kind] = float(weight)
+  return mix
+
+
+def ParseArguments(argv):
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--modes', default=','.join(MODES),
+                      help='Comma separated modes to run, among %s.' %
+                      ', '.join(MODES))
+  parser.add_argument('--requests', type=int, default=2000,
+                      help='Number of requests to replay in each mode.')
+  parser.add_argument('--mix', type=_ParseMix,
+                      default='update=60,install=10,event=30',
+                      help='Weights of the update checks, installs and events.')
+  parser.add_argument('--dlcs', type=int, default=3,
+                      help='Number of DLC apps in each request.')
+  parser.add_argument('--other-apps', type=int, default=50,
+                      help='Number of apps in the payload metadata directory '
+                      'that no request asks for.')
+  parser.add_argument('--clients', type=int, default=8,
+                      help='Number of concurrent clients of the servers.')
+  parser.add_argument('--output', help='File to write the results to.')
+  parser.add_argument('--baseline',
+                      help='Results of a previous run to compare to.')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='Relative regression --baseline tolerates.')
+  opts = parser.parse_args(argv)
+  opts.modes = opts.modes.split(',')
+  for mode in opts.modes:
+    if mode not in MODES:
+      parser.error('Unknown mode %s' % mode)
+  return opts
+
+
+def main(argv):
+  opts = ParseArguments(argv)
+  static_dir = tempfile.mkdtemp(prefix='update_check_benchmark')
+  try:
+    metadata_dir = os.path.join(static_dir, _LABEL)
+    os.makedirs(metadata_dir)
+    with open(os.path.join(metadata_dir, 'update.gz'), 'w'):
+      pass
+    GenerateMetadataDir(metadata_dir, opts.dlcs, opts.other_apps)
+
+    results = {
+        'parameters': {
+            'requests': opts.requests,
+            'mix': opts.mix,
+            'dlcs': opts.dlcs,
+            'other_apps': opts.other_apps,
+            'clients': opts.clients,
+        },
+        'modes': {},
+    }
+    queue = multiprocessing.Queue()
+    for mode in opts.modes:
+      process = multiprocessing.Process(
+          target=_RunMode, args=(mode, opts, metadata_dir, queue))
+      process.start()
+      name, result = queue.get()
+      process.join()
+      results['modes'][name] = result
+  finally:
+    shutil.rmtree(static_dir)
+
+  output = json.dumps(results, indent=2, sort_keys=True)
+  if opts.output:
+    with open(opts.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+
+  if opts.baseline:
+    with open(opts.baseline) as f:
+      regressions = Compare(results, json.load(f), opts.tolerance)
+    for regression in regressions:
+      print('Regression: %s' % regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))